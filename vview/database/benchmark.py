@@ -0,0 +1,412 @@
+# A query plan regression benchmark for FileIndex.
+#
+# This builds synthetic file indexes of a few sizes, runs every combination of search
+# filter and sort order against them, and compares the results against a checked-in
+# baseline.  This catches changes to FileIndex.search or the schema that turn an indexed
+# search into a table scan or a full sort, which are easy to miss with a small test library.
+#
+# This only uses FileIndex and SQLite, so it runs on any platform:
+#
+# python -m vview.database.benchmark --sizes 10000,100000
+#
+# For each search we record:
+#
+# - The EXPLAIN QUERY PLAN output.  Any change to a plan is reported as a regression, since
+#   it's usually either a mistake or something the baseline should be updated for.
+# - The number of SQLite virtual machine steps taken to return the first page of results.
+#   SQLite doesn't expose the number of rows examined through Python, so this counts VM
+#   instructions with a progress handler instead.  It's proportional to the rows visited
+#   and deterministic for a given SQLite version, so unlike latency it can be compared
+#   strictly.
+# - The latency of the first page, which is what matters for the UI.  This is noisy and
+#   depends on the machine, so it's only compared with a generous tolerance.
+#
+# Run with --update-baseline to replace the baseline with the current results.
+import argparse, asyncio, json, logging, os, random, sqlite3, statistics, sys, tempfile, time
+from pathlib import Path, PurePosixPath
+from .file_index import FileIndex
+
+log = logging.getLogger(__name__)
+
+_baseline_path = Path(__file__).parent / 'benchmark_baseline.json'
+
+# The sort orders to test.  These mirror the 'index' orders in library.sort_orders, which
+# can't be imported here since the library requires Windows.  None is the default order
+# with no ORDER BY, or relevance order for keyword searches.
+sort_orders = {
+    'none': None,
+    'normal': [('basename_if_directory_lowercase', 'DESC'), ('path_lowercase', 'ASC')],
+    'ctime': [('round(ctime - 0.5)', 'ASC'), ('path_lowercase', 'ASC')],
+    'bookmarked-at': [('bookmark_updated_at', 'DESC'), ('path_lowercase', 'DESC')],
+    'natural': [('natural_sort_key', 'ASC'), ('path_lowercase', 'ASC')],
+    'natural-reverse-pages': [('natural_sort_key_pages_reversed', 'ASC'), ('path_lowercase', 'ASC')],
+}
+
+# The root of the synthetic library.  Paths under it are laid out as
+# /library/set###/dir####/file#####.ext.
+_root = PurePosixPath('/library')
+_files_per_directory = 100
+_directories_per_set = 50
+
+_words = ('red', 'blue', 'green', 'sky', 'forest', 'city', 'night', 'portrait', 'landscape', 'sketch')
+_bookmark_tags = ['tag%i' % idx for idx in range(20)]
+
+# The search filters to test, as arguments to FileIndex.search.  Paths are filled in by
+# _get_search_options.
+search_filters = {
+    'all': {},
+    'keyword': { 'substr': 'blue' },
+    'keyword-multiple': { 'substr': 'blue for' },
+    'images': { 'media_type': 'images' },
+    'videos': { 'media_type': 'videos' },
+    'bookmarked': { 'bookmarked': True },
+    'unbookmarked': { 'bookmarked': False },
+    'bookmark-tag': { 'bookmarked': True, 'bookmark_tags': 'tag3' },
+    'untagged': { 'bookmarked': True, 'bookmark_tags': '' },
+    'total-pixels': { 'total_pixels': (2000*2000, None) },
+    'aspect-ratio': { 'aspect_ratio': (1.5, None) },
+    'files-only': { 'include_dirs': False },
+    'dirs-only': { 'include_files': False },
+    'root': { 'paths': [_root] },
+    'subtree': { 'paths': [_root / 'set000'] },
+    'subdir': { 'paths': [_root / 'set000' / 'dir0000'], 'mode': FileIndex.SearchMode.Subdir },
+    'subtree-images': { 'paths': [_root / 'set000'], 'media_type': 'images' },
+}
+
+# How many results to read from each search.  This is the same as a page of results
+# from the API.
+page_size = 50
+
+# The progress handler is called every this many VM instructions.
+_progress_interval = 100
+
+def _get_search_options(filter_name):
+    options = dict(search_filters[filter_name])
+    if 'paths' in options:
+        options['paths'] = [str(path) for path in options['paths']]
+    return options
+
+def create_entries(count, *, seed=1):
+    """
+    Yield count synthetic entries, including the directories containing them.
+
+    The entries are deterministic for a given seed, so step counts are comparable
+    between runs.
+    """
+    rand = random.Random(seed)
+
+    def directory_entry(path):
+        return {
+            'populated': True,
+            'path': str(path),
+            'parent': str(path.parent),
+            'path_lowercase': str(path).lower(),
+            'basename_if_directory_lowercase': path.name.lower(),
+            **FileIndex.get_natural_sort_fields(str(path), is_directory=True),
+            'mtime': 0,
+            'ctime': 0,
+            'filesystem_mtime': 0,
+            'is_directory': True,
+            'width': None,
+            'height': None,
+            'tags': '',
+            'title': '',
+            'comment': '',
+            'mime_type': '',
+            'author': '',
+            'directory_thumbnail_path': None,
+            'bookmarked': False,
+            'bookmark_tags': '',
+        }
+
+    yielded = 0
+    directory = None
+    for file_idx in range(count):
+        # Start a new directory every _files_per_directory files, and a new set every
+        # _directories_per_set directories.
+        if file_idx % _files_per_directory == 0:
+            directory_idx = file_idx // _files_per_directory
+            set_path = _root / ('set%03i' % (directory_idx // _directories_per_set))
+            directory = set_path / ('dir%04i' % (directory_idx % _directories_per_set))
+
+            new_directories = [directory]
+            if directory_idx % _directories_per_set == 0:
+                new_directories.insert(0, set_path)
+                if directory_idx == 0:
+                    new_directories.insert(0, _root)
+
+            for path in new_directories:
+                if yielded >= count:
+                    return
+                yield directory_entry(path)
+                yielded += 1
+
+        if yielded >= count:
+            return
+
+        is_video = rand.random() < 0.1
+        path = directory / ('file%05i.%s' % (file_idx, 'mp4' if is_video else 'jpg'))
+        bookmarked = rand.random() < 0.1
+        tags = ' '.join(rand.sample(_bookmark_tags, rand.randint(0, 3))) if bookmarked else ''
+        ctime = 1500000000 + rand.random() * 100000000
+
+        entry = directory_entry(path)
+        entry.update({
+            'basename_if_directory_lowercase': None,
+            **FileIndex.get_natural_sort_fields(str(path), is_directory=False),
+            'mtime': ctime,
+            'ctime': ctime,
+            'filesystem_mtime': ctime,
+            'is_directory': False,
+            'width': rand.choice((640, 1280, 1920, 2560, 4000)),
+            'height': rand.choice((480, 720, 1080, 1440, 3000)),
+            'tags': ' '.join(rand.sample(_words, 2)),
+            'title': rand.choice(_words),
+            'mime_type': 'video/mp4' if is_video else 'image/jpeg',
+            'bookmarked': bookmarked,
+            'bookmark_tags': tags,
+            'bookmark_created_at': ctime if bookmarked else 0,
+            'bookmark_updated_at': ctime if bookmarked else 0,
+        })
+        yield entry
+        yielded += 1
+
+def create_index(db_path, size):
+    """
+    Return a FileIndex at db_path with size synthetic entries.
+
+    If the database already exists with the right number of entries, it's reused, since
+    large indexes take a while to build.
+    """
+    if os.path.exists(db_path):
+        db = FileIndex(db_path)
+        with db.cursor() as cursor:
+            count = cursor.execute(f'SELECT COUNT(*) AS count FROM {db.schema}.files').fetchone()['count']
+        if count == size:
+            return db
+
+        log.info(f'Recreating {db_path}')
+        del db
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.unlink(str(db_path) + suffix)
+            except FileNotFoundError:
+                pass
+
+    db = FileIndex(db_path)
+    started_at = time.time()
+    chunk = []
+    for entry in create_entries(size):
+        chunk.append(entry)
+        if len(chunk) >= 10000:
+            db.add_records(chunk)
+            chunk = []
+    db.add_records(chunk)
+
+    with db.connect(write=True) as conn:
+        conn.execute(f'ANALYZE {db.schema}')
+
+    log.info('Created %s with %i entries in %.1f seconds' % (db_path, size, time.time() - started_at))
+    return db
+
+def _get_order_by(sort_name, *, reverse=False):
+    """
+    Return the ORDER BY clause for a sort order, or None for no order.
+    """
+    order = sort_orders[sort_name]
+    if order is None:
+        return None
+
+    if reverse:
+        order = [(key, 'ASC' if direction == 'DESC' else 'DESC') for key, direction in order]
+    return 'ORDER BY ' + ', '.join(f'{key} {direction}' for key, direction in order)
+
+def check_sort_order_plans(db, *, paths=None):
+    """
+    Raise an exception if searching the index with any sort order, or its reverse, needs
+    a temporary B-tree to sort.  That means every result is read and sorted before the first
+    one is returned, which is very slow for large libraries.
+
+    If paths is set, check searching inside those paths, such as the library's mounts.
+    """
+    # Bookmark sorts are only used when searching bookmarks, and their index only covers bookmarks.
+    search_options = {
+        'bookmarked-at': { 'bookmarked': True },
+    }
+
+    for sort_name in sort_orders.keys():
+        for reverse in (False, True):
+            order_by = _get_order_by(sort_name, reverse=reverse)
+            if order_by is None:
+                continue
+
+            plan = [row['detail'] for row in db.search(paths=paths, order=order_by, explain=True, **search_options.get(sort_name, {}))]
+            if any('USE TEMP B-TREE FOR ORDER BY' in detail for detail in plan):
+                raise Exception(f'Sort order {order_by} isn\'t indexed: {plan}')
+
+def _get_plan(db, conn, options):
+    """
+    Return the query plan for a search as a list of lines, indented to show nesting.
+    """
+    depths = {}
+    plan = []
+    for row in db.search(explain=True, conn=conn, **options):
+        depth = depths.get(row['parent'], -1) + 1
+        depths[row['id']] = depth
+        plan.append('  '*depth + row['detail'])
+    return plan
+
+def run_search(db, filter_name, sort_name, *, reverse=False, repeat=3):
+    """
+    Run one search, returning its query plan, step count and latency.
+    """
+    options = _get_search_options(filter_name)
+    order_by = _get_order_by(sort_name, reverse=reverse)
+    if order_by is not None:
+        options['order'] = order_by
+
+    with db.connect() as conn:
+        plan = _get_plan(db, conn, options)
+
+        steps = 0
+        def progress():
+            nonlocal steps
+            steps += _progress_interval
+            return 0
+
+        latencies = []
+        for _ in range(repeat):
+            steps = 0
+            conn.set_progress_handler(progress, _progress_interval)
+            try:
+                started_at = time.perf_counter()
+                results = db.search(conn=conn, **options)
+                try:
+                    for _ in zip(range(page_size), results):
+                        pass
+                finally:
+                    results.close()
+                latencies.append(time.perf_counter() - started_at)
+            finally:
+                conn.set_progress_handler(None, 0)
+
+    return {
+        'plan': plan,
+        'steps': steps,
+        'latency_ms': round(statistics.median(latencies) * 1000, 3),
+    }
+
+def get_case_names():
+    """
+    Yield (case name, filter name, sort name, reverse) for each combination to test.
+    """
+    for filter_name in search_filters.keys():
+        for sort_name, order in sort_orders.items():
+            for reverse in (False, True):
+                # The default order has no reverse.
+                if order is None and reverse:
+                    continue
+
+                case_name = f'{filter_name} {"-" if reverse else ""}{sort_name}'
+                yield case_name, filter_name, sort_name, reverse
+
+def run_benchmark(db, *, repeat=3):
+    results = {}
+    for case_name, filter_name, sort_name, reverse in get_case_names():
+        results[case_name] = run_search(db, filter_name, sort_name, reverse=reverse, repeat=repeat)
+        log.debug('%s: %i steps, %.1fms' % (case_name, results[case_name]['steps'], results[case_name]['latency_ms']))
+    return results
+
+def compare_results(results, baseline, *, step_tolerance=1.25, latency_tolerance=3, min_latency_ms=5):
+    """
+    Compare results for one index size against the baseline, returning a list of
+    regressions.
+
+    Steps regress if they grow by more than step_tolerance.  Latency regresses if it grows
+    by more than latency_tolerance and by at least min_latency_ms, so tiny searches don't
+    fail due to noise.
+    """
+    regressions = []
+    for case_name, result in results.items():
+        expected = baseline.get(case_name)
+        if expected is None:
+            log.info(f'{case_name}: not in baseline')
+            continue
+
+        if result['plan'] != expected['plan']:
+            regressions.append(f'{case_name}: query plan changed:\n' +
+                '\n'.join('    was: ' + line for line in expected['plan']) + '\n' +
+                '\n'.join('    now: ' + line for line in result['plan']))
+
+        if result['steps'] > expected['steps'] * step_tolerance:
+            regressions.append(f'{case_name}: steps increased from {expected["steps"]} to {result["steps"]}')
+
+        latency, expected_latency = result['latency_ms'], expected['latency_ms']
+        if latency > expected_latency * latency_tolerance and latency - expected_latency >= min_latency_ms:
+            regressions.append(f'{case_name}: latency increased from {expected_latency:.1f}ms to {latency:.1f}ms')
+
+    return regressions
+
+async def main():
+    parser = argparse.ArgumentParser(description='Benchmark FileIndex search query plans against a baseline.')
+    parser.add_argument('--sizes', default='10000,100000,1000000',
+        help='Comma-separated index sizes to test (default: %(default)s)')
+    parser.add_argument('--work-dir', type=Path, default=Path(tempfile.gettempdir()) / 'vview-benchmark',
+        help='Where to store the generated indexes, which are reused between runs (default: %(default)s)')
+    parser.add_argument('--baseline', type=Path, default=_baseline_path,
+        help='The baseline file to compare against (default: %(default)s)')
+    parser.add_argument('--update-baseline', action='store_true',
+        help='Write the results to the baseline instead of comparing them')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='How many times to run each search, using the median latency (default: %(default)s)')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(message)s')
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    args.work_dir.mkdir(parents=True, exist_ok=True)
+
+    try:
+        with args.baseline.open('r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = { 'sizes': {} }
+
+    if baseline.get('sqlite_version') not in (None, sqlite3.sqlite_version):
+        log.warning(f'The baseline was recorded with SQLite {baseline["sqlite_version"]}, but this is '
+            f'{sqlite3.sqlite_version}.  Query plans and step counts may differ.')
+
+    regressions = []
+    for size in sizes:
+        db = create_index(args.work_dir / f'benchmark-{size}.sqlite', size)
+        results = run_benchmark(db, repeat=args.repeat)
+
+        if args.update_baseline:
+            baseline['sizes'][str(size)] = results
+            continue
+
+        expected = baseline['sizes'].get(str(size))
+        if expected is None:
+            log.info(f'No baseline for {size} entries')
+            continue
+
+        size_regressions = compare_results(results, expected)
+        log.info(f'{size} entries: {len(results)} searches, {len(size_regressions)} regressions')
+        regressions.extend(f'[{size}] {regression}' for regression in size_regressions)
+
+    if args.update_baseline:
+        baseline['sqlite_version'] = sqlite3.sqlite_version
+        with args.baseline.open('w', encoding='utf-8') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+            f.write('\n')
+        log.info(f'Updated {args.baseline}')
+        return 0
+
+    for regression in regressions:
+        log.error(regression)
+
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
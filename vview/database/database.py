@@ -69,49 +69,178 @@ def transaction(conn):
         else:
             _transactions[conn] = count
 
+class _ConnectionPool:
+    """
+    A pool of database connections, with a limit on how many can be open at once.
+    """
+    def __init__(self, open_connection, *, name, max_connections, timeout):
+        self.open_connection = open_connection
+        self.name = name
+        self.max_connections = max_connections
+        self.timeout = timeout
+
+        self.idle = []
+        self.open_count = 0
+        self.in_use = 0
+        self.condition = threading.Condition()
+
+        # Statistics.  See get_stats.
+        self.peak_in_use = 0
+        self.acquired = 0
+        self.waited = 0
+        self.total_wait_time = 0
+        self.max_wait_time = 0
+
+    def acquire(self):
+        """
+        Return a connection, waiting for one to be released if the pool is full.
+        """
+        started_at = time.time()
+        with self.condition:
+            while not self.idle and self.open_count >= self.max_connections:
+                remaining = self.timeout - (time.time() - started_at)
+                if remaining <= 0:
+                    raise sqlite3.OperationalError(f'Timed out waiting for a {self.name} connection')
+                self.condition.wait(remaining)
+
+            if self.idle:
+                connection = self.idle.pop()
+            else:
+                # Reserve a slot, and open the connection below outside of the lock.
+                connection = None
+                self.open_count += 1
+
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+            wait_time = time.time() - started_at
+            self.acquired += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+            if wait_time > 0.01:
+                self.waited += 1
+
+        if wait_time > 1:
+            log.info('Waited %.1f seconds for a %s connection' % (wait_time, self.name))
+
+        if connection is None:
+            try:
+                connection = self.open_connection()
+            except:
+                with self.condition:
+                    self.open_count -= 1
+                    self.in_use -= 1
+                    self.condition.notify()
+                raise
+
+        return connection
+
+    def release(self, connection):
+        with self.condition:
+            assert connection not in self.idle
+            self.idle.append(connection)
+            self.in_use -= 1
+            self.condition.notify()
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                'max_connections': self.max_connections,
+                'open': self.open_count,
+                'in_use': self.in_use,
+                'peak_in_use': self.peak_in_use,
+                'acquired': self.acquired,
+                'waited': self.waited,
+                'total_wait_time': self.total_wait_time,
+                'max_wait_time': self.max_wait_time,
+            }
+
 class Database:
     """
     A base class for our databases.
+
+    Connections are pooled separately for reading and writing, so readers holding
+    connections for long-running searches never prevent writers from getting a connection,
+    and the reverse.  Read connections are query_only.
+
+    A search keeps its read connection for as long as its generator is alive, including
+    while it's parked between pages in the /api/list cache, so max_readers needs to stay
+    well above the number of searches the server can park, or parked searches would
+    starve everything else.
+
+    mmap_size, cache_size and temp_store set the PRAGMAs of the same name for this database.
+    cache_size is in KiB if negative, as with the PRAGMA.
     """
-    def __init__(self, db_path, schema):
+    def __init__(self, db_path, schema, *,
+        mmap_size=256*1024*1024,
+        cache_size=-32*1024,
+        temp_store='MEMORY',
+        max_readers=64,
+        max_writers=4,
+        pool_timeout=60,
+    ):
         self.db_path = db_path
         self.schema = schema
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.temp_store = temp_store
 
         # Remember the main event loop.  Note that this class is called from a thread, so
         # anything using this needs to use asyncio.run_coroutine_threadsafe.
         self._event_loop = asyncio.get_running_loop()
 
-        self.connections = []
-        self.lock = threading.Lock()
+        self._read_pool = _ConnectionPool(self._open_read_connection, name=f'{schema} read',
+            max_connections=max_readers, timeout=pool_timeout)
+        self._write_pool = _ConnectionPool(self.open_db, name=f'{schema} write',
+            max_connections=max_writers, timeout=pool_timeout)
 
         # Open the DB now to create it.
         with self.connect() as conn:
             pass
 
+    def _open_read_connection(self):
+        conn = self.open_db()
+
+        # Don't allow writes through read connections.  This is set after open_db, so
+        # migrations can still run.
+        conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    def get_pool_stats(self):
+        """
+        Return statistics for the read and write connection pools.
+        """
+        return {
+            'read': self._read_pool.get_stats(),
+            'write': self._write_pool.get_stats(),
+        }
+
     @contextmanager
     def connect(self, existing_connection=None, write=False):
         """
         Yield a pooled connection, committing it on completion or rolling back on exception.
 
-        If write is true, the connection will be opened with BEGIN IMMEDIATE TRANSACTION
-        active.
-
+        If write is true, the connection will be taken from the write pool and opened
+        with BEGIN IMMEDIATE TRANSACTION active.  Otherwise, it's a read-only connection.
         """
         if existing_connection is not None:
             yield existing_connection
             return
 
-        with self.lock:
-            if self.connections:
-                connection = self.connections.pop()
-            else:
-                connection = self.open_db()
+        pool = self._write_pool if write else self._read_pool
+        connection = pool.acquire()
 
         change_count = connection.total_changes
-        if write:
-            connection.execute('BEGIN IMMEDIATE TRANSACTION')
-        else:
-            connection.execute('BEGIN TRANSACTION')
+        try:
+            if write:
+                connection.execute('BEGIN IMMEDIATE TRANSACTION')
+            else:
+                connection.execute('BEGIN TRANSACTION')
+        except:
+            # If we couldn't start the transaction, such as if the database is locked,
+            # return the connection to the pool.
+            pool.release(connection)
+            raise
 
         started_at = time.time()
 
@@ -136,10 +265,8 @@ class Database:
         finally:
             connection.rollback()
 
-            with self.lock:
-                assert not connection.in_transaction
-                assert connection not in self.connections
-                self.connections.append(connection)
+            assert not connection.in_transaction
+            pool.release(connection)
 
     @contextmanager
     def cursor(self, conn=None, write=False):
@@ -185,6 +312,10 @@ class Database:
         # Why is this off by default?
         conn.execute(f'PRAGMA {self.schema}.foreign_keys = ON')
 
+        conn.execute(f'PRAGMA {self.schema}.mmap_size = {int(self.mmap_size)}')
+        conn.execute(f'PRAGMA {self.schema}.cache_size = {int(self.cache_size)}')
+        conn.execute(f'PRAGMA temp_store = {self.temp_store}')
+
         # Enable read_uncommitted.  This means that searches will never be blocked by a write
         # lock during an update.  This can give inconsistent results if data is read during
         # a transaction, but that's harmless for our use case and it's much more important to
@@ -214,7 +345,7 @@ class Database:
                 raise Exception('No info field in db: %s' % self)
 
     def _set_info(self, field, value, *, conn):
-        with self.cursor(conn) as cursor:
+        with self.cursor(conn, write=True) as cursor:
             query = f'''
                 UPDATE {self.schema}.info
                     SET %(field)s = ?
@@ -1,6 +1,6 @@
-import asyncio, os, re, logging
+import asyncio, itertools, json, os, random, re, logging, sqlite3, time, zlib
 from enum import Enum
-from pathlib import Path
+from pathlib import Path, PurePath
 from .database import Database, transaction
 from pprint import pprint
 from ..util import misc
@@ -8,14 +8,18 @@ from ..util.misc import WithBuilder
 
 log = logging.getLogger(__name__)
 
+# The numeric prefix of a string, which SQLite uses when a string is used as a number.
+_sql_numeric_prefix = re.compile(r'\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?')
+
 # This implements the database storage for library.  It stores similar data to
 # what we get from the Windows index.
 class FileIndex(Database):
-    def __init__(self, db_path, *, schema='files'):
+    def __init__(self, db_path, *, schema='files', **kwargs):
         """
-        db_path is the path to the database on the filesystem.
+        db_path is the path to the database on the filesystem.  Other arguments are
+        passed to Database.
         """
-        super().__init__(db_path, schema=schema)
+        super().__init__(db_path, schema=schema, **kwargs)
 
     def open_db(self):
         conn = super().open_db()
@@ -156,7 +160,223 @@ class FileIndex(Database):
                     conn.execute(f'CREATE INDEX {self.schema}.bookmark_tags_file_id on bookmark_tags(file_id)')
                     conn.execute(f'CREATE INDEX {self.schema}.bookmark_tags_tag on bookmark_tags(tag)')
 
-        assert self.get_db_version(conn=conn) == 1
+            if self.get_db_version(conn=conn) == 1:
+                with transaction(conn):
+                    self.set_db_version(2, conn=conn)
+
+                    # This is a full-text index of each file's keywords, used by keyword searches.
+                    # The rowid is the file ID, and keywords is the file's keywords separated by spaces.
+                    # Keywords are already split and lowercased by split_keywords, so the tokenizer
+                    # only needs to split on spaces.  Don't let it strip diacritics, since GLOB
+                    # matching against file_keywords didn't.
+                    #
+                    # This should be searched with:
+                    #
+                    # SELECT * FROM file_search WHERE file_search MATCH '"word1"* AND "word2"*';
+                    #
+                    # file_search isn't linked to files with a foreign key, so it needs to be updated
+                    # explicitly when files are added, removed or renamed.
+                    conn.execute(f'''
+                        CREATE VIRTUAL TABLE {self.schema}.file_search USING fts5(
+                            keywords,
+                            tokenize = "unicode61 remove_diacritics 0"
+                        )
+                    ''')
+
+                    # Fill the index from the keywords we already have, so existing databases
+                    # don't need to be rescanned.
+                    conn.execute(f'''
+                        INSERT INTO {self.schema}.file_search (rowid, keywords)
+                            SELECT file_id, group_concat(keyword, ' ')
+                            FROM {self.schema}.file_keywords
+                            GROUP BY file_id
+                    ''')
+
+            if self.get_db_version(conn=conn) == 2:
+                with transaction(conn):
+                    self.set_db_version(3, conn=conn)
+
+                    # This is a hierarchy index of directories, used to find everything inside a
+                    # directory without prefix matching paths.  Every directory that contains a file
+                    # in the index has an entry here, along with its parents.  These don't need to
+                    # be in files.
+                    conn.execute(f'''
+                        CREATE TABLE {self.schema}.directories(
+                            id INTEGER PRIMARY KEY,
+                            path UNIQUE NOT NULL,
+                            parent_id INTEGER
+                        )
+                    ''')
+
+                    # This has a row for each directory and each directory inside it, recursively,
+                    # including the directory itself with a depth of 0.  Everything inside a
+                    # directory is:
+                    #
+                    # SELECT descendant_id FROM directory_closure WHERE ancestor_id = ?
+                    #
+                    # The IDs are declared INTEGER so they have the same affinity as directories.id.
+                    # Otherwise, SQLite can't use the indexes when comparing them against subqueries
+                    # on directories.
+                    conn.execute(f'''
+                        CREATE TABLE {self.schema}.directory_closure(
+                            ancestor_id INTEGER NOT NULL,
+                            descendant_id INTEGER NOT NULL,
+                            depth NOT NULL,
+                            PRIMARY KEY(ancestor_id, descendant_id),
+                            FOREIGN KEY(ancestor_id) REFERENCES directories(id) ON DELETE CASCADE,
+                            FOREIGN KEY(descendant_id) REFERENCES directories(id) ON DELETE CASCADE
+                        ) WITHOUT ROWID
+                    ''')
+                    conn.execute(f'CREATE INDEX {self.schema}.directory_closure_descendant_id on directory_closure(descendant_id)')
+
+                    # directory_id is the directory entry for the file's parent.
+                    conn.execute(f'ALTER TABLE {self.schema}.files ADD COLUMN directory_id INTEGER')
+                    conn.execute(f'CREATE INDEX {self.schema}.files_directory_id on files(directory_id)')
+
+                    # Fill in the hierarchy for existing files.
+                    cursor = conn.cursor()
+                    parents = [row[0] for row in cursor.execute(f'SELECT DISTINCT parent FROM {self.schema}.files')]
+                    self._get_directory_ids(cursor, parents)
+                    cursor.execute(f'''
+                        UPDATE {self.schema}.files
+                        SET directory_id = (
+                            SELECT id FROM {self.schema}.directories WHERE directories.path = files.parent
+                        )
+                    ''')
+
+            if self.get_db_version(conn=conn) == 3:
+                with transaction(conn):
+                    self.set_db_version(4, conn=conn)
+
+                    # Add generated columns for total_pixels and aspect_ratio searches, so they can
+                    # be indexed.  These must use the same expressions search() used before, so
+                    # results don't change.  The aspect_ratio column is set by the library from
+                    # metadata and isn't always in sync with width and height, so it isn't used.
+                    #
+                    # These are VIRTUAL, since ALTER TABLE can't add STORED columns.  The values
+                    # are stored in the indexes, which is all searches need.
+                    conn.execute(f'ALTER TABLE {self.schema}.files ADD COLUMN total_pixels GENERATED ALWAYS AS (width*height) VIRTUAL')
+                    conn.execute(f'ALTER TABLE {self.schema}.files ADD COLUMN computed_aspect_ratio GENERATED ALWAYS AS (1.0 * width/height) VIRTUAL')
+                    conn.execute(f'CREATE INDEX {self.schema}.files_total_pixels on files(total_pixels)')
+                    conn.execute(f'CREATE INDEX {self.schema}.files_computed_aspect_ratio on files(computed_aspect_ratio)')
+
+            if self.get_db_version(conn=conn) == 4:
+                with transaction(conn):
+                    self.set_db_version(5, conn=conn)
+
+                    # Indexes for the other sort orders in library.sort_orders, so sorting doesn't
+                    # need a temporary B-tree.  These are also used for the reversed sorts.  The ctime
+                    # sort is an expression, so it needs an expression index with the same expression.
+                    conn.execute(f'CREATE INDEX {self.schema}.files_sort_ctime on files(round(ctime - 0.5), path_lowercase)')
+
+                    # The bookmarked-at sort also sorts by path to break ties.
+                    conn.execute(f'DROP INDEX {self.schema}.files_bookmark_updated_at')
+                    conn.execute(f'CREATE INDEX {self.schema}.files_bookmark_updated_at on files(bookmark_updated_at, path_lowercase) WHERE bookmarked')
+
+            if self.get_db_version(conn=conn) == 5:
+                with transaction(conn):
+                    self.set_db_version(6, conn=conn)
+
+                    # The refresh journal.  Library.refresh records each directory's mtime and
+                    # number of children when it lists it, and the mtime of its metadata file if
+                    # it has one, so later refreshes can skip directories that haven't changed.
+                    # These are null for directories that haven't been listed.
+                    conn.execute(f'ALTER TABLE {self.schema}.directories ADD COLUMN mtime')
+                    conn.execute(f'ALTER TABLE {self.schema}.directories ADD COLUMN child_count')
+                    conn.execute(f'ALTER TABLE {self.schema}.directories ADD COLUMN metadata_mtime')
+
+            if self.get_db_version(conn=conn) == 6:
+                with transaction(conn):
+                    self.set_db_version(7, conn=conn)
+
+                    # Unpopulated entries are the queue for the library's populate engine, which
+                    # reads them in ID order.  populate_checkpoint is the last ID it finished, so
+                    # it can continue where it left off after a restart.
+                    conn.execute(f'CREATE INDEX {self.schema}.files_unpopulated on files(id) WHERE NOT populated')
+                    conn.execute(f'ALTER TABLE {self.schema}.info ADD COLUMN populate_checkpoint NOT NULL DEFAULT 0')
+
+            if self.get_db_version(conn=conn) == 7:
+                with transaction(conn):
+                    self.set_db_version(8, conn=conn)
+
+                    # Natural sort keys for the "natural" and "natural-reverse-pages" sort orders in
+                    # library.sort_orders.  These are strings that sort naturally, so they can be
+                    # indexed.  See get_natural_sort_fields.
+                    conn.execute(f'ALTER TABLE {self.schema}.files ADD COLUMN natural_sort_key')
+                    conn.execute(f'ALTER TABLE {self.schema}.files ADD COLUMN natural_sort_key_pages_reversed')
+
+                    # Fill in existing files a chunk at a time, so we don't load the whole table
+                    # into memory for large libraries.  The new columns aren't indexed yet, so
+                    # updating them doesn't disturb the scan.
+                    read_cursor = conn.cursor()
+                    write_cursor = conn.cursor()
+                    read_cursor.execute(f'SELECT id, path, is_directory FROM {self.schema}.files')
+                    while True:
+                        rows = read_cursor.fetchmany(500)
+                        if not rows:
+                            break
+
+                        updates = []
+                        for row in rows:
+                            fields = self.get_natural_sort_fields(row['path'], is_directory=row['is_directory'])
+                            updates.append((fields['natural_sort_key'], fields['natural_sort_key_pages_reversed'], row['id']))
+                        write_cursor.executemany(f'''
+                            UPDATE {self.schema}.files
+                            SET natural_sort_key = ?, natural_sort_key_pages_reversed = ?
+                            WHERE id = ?
+                        ''', updates)
+
+                    # Indexes for searching with these sorts, and for listing a single directory with
+                    # them (parent = ?) without sorting.
+                    conn.execute(f'CREATE INDEX {self.schema}.files_sort_natural on files(natural_sort_key, path_lowercase)')
+                    conn.execute(f'CREATE INDEX {self.schema}.files_sort_natural_reverse_pages on files(natural_sort_key_pages_reversed, path_lowercase)')
+                    conn.execute(f'CREATE INDEX {self.schema}.files_list_natural on files(parent, natural_sort_key, path_lowercase)')
+                    conn.execute(f'CREATE INDEX {self.schema}.files_list_natural_reverse_pages on files(parent, natural_sort_key_pages_reversed, path_lowercase)')
+
+                    # The listing indexes begin with parent, so they replace the parent index.
+                    conn.execute(f'DROP INDEX {self.schema}.files_parent')
+
+                    # The directory's mtime when everything in it was last added to the index, so
+                    # the library can list it from the index if it hasn't changed since.  This is
+                    # null if it hasn't been.  See set_listing_mtimes.
+                    conn.execute(f'ALTER TABLE {self.schema}.directories ADD COLUMN listing_mtime')
+
+            if self.get_db_version(conn=conn) == 8:
+                with transaction(conn):
+                    self.set_db_version(9, conn=conn)
+
+                    # Cached results computed from directory listings, such as the library's
+                    # list_ids.  key identifies what was computed from the directory, and mtime is
+                    # the directory's mtime when it was.  data is compressed JSON.  See
+                    # get_listing_cache.
+                    conn.execute(f'''
+                        CREATE TABLE {self.schema}.listing_cache(
+                            path NOT NULL,
+                            key NOT NULL,
+                            mtime NOT NULL,
+                            data NOT NULL,
+                            last_used_at NOT NULL,
+                            PRIMARY KEY(path, key)
+                        )
+                    ''')
+                    conn.execute(f'CREATE INDEX {self.schema}.listing_cache_last_used_at on listing_cache(last_used_at)')
+
+            if self.get_db_version(conn=conn) == 9:
+                with transaction(conn):
+                    self.set_db_version(10, conn=conn)
+
+                    # Metadata files we've read, and their mtime and size when we did.  The library
+                    # uses this at startup to only read metadata files that have changed, instead
+                    # of searching for all of them.  See get_metadata_files.
+                    conn.execute(f'''
+                        CREATE TABLE {self.schema}.metadata_files(
+                            path PRIMARY KEY NOT NULL,
+                            mtime NOT NULL,
+                            size NOT NULL
+                        )
+                    ''')
+
+        assert self.get_db_version(conn=conn) == 10
 
     @classmethod
     def split_keywords(self, filename):
@@ -180,6 +400,20 @@ class FileIndex(Database):
                 keywords |= self.split_keywords(entry[keyword_field])
         return keywords
 
+    @classmethod
+    def get_natural_sort_fields(cls, path, *, is_directory):
+        """
+        Return the natural sort key fields for an entry with the given path.
+
+        The library includes these in entries it creates.  They only depend on the path,
+        so they're treated like path_lowercase and only change on rename.
+        """
+        stem = PurePath(path).stem
+        return {
+            'natural_sort_key': misc.natural_sort_key(stem, is_directory=is_directory),
+            'natural_sort_key_pages_reversed': misc.natural_sort_key(stem, is_directory=is_directory, reverse_pages=True),
+        }
+
     def add_record(self, entry, *, conn=None):
         """
         Add or update a file record.  Set entry['id'] to the new or updated record's
@@ -187,111 +421,464 @@ class FileIndex(Database):
 
         If a record for this path already exists, it will be replaced.
         """
-        # We're going to read the database and then probably write a record.  Try to open
-        # a write transaction from the start, which prevents "database locked" errors if
-        # the database is modified between the read and the write.  This won't do anything
-        # if we already have a connection.
-        with self.cursor(conn, write=True) as cursor:
-            fields = list(entry.keys())
+        self.add_records([entry], conn=conn)
+        return entry
 
-            # These fields are included in the keyword index.
-            keyword_fields = self.keyword_fields
+    # Fields that are never changed when updating an existing record.  These only change
+    # on rename.
+    _invariant_fields = ('id', 'path', 'parent', 'directory_id', 'path_lowercase', 'basename_if_directory_lowercase',
+        'natural_sort_key', 'natural_sort_key_pages_reversed')
 
-            # See if this file already exists in the database.
-            query = f"""
-                SELECT *
-                FROM {self.schema}.files
-                WHERE path = ?
-                """
-            result = list(cursor.execute(query, (entry['path'],)))
-            existing_record = result[0] if result else None
-
-            if existing_record:
-                # The record already exists.  Update all fields except for path, parent, and
-                # path_lowercase name, which are invariant (except for renames which we don't
-                # do here)  This is much faster than letting INSERT OR REPLACE replace the record.
-                fields.remove('path')
-                fields.remove('parent')
-                fields.remove('path_lowercase')
-                fields.remove('basename_if_directory_lowercase')
-                row = [entry[key] for key in fields]
-                row.append(entry['path'])
-                sets = ['%s = ?' % field for field in fields]
-                query = f'''
-                    UPDATE {self.schema}.files
-                        SET {', '.join(sets)}
-                        WHERE path = ?
-                '''
-                cursor.execute(query, row)
+    # Generated columns, which are never written.  These are present in entries read from
+    # the database.
+    _generated_fields = ('total_pixels', 'computed_aspect_ratio')
 
-                # If any field in keyword_fields has changed, we need to update the keyword index.
-                keyword_update_needed = False
-                for keyword_field in keyword_fields:
-                    keyword_update_needed |= existing_record[keyword_field] != entry[keyword_field]
+    def add_records(self, entries, *, conn=None, chunk_size=500, replace=True):
+        """
+        Add or update a list of file records, setting entry['id'] on each entry.
+
+        This is the same as calling add_record on each entry, but reads existing records
+        and writes changes with a few queries per chunk instead of several queries per
+        entry.  Each chunk is written in its own transaction, unless conn is set, in which
+        case everything is written to conn.
+
+        If replace is false, only add entries that don't already exist, and leave existing
+        records unchanged.
+        """
+        entries = list(entries)
+        for start in range(0, len(entries), chunk_size):
+            chunk = entries[start:start+chunk_size]
+
+            # We're going to read the database and then probably write records.  Open a
+            # write transaction from the start, which prevents "database locked" errors if
+            # the database is modified between the read and the write.  This won't do anything
+            # if we already have a connection.
+            with self.cursor(conn, write=True) as cursor:
+                self._add_records_chunk(cursor, chunk, replace=replace)
+
+        return entries
+
+    def _add_records_chunk(self, cursor, entries, *, replace=True):
+        # If the same path is in the list more than once, the last one wins.
+        entries_by_path = {entry['path']: entry for entry in entries}
+        paths = list(entries_by_path.keys())
+
+        # These fields are included in the keyword index.
+        keyword_fields = self.keyword_fields
+
+        # See which of these files already exist in the database.
+        query = f"""
+            SELECT id, path, bookmark_tags, {', '.join(keyword_fields)}
+            FROM {self.schema}.files
+            WHERE path IN ({', '.join('?'*len(paths))})
+            """
+        existing_records = { row['path']: row for row in cursor.execute(query, paths) }
+
+        # Find the directory entries for new files, creating them if needed.
+        directory_ids = self._get_directory_ids(cursor,
+            { entry['parent'] for path, entry in entries_by_path.items() if path not in existing_records })
+
+        # Entries can have different fields, such as placeholder and populated entries, so
+        # group writes by the fields being written.
+        updates = {}
+        inserts = {}
+        keyword_updates = []
+        tag_updates = []
+        for path, entry in entries_by_path.items():
+            existing_record = existing_records.get(path)
+            if existing_record and not replace:
+                entry['id'] = existing_record['id']
+            elif existing_record:
+                # The record already exists.  Update all fields except for the invariant fields.
+                # This is much faster than letting INSERT OR REPLACE replace the record.
+                fields = tuple(field for field in entry.keys() if field not in self._invariant_fields and field not in self._generated_fields)
+                updates.setdefault(fields, []).append([entry[key] for key in fields] + [path])
 
-                # If the tag list changed, we need to update the tag index.
-                tag_update_needed = existing_record['bookmark_tags'] != entry['bookmark_tags']
-                
                 # Set the ID in our caller's entry to the existing ID.
                 entry['id'] = existing_record['id']
+
+                # If any field in keyword_fields has changed, we need to update the keyword index.
+                if any(existing_record[field] != entry[field] for field in keyword_fields):
+                    keyword_updates.append(entry)
+
+                # If the tag list changed, we need to update the tag index.
+                if existing_record['bookmark_tags'] != entry['bookmark_tags']:
+                    tag_updates.append(entry)
             else:
                 # The record doesn't exist, so create a new one.
-                keyword_update_needed = True
+                fields = tuple(field for field in entry.keys() if field not in ('id', 'directory_id') and field not in self._generated_fields)
+                inserts.setdefault(fields, []).append([entry[key] for key in fields] + [directory_ids[entry['parent']]])
+                keyword_updates.append(entry)
 
                 # If this entry is bookmarked, update its tag index.  Since this is a new entry,
                 # we can skip this if it's not bookmarked.
-                tag_update_needed = entry['bookmarked']
-
-                row = [entry[key] for key in fields]
-
-                query = f'''
-                    INSERT OR REPLACE INTO {self.schema}.files
-                        (%(fields)s)
-                        VALUES (%(placeholders)s)
-                ''' % {
-                    'fields': ', '.join(fields),
-                    'placeholders': ', '.join('?'*len(fields))
-                }
-                cursor.execute(query, row)
-                rowid = cursor.lastrowid
-
-                # Fill in the ID.
-                entry['id'] = rowid
-
-            # Update search keywords if needed.
-            if keyword_update_needed:
-                # Delete old keywords.
-                cursor.execute(f'DELETE FROM {self.schema}.file_keywords WHERE file_id = ?', [entry['id']])
+                if entry['bookmarked']:
+                    tag_updates.append(entry)
 
-                keywords = self.get_keywords_for_entry(entry)
+        for fields, rows in updates.items():
+            sets = ['%s = ?' % field for field in fields]
+            cursor.executemany(f'''
+                UPDATE {self.schema}.files
+                    SET {', '.join(sets)}
+                    WHERE path = ?
+            ''', rows)
 
-                keywords_to_add = []
-                for keyword in keywords:
-                    keywords_to_add.append((entry['id'], keyword.lower()))
+        for fields, rows in inserts.items():
+            cursor.executemany(f'''
+                INSERT OR REPLACE INTO {self.schema}.files
+                    (%(fields)s)
+                    VALUES (%(placeholders)s)
+            ''' % {
+                'fields': ', '.join(fields + ('directory_id',)),
+                'placeholders': ', '.join('?'*(len(fields) + 1))
+            }, rows)
+
+        # executemany doesn't give us the new IDs, so read them back.
+        if inserts:
+            new_paths = [path for path in paths if path not in existing_records]
+            query = f"""
+                SELECT id, path
+                FROM {self.schema}.files
+                WHERE path IN ({', '.join('?'*len(new_paths))})
+                """
+            for row in cursor.execute(query, new_paths):
+                entries_by_path[row['path']]['id'] = row['id']
 
-                cursor.executemany(f'''
-                    INSERT INTO {self.schema}.file_keywords (file_id, keyword) values (?, ?)
-                ''', keywords_to_add)
+        # Update search keywords if needed.
+        if keyword_updates:
+            self._update_keywords(cursor, keyword_updates)
 
-            # Update bookmark tags if needed.
-            if tag_update_needed:
-                # Delete old tags.
-                cursor.execute(f'DELETE FROM {self.schema}.bookmark_tags WHERE file_id = ?', [entry['id']])
+        # Update bookmark tags if needed.
+        if tag_updates:
+            # Delete old tags.
+            cursor.executemany(f'DELETE FROM {self.schema}.bookmark_tags WHERE file_id = ?',
+                [(entry['id'],) for entry in tag_updates])
 
+            tags_to_add = []
+            for entry in tag_updates:
                 # Split the tag list.
                 tags = set(entry['bookmark_tags'].split(' '))
                 if '' in tags:
                     tags.remove('')
 
-                tags_to_add = []
                 for tag in tags:
                     tags_to_add.append((entry['id'], tag))
 
+            cursor.executemany(f'''
+                INSERT INTO {self.schema}.bookmark_tags (file_id, tag) values (?, ?)
+            ''', tags_to_add)
+
+        # If a path was listed more than once, give the other entries the ID too.
+        for entry in entries:
+            entry['id'] = entries_by_path[entry['path']]['id']
+
+    def _update_keywords(self, cursor, entries):
+        """
+        Replace the keyword index for a list of entries, which must have IDs.
+        """
+        # Delete old keywords.
+        ids = [(entry['id'],) for entry in entries]
+        cursor.executemany(f'DELETE FROM {self.schema}.file_keywords WHERE file_id = ?', ids)
+        cursor.executemany(f'DELETE FROM {self.schema}.file_search WHERE rowid = ?', ids)
+
+        keywords_to_add = []
+        search_rows = []
+        for entry in entries:
+            keywords = [keyword.lower() for keyword in self.get_keywords_for_entry(entry)]
+            for keyword in keywords:
+                keywords_to_add.append((entry['id'], keyword))
+            search_rows.append((entry['id'], ' '.join(keywords)))
+
+        cursor.executemany(f'''
+            INSERT INTO {self.schema}.file_keywords (file_id, keyword) values (?, ?)
+        ''', keywords_to_add)
+
+        cursor.executemany(f'''
+            INSERT INTO {self.schema}.file_search (rowid, keywords) values (?, ?)
+        ''', search_rows)
+
+    @classmethod
+    def _get_keyword_match(cls, words):
+        """
+        Return an FTS5 MATCH expression that prefix matches all of words.
+        """
+        # Quote each word, so it's treated as a string and not as query syntax.
+        terms = ['"%s"*' % word.replace('"', '""') for word in words]
+        return ' AND '.join(terms)
+
+    def _get_directory_ids(self, cursor, paths):
+        """
+        Return { path: id } of the directories table entry for each path in paths,
+        creating them and their parents if they don't exist.
+        """
+        paths = set(paths)
+        directory_ids = {}
+        path_list = list(paths)
+        for start in range(0, len(path_list), 500):
+            chunk = path_list[start:start+500]
+            query = f"""
+                SELECT id, path
+                FROM {self.schema}.directories
+                WHERE path IN ({', '.join('?'*len(chunk))})
+            """
+            for row in cursor.execute(query, chunk):
+                directory_ids[row['path']] = row['id']
+
+        missing = paths - directory_ids.keys()
+        if not missing:
+            return directory_ids
+
+        # Make sure the parents of missing directories exist first.  Parents which are also
+        # missing are created below.  This recurses once per missing directory level.
+        parents = { str(Path(path).parent) for path in missing } - missing
+        directory_ids.update(self._get_directory_ids(cursor, parents))
+
+        # Create missing directories, parents first.
+        for path in sorted(missing, key=lambda path: len(Path(path).parts)):
+            if path in directory_ids:
+                continue
+
+            parent = str(Path(path).parent)
+            parent_id = directory_ids.get(parent) if parent != path else None
+            cursor.execute(f'''
+                INSERT INTO {self.schema}.directories (path, parent_id) VALUES (?, ?)
+            ''', [path, parent_id])
+            directory_id = cursor.lastrowid
+            directory_ids[path] = directory_id
+
+            # The new directory is inside everything its parent is inside, and inside itself.
+            cursor.execute(f'''
+                INSERT INTO {self.schema}.directory_closure (ancestor_id, descendant_id, depth)
+                    SELECT ancestor_id, ?, depth + 1
+                    FROM {self.schema}.directory_closure
+                    WHERE descendant_id = ?
+                    UNION ALL
+                    SELECT ?, ?, 0
+            ''', [directory_id, parent_id, directory_id, directory_id])
+
+        return directory_ids
+
+    def _is_large_subtree(self, paths, *, conn=None):
+        """
+        Return true if paths contain at least half of the directories in the library.
+        """
+        with self.cursor(conn) as cursor:
+            total = cursor.execute(f'SELECT count(*) FROM {self.schema}.directories').fetchone()[0]
+            inside = self.get_directory_count(paths, conn=cursor.connection)
+            return inside * 2 >= total
+
+    def get_directory_count(self, paths, *, conn=None):
+        """
+        Return the number of indexed directories inside paths, including paths themselves.
+
+        This only counts directories containing indexed files or which have been refreshed,
+        so it's a lower bound on the number of directories on disk.
+        """
+        paths = [str(path) for path in paths]
+        with self.cursor(conn) as cursor:
+            return cursor.execute(f'''
+                SELECT count(*) FROM {self.schema}.directory_closure
+                WHERE ancestor_id IN (SELECT id FROM {self.schema}.directories WHERE path IN ({', '.join('?'*len(paths))}))
+            ''', paths).fetchone()[0]
+
+    def get_directory_journal(self, paths, *, conn=None):
+        """
+        Return the refresh journal for every directory inside paths, including paths
+        themselves.
+
+        The result is { path: { 'mtime', 'child_count', 'metadata_mtime', 'subdirectories' } },
+        where subdirectories is a list of the paths of directories inside it that are also
+        in the journal.  Directories that haven't been refreshed aren't included.
+        """
+        paths = [str(path) for path in paths]
+        journal = {}
+        parent_ids = {}
+        paths_by_id = {}
+        with self.cursor(conn) as cursor:
+            for row in cursor.execute(f'''
+                SELECT directories.id, directories.parent_id, directories.path,
+                    directories.mtime, directories.child_count, directories.metadata_mtime
+                FROM {self.schema}.directories AS directories
+                WHERE directories.id IN (
+                    SELECT descendant_id FROM {self.schema}.directory_closure
+                    WHERE ancestor_id IN (SELECT id FROM {self.schema}.directories WHERE path IN ({', '.join('?'*len(paths))}))
+                ) AND directories.mtime IS NOT NULL
+            ''', paths):
+                journal[row['path']] = {
+                    'mtime': row['mtime'],
+                    'child_count': row['child_count'],
+                    'metadata_mtime': row['metadata_mtime'],
+                    'subdirectories': [],
+                }
+                parent_ids[row['path']] = row['parent_id']
+                paths_by_id[row['id']] = row['path']
+
+        for path, parent_id in parent_ids.items():
+            parent = paths_by_id.get(parent_id)
+            if parent is not None:
+                journal[parent]['subdirectories'].append(path)
+
+        return journal
+
+    def set_directory_journal(self, records, *, conn=None, chunk_size=500):
+        """
+        Update the refresh journal.  records is a list of dictionaries with path, mtime,
+        child_count and metadata_mtime keys.  Directories are added to the directory
+        hierarchy if they aren't already there.
+        """
+        records = list(records)
+        for start in range(0, len(records), chunk_size):
+            chunk = records[start:start+chunk_size]
+            with self.cursor(conn, write=True) as cursor:
+                self._get_directory_ids(cursor, [record['path'] for record in chunk])
                 cursor.executemany(f'''
-                    INSERT INTO {self.schema}.bookmark_tags (file_id, tag) values (?, ?)
-                ''', tags_to_add)
+                    UPDATE {self.schema}.directories
+                    SET mtime = ?, child_count = ?, metadata_mtime = ?
+                    WHERE path = ?
+                ''', [(record['mtime'], record['child_count'], record['metadata_mtime'], record['path']) for record in chunk])
 
-        return entry
+    def get_listing_mtimes(self, paths, *, conn=None):
+        """
+        Return { path: mtime } for each directory in paths whose contents have all been
+        added to the index.  mtime is the directory's mtime when they were, so if it
+        hasn't changed, the directory can be listed from the index.  See set_listing_mtimes.
+        """
+        paths = [str(path) for path in paths]
+        if not paths:
+            return {}
+
+        with self.cursor(conn) as cursor:
+            return { row['path']: row['listing_mtime'] for row in cursor.execute(f'''
+                SELECT path, listing_mtime
+                FROM {self.schema}.directories
+                WHERE path IN ({', '.join('?'*len(paths))}) AND listing_mtime IS NOT NULL
+            ''', paths) }
+
+    def set_listing_mtimes(self, mtimes, *, conn=None):
+        """
+        Record that everything inside each directory in mtimes, a dictionary of { path: mtime },
+        has been added to the index while the directory had the given mtime.
+        """
+        with self.cursor(conn, write=True) as cursor:
+            self._get_directory_ids(cursor, [str(path) for path in mtimes.keys()])
+            cursor.executemany(f'''
+                UPDATE {self.schema}.directories
+                SET listing_mtime = ?
+                WHERE path = ?
+            ''', [(mtime, str(path)) for path, mtime in mtimes.items()])
+
+    def get_listing_cache(self, path, key, *, conn=None, touch_interval=60):
+        """
+        Return (mtime, data) for a result cached with set_listing_cache, or None if there
+        isn't one.  The caller should check that mtime matches the directory.
+
+        The entry's last used time is only updated if it's older than touch_interval seconds,
+        so cache hits usually don't need a write connection.
+        """
+        with self.cursor(conn) as cursor:
+            row = cursor.execute(f'''
+                SELECT mtime, data, last_used_at FROM {self.schema}.listing_cache
+                WHERE path = ? AND key = ?
+            ''', [str(path), key]).fetchone()
+            if row is None:
+                return None
+
+        now = time.time()
+        if now - row['last_used_at'] >= touch_interval:
+            with self.cursor(conn, write=True) as cursor:
+                cursor.execute(f'''
+                    UPDATE {self.schema}.listing_cache SET last_used_at = ?
+                    WHERE path = ? AND key = ?
+                ''', [now, str(path), key])
+
+        return row['mtime'], json.loads(zlib.decompress(row['data']))
+
+    def set_listing_cache(self, path, key, mtime, data, *, max_entries=100, conn=None):
+        """
+        Cache data computed from the directory at path, when its mtime was mtime.  data
+        can be anything that can be stored as JSON.
+
+        If there are more than max_entries, the least recently used ones are removed.
+        """
+        with self.cursor(conn, write=True) as cursor:
+            cursor.execute(f'''
+                INSERT OR REPLACE INTO {self.schema}.listing_cache (path, key, mtime, data, last_used_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [str(path), key, mtime, zlib.compress(json.dumps(data).encode('utf-8')), time.time()])
+
+            cursor.execute(f'''
+                DELETE FROM {self.schema}.listing_cache
+                WHERE rowid IN (
+                    SELECT rowid FROM {self.schema}.listing_cache
+                    ORDER BY last_used_at DESC
+                    LIMIT -1 OFFSET ?
+                )
+            ''', [max_entries])
+
+    def get_metadata_files(self, paths, *, conn=None):
+        """
+        Return { path: (mtime, size) } for registered metadata files inside paths.
+        """
+        params = []
+        where = []
+        for path in paths:
+            start, end = self._get_subtree_range(path)
+            where.append('(path > ? AND path < ?)')
+            params.extend([start, end])
+
+        if not where:
+            return {}
+
+        with self.cursor(conn) as cursor:
+            return { row['path']: (row['mtime'], row['size']) for row in cursor.execute(f'''
+                SELECT path, mtime, size FROM {self.schema}.metadata_files
+                WHERE {' OR '.join(where)}
+            ''', params) }
+
+    def set_metadata_files(self, records, *, conn=None):
+        """
+        Register metadata files.  records is a list of dictionaries with path, mtime and
+        size keys, with the metadata file's mtime and size when it was read.
+        """
+        with self.cursor(conn, write=True) as cursor:
+            cursor.executemany(f'''
+                INSERT OR REPLACE INTO {self.schema}.metadata_files (path, mtime, size)
+                VALUES (?, ?, ?)
+            ''', [(str(record['path']), record['mtime'], record['size']) for record in records])
+
+    def delete_metadata_files(self, paths, *, conn=None):
+        """
+        Remove metadata files from the registry.
+        """
+        with self.cursor(conn, write=True) as cursor:
+            cursor.executemany(f'''
+                DELETE FROM {self.schema}.metadata_files WHERE path = ?
+            ''', [(str(path),) for path in paths])
+
+    @classmethod
+    def _get_subtree_range(cls, path):
+        """
+        Return (start, end), where paths inside path are start < path < end.
+
+        Paths are compared as strings, so this is every path beginning with path and a
+        separator.
+        """
+        path = str(path)
+        sep = '\\' if '\\' in path else '/'
+        if not path.endswith(sep):
+            path += sep
+
+        return path, path[:-1] + chr(ord(sep) + 1)
+
+    def _get_subtree_query(self, placeholder='?'):
+        """
+        Return an SQL subquery for the IDs of all directories inside placeholder, including
+        itself.
+        """
+        return f'''
+            SELECT descendant_id FROM {self.schema}.directory_closure
+            WHERE ancestor_id = (SELECT id FROM {self.schema}.directories WHERE path = {placeholder})
+        '''
 
     def delete_recursively(self, paths, *, conn=None):
         """
@@ -300,16 +887,35 @@ class FileIndex(Database):
         If this includes directories, all entries for files inside the directory
         will be removed recursively.
         """
-        with self.cursor(conn) as cursor:
-            # If path includes "/path", we need to delete "/path" and files matching
-            # "/path/%", but not "/path%".
-            path_list = [(str(path), self.escape_like(str(path)) + os.path.sep + '%') for path in paths]
+        with self.cursor(conn, write=True) as cursor:
+            # If path includes "/path", we need to delete "/path" and files in any directory
+            # inside it.
+            path_list = [(str(path),) for path in paths]
             count = cursor.connection.total_changes
+
+            # Remove the files from the keyword search index first, since it isn't cleared
+            # by the foreign key cascade like the other tables.
+            cursor.executemany(f'''
+                DELETE FROM {self.schema}.file_search
+                WHERE rowid IN (
+                    SELECT id FROM {self.schema}.files
+                    WHERE
+                        files.path = ?1 OR
+                        files.directory_id IN ({self._get_subtree_query('?1')})
+                )
+            ''', path_list)
+
             cursor.executemany(f'''
                 DELETE FROM {self.schema}.files
                 WHERE
-                    files.path = ? OR
-                    files.path LIKE ? ESCAPE "$"
+                    files.path = ?1 OR
+                    files.directory_id IN ({self._get_subtree_query('?1')})
+            ''', path_list)
+
+            # Remove the directories.  This also removes them from directory_closure.
+            cursor.executemany(f'''
+                DELETE FROM {self.schema}.directories
+                WHERE id IN ({self._get_subtree_query('?1')})
             ''', path_list)
 
             deleted = cursor.connection.total_changes - count
@@ -321,7 +927,7 @@ class FileIndex(Database):
 
         This is done when we detect a filesystem rename.
         """
-        with self.cursor(conn) as cursor:
+        with self.cursor(conn, write=True) as cursor:
             # Update "path" and "parent" for old_path and all files inside it.
             log.info('Renaming "%s" -> "%s"' % (old_path, new_path))
             old_path = Path(old_path)
@@ -329,45 +935,203 @@ class FileIndex(Database):
 
             if old_path == new_path:
                 return
-                
-            # Make sure the old path doesn't exist.  We could use UPDATE OR REPLACE
+
+            # Make sure the new path doesn't exist.  We could use UPDATE OR REPLACE
             # below, but that would only remove conflicting files.  If the new path
             # exists in the database, the entire directory is stale and should be
             # removed.
-            self.delete_recursively([new_path], conn=conn)
-            
-            for entry in self.search(paths=[str(old_path)], conn=conn):
-                # path should always be relative to old_path: this is a path inside
-                # the path we searched for.
-                path = Path(entry['path'])
-                relative_path = path.relative_to(old_path)
-                entry_new_path = new_path / relative_path
-
-                # parent should always be inside old_path, unless this is old_path itself.
-                if path != old_path:
-                    relative_parent = Path(entry['parent']).relative_to(old_path)
-                    entry_new_parent = new_path / relative_parent
-                else:
-                    entry_new_parent = entry['parent']
-
-                entry_new_path_lowercase = str(new_path).lower()
-                basename_if_directory_lowercase = new_path.basename.lower() if new_path.is_dir() else None
-
-                query = f'''
-                    UPDATE OR REPLACE {self.schema}.files
-                        SET path = ?, parent = ?, path_lowercase = ?, basename_if_directory_lowercase = ?
-                        WHERE id = ?
-                ''' % {
-                    'path': '',
-                    'parent': '',
-                }
-                cursor.execute(query, [
-                    str(entry_new_path),              # path
-                    str(entry_new_parent),            # parent
-                    str(entry_new_path_lowercase),    # path_lowercase
-                    str(basename_if_directory_lowercase), # basename_if_directory_lowercase
-                    entry['id'],                      # WHERE id
-                ])
+            #
+            # If this is only changing the case of the filename, the destination is the
+            # source, so don't delete it.
+            if str(old_path).lower() != str(new_path).lower():
+                self.delete_recursively([new_path], conn=cursor.connection)
+
+            old_prefix, old_prefix_end = self._get_subtree_range(old_path)
+            new_prefix = self._get_subtree_range(new_path)[0]
+            old_prefix_lowercase = old_prefix.lower()
+            new_prefix_lowercase = new_prefix.lower()
+
+            # Rewrite the prefix of everything inside old_path in one pass.  Files inside
+            # old_path are the range of paths beginning with old_path and a separator (see
+            # _get_subtree_range).  Search the range rather than with LIKE, so this uses the
+            # path index.  Note that substr is 1-based.
+            #
+            # path and parent are sliced by the length of the original prefix.  path_lowercase
+            # begins with the lowercased prefix, which isn't always the same length, since
+            # lowercasing some characters like 'İ' adds a combining character, so it's sliced
+            # by the length of that instead.
+            cursor.execute(f'''
+                UPDATE {self.schema}.files
+                SET
+                    path = :new_prefix || substr(path, :prefix_length + 1),
+                    parent = :new_path || substr(parent, :path_length + 1),
+                    path_lowercase = :new_prefix_lowercase || substr(path_lowercase, :prefix_length_lowercase + 1)
+                WHERE
+                    path >= :old_prefix AND path < :old_prefix_end
+            ''', {
+                'old_prefix': old_prefix,
+                'old_prefix_end': old_prefix_end,
+                'new_path': str(new_path),
+                'new_prefix': new_prefix,
+                'path_length': len(str(old_path)),
+                'prefix_length': len(old_prefix),
+                'new_prefix_lowercase': new_prefix_lowercase,
+                'prefix_length_lowercase': len(old_prefix_lowercase),
+            })
+
+            # Rename old_path itself.  Its parent and its basename may both have changed.
+            new_parent_id = self._get_directory_ids(cursor, [str(new_path.parent)])[str(new_path.parent)]
+            directory_sort_fields = self.get_natural_sort_fields(new_path, is_directory=True)
+            file_sort_fields = self.get_natural_sort_fields(new_path, is_directory=False)
+            cursor.execute(f'''
+                UPDATE {self.schema}.files
+                SET
+                    path = :new_path,
+                    parent = :new_parent,
+                    directory_id = :new_parent_id,
+                    path_lowercase = :new_path_lowercase,
+                    basename_if_directory_lowercase = CASE WHEN is_directory THEN :new_basename_lowercase ELSE NULL END,
+                    natural_sort_key = CASE WHEN is_directory THEN :directory_sort_key ELSE :file_sort_key END,
+                    natural_sort_key_pages_reversed = CASE WHEN is_directory THEN :directory_sort_key_pages_reversed ELSE :file_sort_key_pages_reversed END
+                WHERE
+                    path = :old_path
+            ''', {
+                'old_path': str(old_path),
+                'new_path': str(new_path),
+                'new_parent': str(new_path.parent),
+                'new_parent_id': new_parent_id,
+                'new_path_lowercase': str(new_path).lower(),
+                'new_basename_lowercase': new_path.name.lower(),
+                'directory_sort_key': directory_sort_fields['natural_sort_key'],
+                'directory_sort_key_pages_reversed': directory_sort_fields['natural_sort_key_pages_reversed'],
+                'file_sort_key': file_sort_fields['natural_sort_key'],
+                'file_sort_key_pages_reversed': file_sort_fields['natural_sort_key_pages_reversed'],
+            })
+
+            # Move old_path's directory entry, if it has one.  Files keep their directory IDs,
+            # so only the directories need to change.
+            directory = cursor.execute(f'SELECT id FROM {self.schema}.directories WHERE path = ?', [str(old_path)]).fetchone()
+            if directory is not None:
+                directory_id = directory['id']
+                cursor.execute(f'''
+                    UPDATE {self.schema}.directories
+                    SET path = :new_prefix || substr(path, :prefix_length + 1)
+                    WHERE path >= :old_prefix AND path < :old_prefix_end
+                ''', {
+                    'old_prefix': old_prefix,
+                    'old_prefix_end': old_prefix_end,
+                    'new_prefix': new_prefix,
+                    'prefix_length': len(old_prefix),
+                })
+                cursor.execute(f'''
+                    UPDATE {self.schema}.directories
+                    SET path = ?, parent_id = ?
+                    WHERE id = ?
+                ''', [str(new_path), new_parent_id, directory_id])
+
+                # Detach the subtree from its old ancestors, and attach it to its new ones.
+                cursor.execute(f'''
+                    DELETE FROM {self.schema}.directory_closure
+                    WHERE
+                        descendant_id IN (SELECT descendant_id FROM {self.schema}.directory_closure WHERE ancestor_id = :id) AND
+                        ancestor_id NOT IN (SELECT descendant_id FROM {self.schema}.directory_closure WHERE ancestor_id = :id)
+                ''', { 'id': directory_id })
+                cursor.execute(f'''
+                    INSERT INTO {self.schema}.directory_closure (ancestor_id, descendant_id, depth)
+                        SELECT above.ancestor_id, below.descendant_id, above.depth + below.depth + 1
+                        FROM {self.schema}.directory_closure AS above, {self.schema}.directory_closure AS below
+                        WHERE above.descendant_id = :parent_id AND below.ancestor_id = :id
+                ''', { 'id': directory_id, 'parent_id': new_parent_id })
+
+            # The keywords include the filename, so old_path's keywords need to be updated.
+            # Files inside it keep their filenames and don't need to be updated.
+            entry = cursor.execute(f'''
+                SELECT id, {', '.join(self.keyword_fields)}
+                FROM {self.schema}.files
+                WHERE path = ?
+            ''', [str(new_path)]).fetchone()
+            if entry is not None:
+                self._update_keywords(cursor, [dict(entry)])
+
+    def get_multi(self, paths, *, conn=None, chunk_size=500):
+        """
+        Return a dictionary of { path: entry } for each path in paths which exists in the
+        database.
+        """
+        results = {}
+        paths = [str(path) for path in paths]
+        with self.cursor(conn) as cursor:
+            for start in range(0, len(paths), chunk_size):
+                chunk = paths[start:start+chunk_size]
+                query = f"""
+                    SELECT *
+                    FROM {self.schema}.files
+                    WHERE path IN ({', '.join('?'*len(chunk))})
+                    """
+                for row in cursor.execute(query, chunk):
+                    results[row['path']] = dict(row)
+
+        return results
+
+    def get_children(self, paths, *, conn=None):
+        """
+        Return a dictionary of { path: entry } for each entry directly inside paths.
+
+        This reads a directory's entries with a single query, so they can be compared
+        against a directory listing without querying each file separately.
+        """
+        paths = [str(path) for path in paths]
+        if not paths:
+            return {}
+
+        results = {}
+        with self.cursor(conn) as cursor:
+            query = f"""
+                SELECT *
+                FROM {self.schema}.files
+                WHERE parent IN ({', '.join('?'*len(paths))})
+                """
+            for row in cursor.execute(query, paths):
+                results[row['path']] = dict(row)
+
+        return results
+
+    def get_unpopulated(self, *, paths=None, after_id=0, limit=100, conn=None):
+        """
+        Return up to limit unpopulated entries with IDs greater than after_id, in ID order.
+
+        If paths is set, only return entries inside those paths, recursively.
+        """
+        where = ['NOT files.populated', 'files.id > ?']
+        params = [after_id]
+        if paths:
+            paths = [str(path) for path in paths]
+            placeholders = ', '.join('?'*len(paths))
+            where.append(f'''(
+                files.path IN ({placeholders}) OR
+                files.directory_id IN (
+                    SELECT descendant_id FROM {self.schema}.directory_closure
+                    WHERE ancestor_id IN (SELECT id FROM {self.schema}.directories WHERE path IN ({placeholders}))
+                )
+            )''')
+            params.extend(paths)
+            params.extend(paths)
+
+        params.append(limit)
+        with self.cursor(conn) as cursor:
+            query = f'''
+                SELECT files.*
+                FROM {self.schema}.files AS files
+                WHERE {' AND '.join(where)}
+                ORDER BY files.id
+                LIMIT ?
+            '''
+            return [dict(row) for row in cursor.execute(query, params)]
+
+    def get_populate_checkpoint(self, *, conn=None):
+        return self._get_info(conn=conn)['populate_checkpoint']
+    def set_populate_checkpoint(self, file_id, *, conn=None):
+        return self._set_info('populate_checkpoint', file_id, conn=conn)
 
     def get(self, path, *, conn=None):
         """
@@ -393,6 +1157,8 @@ class FileIndex(Database):
         # SearchMode.Exact: Return path.
         mode=SearchMode.Recursive,
 
+        # Only match files with a keyword beginning with each word in substr.  If no order
+        # is given, results are ordered by relevance.
         substr=None,
 
         # "images" or "videos":
@@ -415,6 +1181,13 @@ class FileIndex(Database):
         # An SQL ORDER BY statement to order results.  See library.sort_orders.
         order=None,
 
+        # If set, this is a (keys, values) tuple to only return results that sort after a
+        # previous result.  keys is a list of (expression, 'ASC' or 'DESC') matching order,
+        # and values are those expressions for the previous result (see get_sort_key_values).
+        # This allows continuing a search from where it left off without scanning the results
+        # before it.
+        after=None,
+
         # By default, all filters must match for us to return a file.  If available_fields
         # is set, it's a list of keys in the entry which are available, and only search
         # filters whose required fields are present will be used.  For example, if
@@ -431,6 +1204,9 @@ class FileIndex(Database):
 
         include_files=True, include_dirs=True,
         debug=False,
+
+        # If true, yield the query plan instead of results.
+        explain=False,
         conn=None
     ):
         # If available_fields was supplied, disable searches that require unavailable
@@ -458,13 +1234,34 @@ class FileIndex(Database):
             params.extend(source_params)
             schema = ''
 
-        if paths:
+        if paths and mode == self.SearchMode.Recursive and source is None:
+            # Match the paths themselves, and anything in a directory inside them.  This is
+            # an index lookup no matter how many paths we have.
+            #
+            # If we're sorting and the paths contain most of the library, such as when searching
+            # a whole mount, it's much faster to read the sort index in order and filter it than
+            # to look up every file and then sort them all.  SQLite can't tell how much of the
+            # library the paths contain, so check, and prevent it from using the path indexes
+            # with unary + if it's large.
+            placeholders = ', '.join('?'*len(paths))
+            no_index = '+' if order and self._is_large_subtree(paths, conn=conn) else ''
+            where.append(f'''(
+                {no_index}{schema}files.path IN ({placeholders}) OR
+                {no_index}{schema}files.directory_id IN (
+                    SELECT descendant_id FROM {schema}directory_closure
+                    WHERE ancestor_id IN (SELECT id FROM {schema}directories WHERE path IN ({placeholders}))
+                )
+            )''')
+            params.extend(paths)
+            params.extend(paths)
+        elif paths:
             path_conds = []
             for path in paths:
                 if mode == self.SearchMode.Recursive:
-                    # paths are top directories to start searching from.  This is done with a
-                    # prefix match against the path: listing "C:\ABCD" recursively matches "C:\ABCD\*".
-                    # Directories don't end in a slash, so Include the directory itself explicitly.
+                    # paths are top directories to start searching from.  The source doesn't
+                    # have the directory hierarchy, so do this with a prefix match against the
+                    # path: listing "C:\ABCD" recursively matches "C:\ABCD\*".  Directories don't
+                    # end in a slash, so Include the directory itself explicitly.
                     path_conds.append(f'({schema}files.path LIKE ? ESCAPE "$" OR {schema}files.path = ?)')
                     params.append(self.escape_like(path) + os.path.sep + '%')
                     params.append(path)
@@ -495,26 +1292,35 @@ class FileIndex(Database):
             elif media_type == 'images':
                 where.append(f'{schema}mime_type LIKE "image/%"')
 
+        # Search total pixels and aspect ratio with their indexed generated columns.  A source
+        # won't have these, so use the expressions they're generated from.
+        if source is None:
+            total_pixels_expr = f'{schema}files.total_pixels'
+            aspect_ratio_expr = f'{schema}files.computed_aspect_ratio'
+        else:
+            total_pixels_expr = f'{schema}width*{schema}height'
+            aspect_ratio_expr = f'1.0 * {schema}width/{schema}height'
+
         if total_pixels is not None:
             # Minimum total pixels:
             if total_pixels[0] is not None:
-                where.append(f'{schema}width*{schema}height >= ?')
+                where.append(f'{total_pixels_expr} >= ?')
                 params.append(total_pixels[0])
 
             # Maximum total pixels:
             if total_pixels[1] is not None:
-                where.append(f'{schema}width*{schema}height <= ?')
+                where.append(f'{total_pixels_expr} <= ?')
                 params.append(total_pixels[1])
 
         if aspect_ratio is not None:
             # Minimum aspect ratio:
             if aspect_ratio[0] is not None:
-                where.append(f'1.0 * {schema}width/{schema}height >= ?')
+                where.append(f'{aspect_ratio_expr} >= ?')
                 params.append(aspect_ratio[0])
 
             # Maximum aspect ratio:
             if aspect_ratio[1] is not None:
-                where.append(f'1.0 * {schema}width/{schema}height <= ?')
+                where.append(f'{aspect_ratio_expr} <= ?')
                 params.append(aspect_ratio[1])
 
         if bookmarked is not None:
@@ -540,7 +1346,18 @@ class FileIndex(Database):
                         params.append(tag)
                     where.append('(' + ' OR '.join(tag_match) + ')')
         
-        if substr:
+        keyword_search = False
+        if substr and source is None:
+            # Search keywords with the full-text index.  This matches files where each word is
+            # a prefix of one of its keywords.
+            words = self.split_keywords(substr)
+            if words:
+                keyword_search = True
+                joins.append(f'''JOIN {schema}file_search AS file_search ON file_search.rowid = files.id''')
+                where.append('file_search MATCH ?')
+                params.append(self._get_keyword_match(words))
+        elif substr:
+            # The source doesn't have the full-text index, so search file_keywords directly.
             for word_idx, word in enumerate(self.split_keywords(substr)):
                 # Each keyword match requires a separate join.
                 alias = 'keyword%i' % word_idx
@@ -550,8 +1367,14 @@ class FileIndex(Database):
                 where.append('%s.keyword GLOB ?' % alias)
                 params.append(word.lower() + '*')
 
+        if after is not None:
+            keys, values = after
+            where.append(self._get_seek_condition(keys, values, params))
+
         if order is None:
-            order = ''
+            # If we're searching keywords and no order was requested, return the best
+            # matches first.
+            order = 'ORDER BY file_search.rank' if keyword_search else ''
 
         where = ('WHERE\n' + ' AND\n'.join(where)) if where else ''
         joins = ('\n'.join(joins)) if joins else ''
@@ -572,6 +1395,9 @@ class FileIndex(Database):
                     result = dict(row)
                     log.debug('plan:', result)
 
+            if explain:
+                query = 'EXPLAIN QUERY PLAN ' + query
+
             for row in cursor.execute(query, params):
                 result = dict(row)
                 try:
@@ -581,6 +1407,77 @@ class FileIndex(Database):
                     # the transaction.
                     return
 
+    @classmethod
+    def _get_seek_condition(cls, keys, values, params):
+        """
+        Return a WHERE condition matching rows that sort after values, adding its
+        parameters to params.
+
+        keys is a list of (expression, 'ASC' or 'DESC'), and values is the value of
+        each expression for the row to start after.
+        """
+        assert len(keys) == len(values)
+        directions = set(direction for _, direction in keys)
+
+        # If every key sorts in the same direction and there are no nulls, we can use a row
+        # value comparison, which SQLite can turn into an index range.
+        if len(directions) == 1 and None not in values:
+            params.extend(values)
+            comparison = '>' if directions == {'ASC'} else '<'
+            placeholders = ', '.join('?' * len(values))
+            return f"(({', '.join(expr for expr, _ in keys)}) {comparison} ({placeholders}))"
+
+        # Otherwise, expand the comparison:
+        #
+        # (a, b) after (x, y) = a after x OR (a IS x AND b after y)
+        #
+        # SQLite sorts null before everything else, so "after null" means "not null" in
+        # ascending order, and never matches in descending order.
+        terms = []
+        for idx, ((expr, direction), value) in enumerate(zip(keys, values)):
+            conds = []
+            for prev_expr, _ in keys[:idx]:
+                conds.append(f'{prev_expr} IS ?')
+            params.extend(values[:idx])
+
+            if direction == 'ASC':
+                if value is None:
+                    conds.append(f'{expr} IS NOT NULL')
+                else:
+                    conds.append(f'{expr} > ?')
+                    params.append(value)
+            else:
+                if value is None:
+                    conds.append('0')
+                else:
+                    conds.append(f'({expr} < ? OR {expr} IS NULL)')
+                    params.append(value)
+
+            terms.append('(' + ' AND '.join(conds) + ')')
+
+        return '(' + ' OR '.join(terms) + ')'
+
+    def get_sort_key_values(self, fields, keys, *, conn=None):
+        """
+        Return the values of the ORDER BY expressions in keys for an entry with the given
+        fields.  This is used to create the after parameter to search().
+
+        Field names aren't escaped and must be trusted.
+        """
+        params = []
+        builder = WithBuilder(*fields.keys(), table_name='files')
+        builder.add_row(*fields.values())
+        builder.get_params(params)
+
+        query = f"""
+            WITH {builder.get()}
+            SELECT {', '.join(expr for expr, _ in keys)}
+            FROM files
+        """
+        with self.cursor(conn) as cursor:
+            row = cursor.execute(query, params).fetchone()
+            return list(row)
+
     def entry_matches_search(self, entry, conn=None, incomplete=False, **search_options):
         """
         Return true if the given entry matches the search options.  The entry doesn't
@@ -589,6 +1486,17 @@ class FileIndex(Database):
         If incomplete is true and entry is unpopulated, do as much filtering as possible
         with the data available.  If a search filter can't be performed because entry
         doesn't have the data yet, we'll assume it matches.
+
+        If you're checking a lot of entries against the same search, use compile_search
+        instead.
+        """
+        return self.compile_search(incomplete=incomplete, **search_options)(entry)
+
+    def _entry_matches_search_sql(self, entry, conn=None, incomplete=False, **search_options):
+        """
+        The same as entry_matches_search, but by running the search in SQLite against
+        just this entry.  This is slow, and is used to check that compile_search matches
+        search().
         """
         # Create a WITH statement with the same schema as the "files" and "file_keywords"
         # table, containing just this record.
@@ -636,6 +1544,146 @@ class FileIndex(Database):
 
         return False
 
+    @classmethod
+    def _sql_number(cls, value):
+        """
+        Return value converted to a number the way SQLite does for arithmetic, or None
+        if value is null.
+        """
+        if value is None or isinstance(value, (int, float)):
+            return value
+
+        # SQLite uses the longest numeric prefix of strings, or 0 if there isn't one.
+        match = _sql_numeric_prefix.match(str(value))
+        if match is None:
+            return 0
+
+        number = float(match[0])
+        return int(number) if number.is_integer() and not any(c in match[0] for c in '.eE') else number
+
+    @classmethod
+    def _sql_bool(cls, value):
+        """
+        Return the result of value as an SQL condition: True, False, or None for null.
+        """
+        value = cls._sql_number(value)
+        return None if value is None else value != 0
+
+    def compile_search(self, *,
+        substr=None,
+        media_type=None,
+        bookmarked=None,
+        bookmark_tags=None,
+        total_pixels=None,
+        aspect_ratio=None,
+        include_files=True, include_dirs=True,
+        available_fields=None,
+
+        # If true, available_fields is each entry's non-null fields, like entry_matches_search.
+        incomplete=False,
+    ):
+        """
+        Return a function that takes an entry and returns true if search() with these
+        options would return it.  This runs in Python, so checking an entry is much faster
+        than running the search in SQLite.
+
+        The entry doesn't need to be in the database.  Bookmark tag searches use the tags in
+        entry['bookmark_tags'].
+        """
+        # Each filter is (required_fields, func).  func receives the entry and returns
+        # whether it matches.  Filters are skipped if available_fields doesn't include
+        # all of required_fields.
+        filters = []
+
+        if not include_files:
+            filters.append(((), lambda entry: self._sql_bool(entry.get('is_directory')) is True))
+        if not include_dirs:
+            filters.append(((), lambda entry: self._sql_bool(entry.get('is_directory')) is False))
+
+        if media_type is not None:
+            assert media_type in ('videos', 'images')
+
+            def mime_type_starts_with(entry, prefix):
+                mime_type = entry.get('mime_type')
+                return mime_type is not None and str(mime_type).startswith(prefix)
+
+            if media_type == 'videos':
+                # Include animation, so searching for videos includes animated GIFs.
+                filters.append((('animation',), lambda entry:
+                    mime_type_starts_with(entry, 'video/') or self._sql_bool(entry.get('animation')) is True))
+            elif media_type == 'images':
+                filters.append(((), lambda entry: mime_type_starts_with(entry, 'image/')))
+
+        def in_range(value, value_range):
+            # Comparisons with null are false, but a range with no limits matches anything.
+            if value_range[0] is not None and (value is None or not value >= value_range[0]):
+                return False
+            if value_range[1] is not None and (value is None or not value <= value_range[1]):
+                return False
+            return True
+
+        if total_pixels is not None:
+            def get_total_pixels(entry):
+                width = self._sql_number(entry.get('width'))
+                height = self._sql_number(entry.get('height'))
+                return None if width is None or height is None else width * height
+
+            filters.append((('width', 'height'), lambda entry: in_range(get_total_pixels(entry), total_pixels)))
+
+        if aspect_ratio is not None:
+            def get_aspect_ratio(entry):
+                width = self._sql_number(entry.get('width'))
+                height = self._sql_number(entry.get('height'))
+
+                # Division by zero is null in SQLite.
+                if width is None or height is None or height == 0:
+                    return None
+                return 1.0 * width / height
+
+            filters.append((('width', 'height'), lambda entry: in_range(get_aspect_ratio(entry), aspect_ratio)))
+
+        if bookmarked is not None:
+            filters.append(((), lambda entry: self._sql_bool(entry.get('bookmarked')) is bool(bookmarked)))
+
+            if bookmark_tags is not None:
+                if bookmark_tags == '':
+                    # Untagged bookmarks.
+                    filters.append(((), lambda entry: entry.get('bookmark_tags') == '' and self._sql_bool(entry.get('bookmarked')) is True))
+                else:
+                    # Tags are only indexed for bookmarked files, so tags on a file that isn't
+                    # bookmarked never match.
+                    tags = set(bookmark_tags.split(' '))
+                    def has_tag(entry):
+                        if not self._sql_bool(entry.get('bookmarked')):
+                            return False
+
+                        entry_tags = (entry.get('bookmark_tags') or '').split(' ')
+                        return any(tag in tags for tag in entry_tags if tag)
+                    filters.append(((), has_tag))
+
+        if substr:
+            words = self.split_keywords(substr)
+            if words:
+                def matches_keywords(entry):
+                    keywords = self.get_keywords_for_entry(entry)
+                    return all(any(keyword.startswith(word) for keyword in keywords) for word in words)
+                filters.append(((), matches_keywords))
+
+        def matches(entry):
+            if incomplete:
+                available = { field for field, value in entry.items() if value is not None }
+            else:
+                available = available_fields
+
+            for required_fields, func in filters:
+                if available is not None and not all(field in available for field in required_fields):
+                    continue
+                if not func(entry):
+                    return False
+            return True
+
+        return matches
+
     def get_all_bookmark_tags(self, *, conn=None):
         """
         Return a list of all bookmark tags.
@@ -697,6 +1745,7 @@ async def test():
         'author': '',
         'directory_thumbnail_path': None,
         'bookmarked': False,
+        'bookmark_tags': '',
     }
     
     def path_record(path):
@@ -750,6 +1799,375 @@ async def test():
     assert Path(new_entry['path']) == Path('f:/test')
     assert Path(new_entry['parent']) == Path('f:/')
 
+    # Rename a directory whose name changes length when lowercased.  A sibling whose name
+    # begins with the same characters isn't inside it and shouldn't be renamed.
+    unicode_root = Path('f:/İmages')
+    for unicode_path in (unicode_root, unicode_root / 'Sub', unicode_root / 'Sub' / 'File', Path('f:/İmages2')):
+        db.add_record(path_record(unicode_path) | { 'path_lowercase': str(unicode_path).lower() })
+    db.rename(str(unicode_root), str(Path('f:/Renamed')))
+    renamed_entry = db.get(str(Path('f:/Renamed/Sub/File')))
+    assert renamed_entry['path_lowercase'] == str(Path('f:/renamed/sub/file')), renamed_entry
+    assert renamed_entry['parent'] == str(Path('f:/Renamed/Sub')), renamed_entry
+    assert db.get(str(Path('f:/İmages2')))['path_lowercase'] == str(Path('f:/İmages2')).lower()
+    db.delete_recursively([str(Path('f:/Renamed')), str(Path('f:/İmages2'))])
+
+    # Rename paths that use a different separator than os.path.sep.  Nested directories
+    # should move along with their files.
+    windows_paths = ['x:\\old', 'x:\\old\\a', 'x:\\old\\a\\b', 'x:\\old\\a\\b\\file']
+    for windows_path in windows_paths:
+        db.add_record(test_entry | { 'path': windows_path, 'parent': windows_path.rsplit('\\', 1)[0] })
+    db.rename('x:\\old', 'x:\\new')
+    with db.cursor() as cursor:
+        directories = { row['path'] for row in cursor.execute('SELECT path FROM directories WHERE path LIKE "x:%"') }
+    assert directories == { 'x:', 'x:\\new', 'x:\\new\\a', 'x:\\new\\a\\b' }, directories
+    assert db.get('x:\\new\\a\\b\\file') is not None
+    # Path doesn't understand backslashes on other platforms, so the directory hierarchy
+    # for these is flat there.  Delete each path explicitly.
+    db.delete_recursively(['x:'] + [path.replace('old', 'new') for path in windows_paths])
+
+    # Test keyword searches.  Renaming f:/foo should have updated its filename keywords.
+    def search_paths(substr):
+        return { Path(entry['path']) for entry in db.search(substr=substr) }
+
+    assert search_paths('tes') == { Path('f:/test') }
+    assert search_paths('foo') == set()
+
+    # All words must match, as prefixes of any keyword.
+    keyword_entry = path_record(Path('f:/test/image'))
+    keyword_entry.update({ 'title': 'Some Title', 'tags': 'tag1 tag2' })
+    db.add_record(keyword_entry)
+    assert search_paths('image tit') == { Path('f:/test/image') }
+    assert search_paths('image titles') == set()
+    assert search_paths('"tag') == { Path('f:/test/image') }
+
+    # Editing the entry updates its keywords.
+    keyword_entry['title'] = 'Other'
+    db.add_record(keyword_entry)
+    assert search_paths('title') == set()
+    assert search_paths('other') == { Path('f:/test/image') }
+
+    # Deleting the entry removes it from the keyword index.
+    db.delete_recursively([str(Path('f:/test'))])
+    assert search_paths('other') == set()
+    assert search_paths('unrelated') == { path3 }
+    with db.cursor() as cursor:
+        search_ids = [row['rowid'] for row in cursor.execute('SELECT rowid FROM files.file_search')]
+        assert search_ids == [db.get(str(path3))['id']], search_ids
+
+    # Test adding records in bulk, mixing new and existing records.  Use a small chunk size
+    # so we test records spanning chunks.
+    existing_entry = db.get(str(path3))
+    bulk_entries = [path_record(Path('f:/bulk') / ('file%i' % idx)) for idx in range(10)]
+    bulk_entries[3].update({ 'bookmarked': True, 'bookmark_tags': 'tag1 tag2' })
+    bulk_entries.append(path_record(path3) | { 'title': 'Renamed' })
+    db.add_records(bulk_entries, chunk_size=4)
+    assert bulk_entries[-1]['id'] == existing_entry['id']
+    for entry in bulk_entries:
+        assert db.get(entry['path'])['id'] == entry['id']
+    assert db.get(str(path3))['title'] == 'Renamed'
+    assert search_paths('file3') == { Path('f:/bulk/file3') }
+    assert search_paths('renamed') == { path3 }
+    assert db.get_all_bookmark_tags() == { 'tag1': 1, 'tag2': 1, '': 0 }
+
+    # Test updating tags in bulk.
+    bulk_entries[3]['bookmark_tags'] = 'tag2'
+    db.add_records(bulk_entries)
+    assert db.get_all_bookmark_tags() == { 'tag2': 1, '': 0 }
+
+    # Test continuing searches with after.  Mix directories and files, so we test
+    # seeking past null basename_if_directory_lowercase values.
+    seek_entries = []
+    for idx in range(10):
+        path = Path('f:/seek') / ('File%i' % idx)
+        is_directory = idx < 4
+        seek_entries.append(path_record(path) | {
+            'is_directory': is_directory,
+            'path_lowercase': str(path).lower(),
+            'basename_if_directory_lowercase': path.name.lower() if is_directory else None,
+            'ctime': idx // 3,
+        })
+    db.add_records(seek_entries)
+
+    def paginate(keys):
+        order = 'ORDER BY ' + ', '.join('%s %s' % key for key in keys)
+        fields = ('basename_if_directory_lowercase', 'path_lowercase', 'ctime')
+        results = []
+        after = None
+        while True:
+            page = list(itertools.islice(db.search(paths=[str(Path('f:/seek'))], order=order, after=after), 2))
+            if not page:
+                return results
+            results.extend(entry['path'] for entry in page)
+            values = db.get_sort_key_values({ field: page[-1][field] for field in fields }, keys)
+            after = (keys, values)
+
+    for keys in (
+        [('basename_if_directory_lowercase', 'DESC'), ('path_lowercase', 'ASC')],
+        [('basename_if_directory_lowercase', 'ASC'), ('path_lowercase', 'DESC')],
+        [('round(ctime - 0.5)', 'ASC'), ('path_lowercase', 'ASC')],
+        [('round(ctime - 0.5)', 'DESC'), ('path_lowercase', 'DESC')],
+    ):
+        order = 'ORDER BY ' + ', '.join('%s %s' % key for key in keys)
+        expected = [entry['path'] for entry in db.search(paths=[str(Path('f:/seek'))], order=order)]
+        assert len(expected) == 10
+        assert paginate(keys) == expected, keys
+
+    # Test renaming a tree with nested directories and files inside a ZIP.  f:/tree2 shares
+    # a prefix with f:/tree, and shouldn't be affected.
+    def tree_record(path, is_directory=True):
+        return path_record(path) | {
+            'is_directory': is_directory,
+            'path_lowercase': str(path).lower(),
+            'basename_if_directory_lowercase': path.name.lower() if is_directory else None,
+        }
+
+    tree = Path('f:/tree')
+    tree_files = {
+        Path(''): True,
+        Path('sub'): True,
+        Path('sub/deeper'): True,
+        Path('sub/deeper/image.jpg'): False,
+        Path('archive.zip'): True,
+        Path('archive.zip/inner'): True,
+        Path('archive.zip/inner/page.jpg'): False,
+    }
+    db.add_records([tree_record(tree / path, is_directory) for path, is_directory in tree_files.items()])
+    db.add_record(tree_record(Path('f:/tree2/file.jpg'), False))
+    tree_ids = { path: db.get(str(tree / path))['id'] for path in tree_files }
+
+    def check_tree(root, root_name):
+        for path, is_directory in tree_files.items():
+            entry = db.get(str(root / path))
+            assert entry is not None, path
+            assert entry['id'] == tree_ids[path]
+            assert entry['path_lowercase'] == str(root / path).lower()
+            if path != Path(''):
+                assert Path(entry['parent']) == root / path.parent
+                assert entry['basename_if_directory_lowercase'] == (path.name.lower() if is_directory else None)
+        root_entry = db.get(str(root))
+        assert Path(root_entry['parent']) == root.parent
+        assert root_entry['basename_if_directory_lowercase'] == root_name
+
+    db.rename(str(tree), str(Path('f:/moved/Tree')))
+    check_tree(Path('f:/moved/Tree'), 'tree')
+    for path in tree_files:
+        assert db.get(str(tree / path)) is None, path
+    assert db.get(str(Path('f:/tree2/file.jpg'))) is not None
+    assert search_paths('tree') == { Path('f:/moved/Tree') }
+
+    # Test renaming onto an existing directory.  The old contents of the destination are
+    # replaced, including files that don't exist in the source.
+    dest = Path('f:/dest')
+    db.add_records([tree_record(dest), tree_record(dest / 'sub'), tree_record(dest / 'stale.jpg', False)])
+    db.rename(str(Path('f:/moved/Tree')), str(dest))
+    check_tree(dest, 'dest')
+    assert db.get(str(dest / 'stale.jpg')) is None
+    assert search_paths('stale') == set()
+    assert search_paths('dest') == { dest }
+
+    # Changing only the case of a directory shouldn't delete it as a collision.
+    db.rename(str(dest), str(Path('f:/Dest')))
+    check_tree(Path('f:/Dest'), 'dest')
+
+    # Recursive searches use the directory hierarchy, which should have followed the renames.
+    def search_tree(*roots):
+        return { Path(entry['path']) for entry in db.search(paths=[str(root) for root in roots]) }
+
+    moved = Path('f:/Dest')
+    assert search_tree(moved) == { moved / path for path in tree_files }
+    assert search_tree(moved / 'sub', Path('f:/tree2')) == {
+        moved / 'sub', moved / 'sub/deeper', moved / 'sub/deeper/image.jpg', Path('f:/tree2/file.jpg'),
+    }
+    assert search_tree(tree) == set()
+    assert search_tree(Path('f:/moved')) == set()
+
+    # get_children only returns entries directly inside the paths.
+    assert set(db.get_children([str(moved / 'sub'), str(Path('f:/tree2'))])) == {
+        str(moved / 'sub/deeper'), str(Path('f:/tree2/file.jpg')),
+    }
+    assert db.get_children([]) == {}
+
+    # Natural sorts match sorting filenames naturally, and follow renames.
+    natural = Path('f:/natural')
+    def natural_record(path, is_directory=False):
+        return tree_record(path, is_directory) | FileIndex.get_natural_sort_fields(str(path), is_directory=is_directory)
+
+    def natural_names(order):
+        return [Path(entry['path']).name for entry in db.search(paths=[str(natural)], mode=FileIndex.SearchMode.Subdir, order=order)]
+
+    db.add_records([natural_record(natural, True)] + [
+        natural_record(natural / name, name == 'zdir')
+        for name in ('Image 10 #2.jpg', 'image 2 #1.jpg', 'Image 10 #1.jpg', 'zdir')
+    ])
+    assert natural_names('ORDER BY natural_sort_key, path_lowercase') == ['zdir', 'image 2 #1.jpg', 'Image 10 #1.jpg', 'Image 10 #2.jpg']
+    assert natural_names('ORDER BY natural_sort_key_pages_reversed DESC, path_lowercase DESC') == ['Image 10 #1.jpg', 'Image 10 #2.jpg', 'image 2 #1.jpg', 'zdir']
+    db.rename(str(natural / 'image 2 #1.jpg'), str(natural / 'image 20 #1.jpg'))
+    assert natural_names('ORDER BY natural_sort_key, path_lowercase') == ['zdir', 'Image 10 #1.jpg', 'Image 10 #2.jpg', 'image 20 #1.jpg']
+
+    # With replace=False, existing entries aren't changed.
+    entry = natural_record(natural / 'zdir', True) | { 'title': 'changed' }
+    db.add_records([entry], replace=False)
+    assert entry['id'] == db.get(entry['path'])['id']
+    assert db.get(entry['path'])['title'] != 'changed'
+
+    assert db.get_listing_mtimes([str(natural)]) == {}
+    db.set_listing_mtimes({ str(natural): 1234.5 })
+    assert db.get_listing_mtimes([str(natural), str(natural / 'zdir')]) == { str(natural): 1234.5 }
+    db.delete_recursively([str(natural)])
+
+    # Listing cache entries are replaced, and the least recently used ones are removed.
+    assert db.get_listing_cache('f:/cached', 'key') is None
+    db.set_listing_cache('f:/cached', 'key', 10, ['a', 'b'])
+    db.set_listing_cache('f:/cached', 'key', 20, ['c'])
+    assert db.get_listing_cache('f:/cached', 'key') == (20, ['c'])
+    db.set_listing_cache('f:/cached', 'other', 30, [], max_entries=1)
+    assert db.get_listing_cache('f:/cached', 'key') is None
+    assert db.get_listing_cache('f:/cached', 'other') == (30, [])
+
+    # Reading an entry only updates its last used time once it's old enough.
+    def get_last_used_at():
+        with db.cursor() as cursor:
+            return cursor.execute('SELECT last_used_at FROM listing_cache WHERE key = ?', ['other']).fetchone()[0]
+    with db.cursor(write=True) as cursor:
+        cursor.execute('UPDATE listing_cache SET last_used_at = 1000 WHERE key = ?', ['other'])
+    db.get_listing_cache('f:/cached', 'other', touch_interval=1e12)
+    assert get_last_used_at() == 1000
+    db.get_listing_cache('f:/cached', 'other')
+    assert get_last_used_at() > 1000
+
+    # Each directory should be inside exactly its parents.
+    with db.cursor() as cursor:
+        directories = { row['id']: row['path'] for row in cursor.execute('SELECT id, path FROM directories') }
+        for directory_id, path in directories.items():
+            ancestors = { directories[row['ancestor_id']] for row in cursor.execute(
+                'SELECT ancestor_id FROM directory_closure WHERE descendant_id = ?', [directory_id]) }
+            assert ancestors == { path } | { str(parent) for parent in Path(path).parents }, path
+
+    db.delete_recursively([moved])
+    assert search_tree(moved) == set()
+    with db.cursor() as cursor:
+        assert cursor.execute('SELECT * FROM directories WHERE path = ?', [str(moved / 'sub')]).fetchone() is None
+
+    # Read connections are query_only, so writing requires write=True.
+    with db.cursor() as cursor:
+        try:
+            cursor.execute('DELETE FROM files')
+            assert False, 'Read connection allowed a write'
+        except sqlite3.OperationalError:
+            pass
+
+    # Searches keep their read connection while they're parked between pages.  As many as
+    # the /api/list cache can hold mustn't use up the read pool.
+    parked = [db.search(paths=[str(Path('f:/'))]) for _ in range(30)]
+    for search in parked:
+        next(search)
+    with db.cursor() as cursor:
+        cursor.execute('SELECT 1')
+    for search in parked:
+        search.close()
+
+    stats = db.get_pool_stats()
+    assert stats['read']['in_use'] == 0 and stats['write']['in_use'] == 0, stats
+    assert stats['write']['acquired'] > 0, stats
+
+    # Compare compile_search against running the same search in SQLite, with random entries
+    # and searches.  Entries are added to the database so bookmark tag searches can see their
+    # tags, and some fields are then cleared to test incomplete entries and nulls.
+    rand = random.Random(1)
+    random_entries = []
+    for idx in range(40):
+        random_entries.append(tree_record(Path('f:/random') / rand.choice(['image', 'Some Video', 'pic', 'a_b']) / str(idx), rand.random() < 0.2) | {
+            'width': rand.choice([None, 0, 1, 100, 1000, 'a', '50']),
+            'height': rand.choice([None, 0, 1, 100, 1000]),
+            'mime_type': rand.choice(['image/jpeg', 'image/gif', 'video/mp4', 'application/folder', '']),
+            'animation': rand.choice([False, True]),
+            'bookmarked': rand.choice([False, True]),
+            'bookmark_tags': rand.choice(['', 'tag1', 'tag2', 'tag1 tag3']),
+            'title': rand.choice(['', 'Some Title', 'image']),
+        })
+    db.add_records(random_entries)
+
+    def random_range():
+        return rand.choice([[None, None], [0, None], [None, 100], [50, 5000], [0.5, 2], [1, 1]])
+
+    for _ in range(300):
+        options = {}
+        if rand.random() < 0.3: options['substr'] = rand.choice(['im', 'some vid', 'tit', 'xyz', 'a b', '   '])
+        if rand.random() < 0.3: options['media_type'] = rand.choice(['images', 'videos'])
+        if rand.random() < 0.3: options['bookmarked'] = rand.choice([False, True])
+        if rand.random() < 0.3: options['bookmark_tags'] = rand.choice(['', 'tag1', 'tag2 tag3', 'missing'])
+        if rand.random() < 0.3: options['total_pixels'] = random_range()
+        if rand.random() < 0.3: options['aspect_ratio'] = random_range()
+        if rand.random() < 0.2: options['include_files'] = False
+        if rand.random() < 0.2: options['include_dirs'] = False
+
+        entry = db.get(rand.choice(random_entries)['path'])
+        for field in ('width', 'height', 'animation', 'mime_type', 'bookmarked', 'is_directory'):
+            if rand.random() < 0.2:
+                entry[field] = None
+
+        incomplete = rand.random() < 0.5
+        expected = db._entry_matches_search_sql(entry, incomplete=incomplete, **options)
+        assert db.entry_matches_search(entry, incomplete=incomplete, **options) == expected, (entry, options, incomplete)
+
+    # Searching the database with the generated columns should match the same entries.
+    for _ in range(20):
+        options = { 'total_pixels': random_range(), 'aspect_ratio': random_range() }
+        matches = db.compile_search(**options)
+        expected = { entry['path'] for entry in random_entries if matches(db.get(entry['path'])) }
+        assert { entry['path'] for entry in db.search(paths=[str(Path('f:/random'))], **options) } == expected, options
+
+    # Every sort order should be read from an index, both with no paths and when searching
+    # a path containing the whole library.
+    from . import benchmark
+    benchmark.check_sort_order_plans(db)
+    benchmark.check_sort_order_plans(db, paths=[str(Path('f:/'))])
+
+    # The keyword index should have exactly one row per file.
+    with db.cursor() as cursor:
+        file_ids = { row['id'] for row in cursor.execute('SELECT id FROM files') }
+        search_ids = [row['rowid'] for row in cursor.execute('SELECT rowid FROM file_search')]
+        assert sorted(search_ids) == sorted(file_ids)
+
+    # Test the refresh journal.  Directories are added to the hierarchy as needed, and
+    # subdirectories are listed under their parents.
+    journal_root = Path('f:/journal')
+    db.set_directory_journal([
+        { 'path': str(journal_root / 'sub' / 'deep'), 'mtime': 3, 'child_count': 0, 'metadata_mtime': None },
+        { 'path': str(journal_root / 'sub'), 'mtime': 2, 'child_count': 1, 'metadata_mtime': 5 },
+        { 'path': str(journal_root), 'mtime': 1, 'child_count': 1, 'metadata_mtime': None },
+    ])
+    journal = db.get_directory_journal([str(journal_root)])
+    assert journal.keys() == { str(journal_root), str(journal_root / 'sub'), str(journal_root / 'sub' / 'deep') }, journal
+    assert journal[str(journal_root)]['subdirectories'] == [str(journal_root / 'sub')], journal
+    assert journal[str(journal_root / 'sub')]['metadata_mtime'] == 5, journal
+
+    # Renaming a directory moves its journal with it.
+    db.rename(str(journal_root / 'sub'), str(journal_root / 'renamed'))
+    journal = db.get_directory_journal([str(journal_root)])
+    assert journal[str(journal_root)]['subdirectories'] == [str(journal_root / 'renamed')], journal
+    assert journal[str(journal_root / 'renamed' / 'deep')]['mtime'] == 3, journal
+
+    # Test the metadata file registry.  Only files inside the requested paths are returned,
+    # not files in directories that begin with the same name.
+    metadata_root = Path('f:/metadata')
+    db.set_metadata_files([
+        { 'path': metadata_root / 'a' / '.vview.txt', 'mtime': 1, 'size': 10 },
+        { 'path': metadata_root / 'a' / 'b' / '.vview.txt', 'mtime': 2, 'size': 20 },
+        { 'path': Path('f:/metadata2') / '.vview.txt', 'mtime': 3, 'size': 30 },
+    ])
+    registry = db.get_metadata_files([str(metadata_root)])
+    assert registry == {
+        str(metadata_root / 'a' / '.vview.txt'): (1, 10),
+        str(metadata_root / 'a' / 'b' / '.vview.txt'): (2, 20),
+    }, registry
+    assert db.get_metadata_files([str(metadata_root / 'a' / 'b')]).keys() == { str(metadata_root / 'a' / 'b' / '.vview.txt') }
+
+    db.set_metadata_files([{ 'path': metadata_root / 'a' / '.vview.txt', 'mtime': 4, 'size': 40 }])
+    db.delete_metadata_files([metadata_root / 'a' / 'b' / '.vview.txt'])
+    registry = db.get_metadata_files([str(metadata_root)])
+    assert registry == { str(metadata_root / 'a' / '.vview.txt'): (4, 40) }, registry
+
 #    entry['comment'] = 'foo'
 #    db.add_record(entry)
 #
@@ -0,0 +1,372 @@
+# The filename index holds the names of files and directories inside the library, so we
+# can search by filename without Windows Search.
+#
+# This is separate from FileIndex, which holds entries for files we've actually looked at.
+# This holds every directory, media file and metadata file in the library, but only what
+# we can learn from listing the directory, so it can be built quickly by crawling.  Its
+# columns use the same names as FileIndex for the fields sort orders use, so the index
+# sorts in library.sort_orders work on both.
+#
+# Directories are only relisted when their mtime changes.  See FilenameIndexProvider.
+import asyncio, logging, os, sqlite3, time
+from pathlib import Path, PurePath
+from .database import Database, transaction
+from .file_index import FileIndex
+from ..util import misc
+
+log = logging.getLogger(__name__)
+
+class FilenameIndex(Database):
+    def __init__(self, db_path, *, schema='filenames', **kwargs):
+        super().__init__(db_path, schema=schema, **kwargs)
+
+    def open_db(self):
+        conn = super().open_db()
+
+        # Use the fastest sync mode.  This data is only a cache, so we don't care
+        # that much if it loses data during a power loss.
+        conn.execute(f'PRAGMA {self.schema}.synchronous = OFF;')
+
+        # Do first-time initialization and any migrations.
+        self.upgrade(conn=conn)
+
+        return conn
+
+    def upgrade(self, *, conn):
+        """
+        Create and apply migrations to the filename database.
+        """
+        with conn:
+            # If there's no info table, start by just creating it at version 0, so _get_info
+            # and _set_info work.
+            if 'info' not in self.get_tables(conn):
+                with transaction(conn):
+                    conn.execute(f'''
+                        CREATE TABLE {self.schema}.info(
+                            id INTEGER PRIMARY KEY,
+                            version
+                        )
+                    ''')
+                    conn.execute(f'INSERT INTO {self.schema}.info (id, version) values (1, ?)', (0,))
+
+            if self.get_db_version(conn=conn) == 0:
+                with transaction(conn):
+                    self.set_db_version(1, conn=conn)
+
+                    conn.execute(f'''
+                        CREATE TABLE {self.schema}.names(
+                            id INTEGER PRIMARY KEY,
+                            path UNIQUE NOT NULL,
+                            parent NOT NULL,
+                            name_lowercase NOT NULL,
+                            is_directory NOT NULL,
+
+                            -- The MIME type, or null for metadata files.
+                            mime_type,
+                            ctime NOT NULL,
+
+                            -- These match the FileIndex fields of the same name, for sorting.
+                            path_lowercase NOT NULL,
+                            basename_if_directory_lowercase,
+                            natural_sort_key NOT NULL,
+                            natural_sort_key_pages_reversed NOT NULL
+                        )
+                    ''')
+                    conn.execute(f'CREATE INDEX {self.schema}.names_parent on names(parent)')
+                    conn.execute(f'CREATE INDEX {self.schema}.names_name_lowercase on names(name_lowercase)')
+
+                    # Directories whose children are in names, and their mtime when they were listed.
+                    # mtime is null if it was too recent to trust, so the directory is listed again
+                    # next time.
+                    conn.execute(f'''
+                        CREATE TABLE {self.schema}.directories(
+                            path PRIMARY KEY NOT NULL,
+                            mtime
+                        )
+                    ''')
+
+        assert self.get_db_version(conn=conn) == 1
+
+    @classmethod
+    def get_record(cls, path, *, is_directory, ctime, mime_type):
+        """
+        Return a record for set_listings.
+
+        mime_type is None for files that should only be found by searching for their filename,
+        like metadata files.
+        """
+        path = os.fspath(path)
+        name = os.path.basename(path)
+
+        return {
+            'path': path,
+            'parent': os.path.dirname(path),
+            'name_lowercase': name.lower(),
+            'is_directory': is_directory,
+            'mime_type': mime_type,
+            'ctime': ctime,
+            'path_lowercase': path.lower(),
+            'basename_if_directory_lowercase': name.lower() if is_directory else None,
+            **FileIndex.get_natural_sort_fields(path, is_directory=is_directory),
+        }
+
+    def get_directory_mtimes(self, paths, *, recursive=True, conn=None):
+        """
+        Return { path: mtime } for each directory in paths whose children are indexed.  If
+        recursive is true, include directories inside paths.
+        """
+        params = []
+        where = []
+        for path in paths:
+            if recursive:
+                start, end = FileIndex._get_subtree_range(path)
+                where.append('path = ? OR (path > ? AND path < ?)')
+                params.extend([str(path), start, end])
+            else:
+                where.append('path = ?')
+                params.append(str(path))
+
+        if not where:
+            return {}
+
+        with self.cursor(conn) as cursor:
+            return { row['path']: row['mtime'] for row in cursor.execute(f'''
+                SELECT path, mtime FROM {self.schema}.directories
+                WHERE {' OR '.join(where)}
+            ''', params) }
+
+    def get_indexed_directories(self, paths, *, conn=None):
+        """
+        Return the directories in paths whose children are indexed.
+        """
+        paths = [str(path) for path in paths]
+        if not paths:
+            return set()
+
+        with self.cursor(conn) as cursor:
+            return { row['path'] for row in cursor.execute(f'''
+                SELECT path FROM {self.schema}.directories
+                WHERE path IN ({', '.join('?'*len(paths))})
+            ''', paths) }
+
+    def get_subdirectories(self, path, *, conn=None):
+        """
+        Return the paths of indexed directories directly inside path.
+        """
+        with self.cursor(conn) as cursor:
+            return [row['path'] for row in cursor.execute(f'''
+                SELECT path FROM {self.schema}.names
+                WHERE parent = ? AND is_directory
+            ''', [str(path)])]
+
+    def set_listings(self, listings, *, conn=None):
+        """
+        Replace the children of directories.
+
+        listings is a list of (path, mtime, records), where records are from get_record.
+        Children of path that aren't in records are removed, along with everything inside
+        them if they're directories.
+        """
+        with self.cursor(conn, write=True) as cursor:
+            for path, mtime, records in listings:
+                path = str(path)
+                new_paths = { record['path'] for record in records }
+
+                # Remove children that no longer exist.
+                removed = [
+                    (row['path'], row['is_directory'])
+                    for row in cursor.execute(f'SELECT path, is_directory FROM {self.schema}.names WHERE parent = ?', [path])
+                    if row['path'] not in new_paths
+                ]
+                self._delete(cursor, removed)
+
+                cursor.executemany(f'''
+                    INSERT OR REPLACE INTO {self.schema}.names
+                    (path, parent, name_lowercase, is_directory, mime_type, ctime, path_lowercase,
+                     basename_if_directory_lowercase, natural_sort_key, natural_sort_key_pages_reversed)
+                    VALUES (:path, :parent, :name_lowercase, :is_directory, :mime_type, :ctime, :path_lowercase,
+                     :basename_if_directory_lowercase, :natural_sort_key, :natural_sort_key_pages_reversed)
+                ''', records)
+
+                cursor.execute(f'''
+                    INSERT OR REPLACE INTO {self.schema}.directories (path, mtime) VALUES (?, ?)
+                ''', [path, mtime])
+
+    def delete(self, paths, *, conn=None):
+        """
+        Remove paths from the index, along with everything inside them.
+        """
+        with self.cursor(conn, write=True) as cursor:
+            self._delete(cursor, [(str(path), True) for path in paths])
+
+    def _delete(self, cursor, paths):
+        """
+        Remove a list of (path, is_directory).
+        """
+        for path, is_directory in paths:
+            cursor.execute(f'DELETE FROM {self.schema}.names WHERE path = ?', [path])
+            cursor.execute(f'DELETE FROM {self.schema}.directories WHERE path = ?', [path])
+            if not is_directory:
+                continue
+
+            start, end = FileIndex._get_subtree_range(path)
+            cursor.execute(f'DELETE FROM {self.schema}.names WHERE path > ? AND path < ?', [start, end])
+            cursor.execute(f'DELETE FROM {self.schema}.directories WHERE path > ? AND path < ?', [start, end])
+
+    def search(self, *,
+        paths=None,
+
+        # If set, return only the file with this exact path.
+        exact_path=None,
+
+        # Filter for files with this exact basename, ignoring case.
+        filename=None,
+
+        # Only match files whose name contains each word in substr, ignoring case.
+        substr=None,
+
+        recurse=True,
+
+        # "images" or "videos".
+        media_type=None,
+
+        # An SQL ORDER BY statement to order results.  See library.sort_orders.
+        order=None,
+
+        include_files=True,
+        include_dirs=True,
+
+        # If set, stop the search after this many seconds by raising TimeoutError.
+        timeout=None,
+
+        conn=None,
+    ):
+        """
+        Yield records matching a search.
+        """
+        assert paths or exact_path
+
+        where = []
+        params = []
+
+        if paths:
+            parts = []
+            for path in paths:
+                if recurse:
+                    start, end = FileIndex._get_subtree_range(path)
+                    parts.append('(names.path > ? AND names.path < ?)')
+                    params.extend([start, end])
+                else:
+                    parts.append('names.parent = ?')
+                    params.append(str(path))
+            where.append(f"({ ' OR '.join(parts) })")
+
+        if exact_path is not None:
+            where.append('names.path = ?')
+            params.append(str(exact_path))
+
+        if filename is not None:
+            where.append('names.name_lowercase = ?')
+            params.append(str(filename).lower())
+        else:
+            # Metadata files are only returned when searching for them by name.
+            where.append('names.mime_type IS NOT NULL')
+
+        if substr is not None:
+            for word in substr.split(' '):
+                if word:
+                    where.append('instr(names.name_lowercase, ?) > 0')
+                    params.append(word.lower())
+
+        if not include_files:
+            where.append('names.is_directory')
+        if not include_dirs:
+            where.append('NOT names.is_directory')
+
+        if media_type == 'images':
+            where.append("names.mime_type LIKE 'image/%'")
+        elif media_type == 'videos':
+            # Include GIFs when searching for videos, like Windows search.  We don't know if
+            # they're animated, so the caller needs to finish filtering them.
+            where.append("(names.mime_type LIKE 'video/%' OR names.mime_type = 'image/gif')")
+
+        query = f'''
+            SELECT names.*
+            FROM {self.schema}.names AS names
+            WHERE {' AND '.join(where)}
+            {order or ''}
+        '''
+
+        with self.cursor(conn) as cursor:
+            # SQLite can't time out queries itself, so use a progress handler to interrupt
+            # the query if it takes too long.  This also interrupts sorting, which happens
+            # before the first result is returned.
+            if timeout:
+                deadline = time.monotonic() + timeout
+                cursor.connection.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+
+            try:
+                for row in cursor.execute(query, params):
+                    try:
+                        yield dict(row)
+                    except GeneratorExit:
+                        # GeneratorExit is normal.  Return rather than raising it to commit
+                        # the transaction.
+                        return
+            except sqlite3.OperationalError as e:
+                if timeout and time.monotonic() > deadline:
+                    raise TimeoutError('The search timed out') from e
+                raise
+            finally:
+                if timeout:
+                    cursor.connection.set_progress_handler(None, 0)
+
+async def test():
+    path = Path('test.sqlite')
+    if path.exists():
+        path.unlink()
+
+    db = FilenameIndex(path)
+
+    def record(path, is_directory=False):
+        mime_type = 'application/folder' if is_directory else misc.mime_type(path)
+        return FilenameIndex.get_record(PurePath(path), is_directory=is_directory, ctime=0, mime_type=mime_type)
+
+    def search(**kwargs):
+        return [PurePath(row['path']).as_posix() for row in db.search(order='ORDER BY path ASC', **kwargs)]
+
+    db.set_listings([
+        ('/root', 1, [record('/root/dir', True), record('/root/image.jpg'), record('/root/.vview.txt')]),
+        ('/root/dir', 2, [record('/root/dir/sub', True), record('/root/dir/video.mp4'), record('/root/dir/IMAGE2.png')]),
+        ('/root/dir/sub', 3, [record('/root/dir/sub/animation.gif')]),
+        ('/root2', 4, [record('/root2/image.jpg')]),
+    ])
+
+    # Files without a MIME type, like metadata files, are only found by name.
+    assert search(paths=['/root']) == ['/root/dir', '/root/dir/IMAGE2.png', '/root/dir/sub', '/root/dir/sub/animation.gif', '/root/dir/video.mp4', '/root/image.jpg']
+    assert search(paths=['/root'], filename='.vview.txt') == ['/root/.vview.txt']
+    assert search(paths=['/root', '/root2'], recurse=False) == ['/root/dir', '/root/image.jpg', '/root2/image.jpg']
+    assert search(paths=['/root'], substr='image 2') == ['/root/dir/IMAGE2.png']
+    assert search(paths=['/root'], media_type='videos') == ['/root/dir/sub/animation.gif', '/root/dir/video.mp4']
+    assert search(paths=['/root'], include_files=False) == ['/root/dir', '/root/dir/sub']
+    assert search(paths=['/root'], include_dirs=False, media_type='images') == ['/root/dir/IMAGE2.png', '/root/dir/sub/animation.gif', '/root/image.jpg']
+    assert search(exact_path='/root/dir/video.mp4') == ['/root/dir/video.mp4']
+
+    # Paths that share a prefix with the search path aren't inside it.
+    assert search(paths=['/root'], substr='image', include_dirs=False) == ['/root/dir/IMAGE2.png', '/root/image.jpg']
+
+    assert { PurePath(path).as_posix(): mtime for path, mtime in db.get_directory_mtimes(['/root/dir']).items() } == { '/root/dir': 2, '/root/dir/sub': 3 }
+    assert [PurePath(path).as_posix() for path in db.get_subdirectories('/root/dir')] == ['/root/dir/sub']
+    assert { PurePath(path).as_posix(): mtime for path, mtime in db.get_directory_mtimes(['/root/dir'], recursive=False).items() } == { '/root/dir': 2 }
+    assert db.get_indexed_directories(['/root', '/other']) == { '/root' }
+
+    # Relisting a directory removes children that are gone, and everything inside them.
+    db.set_listings([('/root', 5, [record('/root/image.jpg')])])
+    assert search(paths=['/root']) == ['/root/image.jpg']
+    assert db.get_directory_mtimes(['/root/dir']) == {}
+
+    db.delete(['/root2'])
+    assert search(paths=['/root2']) == []
+
+if __name__ == '__main__':
+    asyncio.run(test())
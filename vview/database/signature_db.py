@@ -29,8 +29,8 @@ log = logging.getLogger(__name__)
 # This implements the database storage for library.  It stores similar data to
 # what we get from the Windows index.
 class SignatureDB(Database):
-    def __init__(self, db_path, *, schema='signatures'):
-        super().__init__(db_path, schema=schema)
+    def __init__(self, db_path, *, schema='signatures', **kwargs):
+        super().__init__(db_path, schema=schema, **kwargs)
         self.image_index = image_index.ImageIndex()
 
     def open_db(self):
@@ -4,8 +4,9 @@ from pprint import pprint
 from collections import defaultdict
 from pathlib import PurePosixPath
 from urllib import request
-from ..util import misc, inpainting, windows_search, image_index
+from ..util import misc, inpainting, image_index
 from ..util.paths import open_path
+from . import search_providers
 from PIL import Image
 
 log = logging.getLogger(__name__)
@@ -236,6 +237,78 @@ async def api_bookmark_delete(info):
 
     return { 'success': True }
 
+@reg('/bookmark/batch')
+async def api_bookmark_batch(info):
+    """
+    Edit bookmarks for a list of media IDs at once.
+
+    "ids" is a list of media IDs, and "operations" is a list of operations to apply to
+    each of them in order:
+
+    - { "action": "add", "tags": [...] }: bookmark the file if needed and add tags
+    - { "action": "remove", "tags": [...] }: remove tags from the bookmark
+    - { "action": "set", "tags": [...] }: bookmark the file with exactly these tags
+    - { "action": "delete" }: remove the bookmark
+
+    This is much faster than calling bookmark/add for each file, since each directory's
+    metadata is only written once and files aren't read again.  "results" has a result
+    for each ID in the same order, with the bookmark if it succeeded and the error if it
+    didn't.
+    """
+    media_ids = info.data.get('ids', [])
+    if not isinstance(media_ids, list):
+        raise misc.Error('invalid-request', 'ids must be a list')
+
+    # Operations apply to every ID, so if any of them are invalid, fail the whole request.
+    if not isinstance(info.data.get('operations', []), list):
+        raise misc.Error('invalid-request', 'operations must be a list')
+
+    operations = []
+    for operation in info.data.get('operations', []):
+        if not isinstance(operation, dict):
+            raise misc.Error('invalid-request', 'Invalid bookmark operation')
+
+        tags = operation.get('tags', [])
+        if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+            raise misc.Error('invalid-request', 'Bookmark tags must be a list of strings')
+        operations.append((operation.get('action'), tags))
+
+    # Look up the paths, remembering errors for IDs we can't use.  IDs can be listed more
+    # than once, so results are stored by index.
+    results = [None] * len(media_ids)
+    paths = {}
+    for idx, media_id in enumerate(media_ids):
+        try:
+            if not isinstance(media_id, str):
+                raise misc.Error('invalid-request', 'Invalid media ID: %s' % media_id)
+
+            parts = media_id.split(':', 1)
+            if len(parts) < 2:
+                raise misc.Error('invalid-request', 'Invalid media ID: %s' % media_id)
+
+            absolute_path = info.manager.resolve_path(parts[1])
+            info.manager.check_path(absolute_path, info.request, throw=True)
+            paths[idx] = absolute_path
+        except misc.Error as e:
+            results[idx] = e.data()
+
+    entries = await asyncio.to_thread(info.manager.library.bookmark_batch, list(paths.values()), operations)
+    for idx, path in paths.items():
+        entry = entries.get(os.fspath(path))
+        if entry is None:
+            results[idx] = misc.Error('not-found', 'File not in library').data()
+        elif isinstance(entry, misc.Error):
+            results[idx] = entry.data()
+        elif isinstance(entry, Exception):
+            results[idx] = { 'success': False, 'code': 'internal-error', 'reason': str(entry) }
+        else:
+            results[idx] = { 'success': True, 'bookmark': _bookmark_data(entry, info.user) }
+
+    return {
+        'success': True,
+        'results': [{ 'id': media_id, **result } for media_id, result in zip(media_ids, results)],
+    }
+
 @reg('/bookmark/tags', allow_guest=True)
 async def api_bookmark_tags(info):
     """
@@ -326,7 +399,10 @@ async def api_similar_search(info):
     async def do_index():
         if path is not None:
             # Read all paths first, so the search doesn't time out while we're processing files.
-            paths = [result.path for result in windows_search.search(paths=[str(absolute_path)], timeout=30)]
+            search_provider = info.manager.library.search_provider
+            await search_provider.refresh([absolute_path])
+            paths = [result.path for result in search_provider.search(paths=[str(absolute_path)], timeout=30)
+                if result is not search_providers.SearchTimeout]
         else:
             paths = info.manager.library.get_all_bookmark_paths()
 
@@ -553,7 +629,17 @@ async def api_list(info):
 
     If "search" is provided, a recursive filename search will be performed.
     This requires Windows indexing.
+
+    If "cursor" is provided, this continues from the "cursor" returned with a previous
+    page.  Unlike "page", this doesn't keep any search state on the server, so it never
+    expires.  Pass a cursor of null to start a new search in this mode.
+
+    Otherwise, the next page is read in the background after each page is returned, so
+    it's ready when it's requested.  Set "prefetch" to false to disable this.
     """
+    if 'cursor' in info.data:
+        return await _api_list_from_cursor(info)
+
     # page is the UUID of the page we want to load.  skip is the offset from the beginning
     # of the search of the page, which is only used if we can't load page.  It can't be used
     # to seek from page.
@@ -575,6 +661,7 @@ async def api_list(info):
         offset = cache.next_offset
         skip = 0
         result_generator = cache.result
+        prefetch = cache.prefetch
     else:
         # We don't have a previous search, so start a new one.  Create a UUID for
         # this page.
@@ -585,6 +672,7 @@ async def api_list(info):
 
         # Start the request.
         result_generator = api_list_impl(info)
+        prefetch = None
 
     # When we're just reading the next page of results from a continued search,
     # skip is 0 and we'll just load a single page.  We'll only loop here if we're
@@ -599,7 +687,22 @@ async def api_list(info):
                 # This shouldn't happen in the middle of an API call that's using it.
                 assert False
 
-        next_results = await asyncio.to_thread(run)
+        # If this page was prefetched, wait for it to finish instead.
+        if prefetch is not None:
+            next_results = await prefetch.get()
+            prefetch = None
+
+            # If the search was evicted from the cache while we were waiting, its generator
+            # was closed.  Start over, as if the page had expired.
+            if next_results is None:
+                this_page_uuid = str(uuid.uuid4())
+                prev_page_uuid = None
+                offset = 0
+                skip = int(info.data.get('skip', 0))
+                result_generator = api_list_impl(info)
+                continue
+        else:
+            next_results = await asyncio.to_thread(run)
 
         # Store this page's IDs.
         next_results['pages'] = {
@@ -639,15 +742,79 @@ async def api_list(info):
         if skip < 0 or next_results['pages']['next'] is None:
             break
 
+    # Start reading the next page, so it's ready when the client asks for it.
+    if next_results['pages']['next'] is not None and info.data.get('prefetch', True):
+        info.manager.prefetch_api_list_result(next_results['pages']['next'], user=info.user.username)
+
     return next_results
 
+async def _api_list_from_cursor(info):
+    """
+    Return a page of /list results starting at info.data['cursor'].
+    """
+    cursor = info.data['cursor']
+    if cursor is not None:
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(cursor))
+        except (TypeError, ValueError):
+            raise misc.Error('invalid-request', 'Invalid cursor')
+
+        if not _is_valid_list_cursor(cursor):
+            raise misc.Error('invalid-request', 'Invalid cursor')
+
+    # We only need one page, so don't run searches in the background, and close the
+    # generator when we're done so nothing is left running.
+    result_generator = api_list_impl(info, cursor=cursor)
+    def run():
+        try:
+            return next(result_generator)
+        finally:
+            result_generator.close()
+
+    return await asyncio.to_thread(run)
+
+def _is_valid_list_cursor(cursor):
+    """
+    Return true if cursor is a decoded cursor that api_list_impl can continue from.
+
+    The cursor has exactly one of "search", the position of the last search result, or
+    "list", the name of the last file listed and how many files have been listed.  The
+    search position's values are checked by Library.search.
+    """
+    if not isinstance(cursor, dict) or len(cursor) != 1:
+        return False
+
+    if 'search' in cursor:
+        return isinstance(cursor['search'], dict)
+
+    position = cursor.get('list')
+    if not isinstance(position, dict):
+        return False
+
+    if 'name' not in position or 'skip' not in position:
+        return False
+
+    name = position['name']
+    skip = position['skip']
+    return (
+        (name is None or isinstance(name, str)) and
+        isinstance(skip, int) and not isinstance(skip, bool) and skip >= 0
+    )
+
+def _encode_list_cursor(cursor):
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode('utf-8')).decode('ascii')
+
 # A paginated request generator continually yields the next page of results
 # as a { 'results': [...] } dictionary.  When there are no more results, continually
 # yield empty results.
 #
 # If another page may be available, the 'next' key on the dictionary is true.  If it's
 # false or not present, the request will end.
-def api_list_impl(info):
+#
+# Each page also has a 'cursor' which can be passed back as cursor to continue after it
+# (see api_list).  This is null if there are no more results or the search can't be
+# continued, such as with shuffled searches.  If cursor is set, we start there.
+def api_list_impl(info, *, cursor=None):
     path = PurePosixPath(info.request.match_info['path'])
     def get_range_parameter(name):
         value = info.data.get(name, None)
@@ -715,6 +882,9 @@ def api_list_impl(info):
         return
 
     file_info = []
+
+    # The position of the last result we've returned, to create cursors.
+    position = None
     def flush(*, last):
         nonlocal file_info
 
@@ -723,6 +893,7 @@ def api_list_impl(info):
             'next': not last,
             'results': file_info,
             'path': str(info.manager.library.get_public_path(path)),
+            'cursor': _encode_list_cursor(position) if position is not None and not last else None,
         }
 
         file_info = []
@@ -746,11 +917,24 @@ def api_list_impl(info):
         absolute_path = info.manager.resolve_path(path)
         paths_to_search = [absolute_path]
 
+    # If we're reading from a cursor, we'll only read one page, so don't run the search
+    # in the background.
+    threaded = 'cursor' not in info.data
+
     if search_options:
-        entry_iterator = info.manager.library.search(paths=paths_to_search, include_files=not directories_only, sort_order=sort_order, **search_options)
+        after = cursor.get('search') if cursor else None
+        entry_iterator = info.manager.library.search(paths=paths_to_search, include_files=not directories_only, sort_order=sort_order,
+            after=after, threaded=threaded, **search_options)
     else:
         # We have no search, so just list the contents of the directory.
-        entry_iterator = info.manager.library.list(paths=paths_to_search, include_files=not directories_only, sort_order=sort_order)
+        after = cursor.get('list') if cursor else None
+        after = after or { 'name': None, 'skip': 0 }
+        entry_iterator = info.manager.library.list(paths=paths_to_search, include_files=not directories_only, sort_order=sort_order,
+            after=after['name'], skip=after['skip'])
+
+        # Shuffled listings can't be continued.
+        if sort_order != 'shuffle':
+            position = { 'list': after }
 
     # This receives blocks of results.  Convert it to the API format and yield the whole
     # block.
@@ -759,6 +943,18 @@ def api_list_impl(info):
             illust_info = get_illust_info(info, entry, info.base_url)
             if illust_info is not None:
                 file_info.append(illust_info)
+
+        # Remember where we are, so we can continue from here.  For listings, remember the
+        # filename and a fallback offset in case the file is deleted.
+        if entries:
+            if search_options:
+                search_position = info.manager.library.get_search_position(entries[-1], sort_order=sort_order)
+                position = { 'search': search_position } if search_position is not None else None
+            elif position is not None:
+                position = { 'list': {
+                    'name': entries[-1]['path'].name,
+                    'skip': position['list']['skip'] + len(entries),
+                }}
         
         # If we're listing directories only, wait until we have all results.
         if not directories_only and file_info:
@@ -865,3 +1061,31 @@ async def api_auth_set_password(info):
     return {
         'success': True,
     }
+
+async def test():
+    # Cursors that decode but aren't valid positions are rejected as invalid requests,
+    # before any search is started.
+    from types import SimpleNamespace
+    for cursor in (
+        [1, 2],
+        'cursor',
+        {},
+        { 'list': { 'name': None } },
+        { 'list': { 'skip': 0 } },
+        { 'list': { 'name': 1, 'skip': 0 } },
+        { 'list': { 'name': None, 'skip': -1 } },
+        { 'list': { 'name': None, 'skip': 0 }, 'search': {} },
+        { 'search': [] },
+    ):
+        info = SimpleNamespace(data={ 'cursor': _encode_list_cursor(cursor) })
+        try:
+            await _api_list_from_cursor(info)
+            assert False, cursor
+        except misc.Error as e:
+            assert e.code == 'invalid-request', cursor
+
+    assert _is_valid_list_cursor({ 'list': { 'name': 'file.jpg', 'skip': 10 } })
+    assert _is_valid_list_cursor({ 'search': { 'ctime': 0, 'path_lowercase': 'a' } })
+
+if __name__ == '__main__':
+    asyncio.run(test())
@@ -129,6 +129,10 @@ class APIServer:
         """
         try:
             self.running_requests[request.task] = request
+
+            # Let background populating know we're busy.
+            self.server.library.populate_engine.request_started()
+
             return await handler(request)
         finally:
             del self.running_requests[request.task]
@@ -0,0 +1,116 @@
+import asyncio, logging, os, time
+from pathlib import PurePath
+
+from ..util.monitor_changes import FileAction
+
+log = logging.getLogger(__name__)
+
+class ChangeBatcher:
+    """
+    Collect file changes from MonitorChanges and handle them in batches.
+
+    Changes often arrive in bursts.  Unpacking an archive creates every directory in it,
+    and handling each one separately would refresh the same trees over and over.  Changes
+    are collected until none have arrived for delay seconds, or until max_delay seconds
+    after the first one, and then passed to handle_changes together:
+
+    - Repeated changes to the same path are combined.
+    - Changes inside a directory that was added are dropped, since handling the added
+    directory refreshes everything inside it.
+
+    handle_changes is an async function taking a list of (path, old_path, action).
+    Batches are handled one at a time, in the order changes were received.
+    """
+    def __init__(self, handle_changes, *, delay=0.5, max_delay=5):
+        self.handle_changes = handle_changes
+        self.delay = delay
+        self.max_delay = max_delay
+
+        # Pending changes, by path.
+        self._pending = {}
+        self._first_change_at = None
+        self._last_change_at = None
+        self._task = None
+
+        # Statistics.
+        self.changes_received = 0
+        self.changes_handled = 0
+        self.batches = 0
+
+    def add(self, path, old_path, action):
+        """
+        Queue a change.  This must be called from the event loop.
+        """
+        self.changes_received += 1
+
+        key = os.fspath(path)
+        previous = self._pending.pop(key, None)
+        if previous is not None:
+            # A file that was added or renamed and then modified is still just added or renamed.
+            _, previous_old_path, previous_action = previous
+            if action == FileAction.FILE_ACTION_MODIFIED and previous_action in (FileAction.FILE_ACTION_ADDED, FileAction.FILE_ACTION_RENAMED):
+                action = previous_action
+                old_path = previous_old_path
+
+        # Re-add the change, so changes stay in the order they were last made.
+        self._pending[key] = (path, old_path, action)
+
+        now = time.monotonic()
+        if self._first_change_at is None:
+            self._first_change_at = now
+        self._last_change_at = now
+
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name='ChangeBatcher')
+
+    async def _run(self):
+        try:
+            while self._pending:
+                # Wait until changes stop arriving, or until we've waited too long.
+                while True:
+                    flush_at = min(self._last_change_at + self.delay, self._first_change_at + self.max_delay)
+                    delay = flush_at - time.monotonic()
+                    if delay <= 0:
+                        break
+                    await asyncio.sleep(delay)
+
+                await self.flush()
+        finally:
+            self._task = None
+
+    def _get_changes(self):
+        """
+        Return pending changes, without changes inside directories that were added.
+        """
+        added = { PurePath(key) for key, (_, _, action) in self._pending.items() if action == FileAction.FILE_ACTION_ADDED }
+
+        changes = []
+        for key, change in self._pending.items():
+            if any(parent in added for parent in PurePath(key).parents):
+                continue
+            changes.append(change)
+
+        return changes
+
+    async def flush(self):
+        """
+        Handle pending changes now.
+        """
+        if not self._pending:
+            return
+
+        changes = self._get_changes()
+        self._pending = {}
+        self._first_change_at = None
+        self._last_change_at = None
+
+        self.batches += 1
+        self.changes_handled += len(changes)
+
+        try:
+            await self.handle_changes(changes)
+        except Exception as e:
+            log.exception('Error handling file changes')
+
+    def __str__(self):
+        return '%i changes received, %i handled in %i batches' % (self.changes_received, self.changes_handled, self.batches)
@@ -1,7 +1,8 @@
 # This implements indexing for file searching.
 #
 # Keyword searches use Windows's file indexing.  It avoids duplicating the
-# indexing work and keeps what we're doing lightweight.
+# indexing work and keeps what we're doing lightweight.  On other platforms,
+# we keep our own index of filenames instead (see search_providers).
 # 
 # Files are cached in our database.  During initial scanning we search for
 # bookmarked files by looking for our metadata files, and cache the files.
@@ -31,25 +32,34 @@
 # XXX: we shouldn't do a full refresh on changes, but not sure how to find out if
 # indexing is up to date for a path in order to use quick refresh
 
-import asyncio, collections, errno, itertools, os, time, traceback, json, heapq, natsort, random, math, logging, stat, re
+import asyncio, collections, errno, itertools, os, sys, time, traceback, json, heapq, random, math, logging, stat, re
 from pprint import pprint
-from pathlib import Path, PurePosixPath
+from pathlib import Path, PurePath, PurePosixPath
+from concurrent.futures import ThreadPoolExecutor
 
 from ..util import monitor_changes, windows_search, misc, inpainting
 from . import metadata_storage
 from ..database.file_index import FileIndex
+from ..database.filename_index import FilenameIndex
 from ..util.paths import open_path, PathBase
 from ..util.misc import TransientWriteConnection
+from ..util.crawler import Crawler
+from ..util.threaded_tasks import AsyncTask
+from .populate import PopulateEngine
+from .list_ids_cache import ListIdsCache
+from .change_batcher import ChangeBatcher
+from .search_providers import WindowsSearchProvider, FilenameIndexProvider
 
 log = logging.getLogger(__name__)
-natsort_key = natsort.natsort_keygen(alg=natsort.IGNORECASE)
 
 def _create_natsort():
     """
     Create our natural sort key.
+
+    This matches the natural_sort_key index sort, using the path to break ties.
     """
     def key(entry):
-        return not entry.is_dir(), *natsort_key(entry.stem)
+        return misc.natural_sort_key(entry.stem, is_directory=entry.is_dir()), str(entry).lower()
 
     return key
 
@@ -70,21 +80,9 @@ def _create_natsort_pages_reversed():
     This sort actually does the opposite, and just reverses the pages within each group.  To
     get the correct affect, use it as a reverse sort.
     """
-    # Look for "prefix #123...".
-    pattern = re.compile(r'(.* #)(\d+)(.*)')
     def reverse_pages(entry):
-        entry_with_stem = entry
-
-        match = pattern.match(entry.stem)
-        if not entry.is_dir() and match:
-            # natsort doesn't handle negative numbers, so we can't just invert the page number.
-            prefix = match[1]
-            page = int(match[2])
-            suffix = match[3]
-            reversed_filename = f'{prefix}{1000000000000000 - page}{suffix}'
-            entry_with_stem = entry.with_stem(reversed_filename)
-
-        return not entry.is_dir(), *natsort_key(entry_with_stem.stem)
+        key = misc.natural_sort_key(entry.stem, is_directory=entry.is_dir(), reverse_pages=True)
+        return key, str(entry).lower()
 
     return reverse_pages
 
@@ -96,6 +94,10 @@ def _create_natsort_pages_reversed():
 #
 # Filesystem ("fs") sorts are used by Library.list, and sort BasePaths.  This lets us sort items
 # before retrieving their entries.
+#
+# "fields" lists the entry fields the index sort is based on.  These are what we need to
+# remember about the last result to continue a search from where it left off without
+# rerunning it (see Library.search's after parameter).
 sort_orders = {
     # Normal sorting puts directories first, then sorts by pathname.
     #
@@ -113,6 +115,7 @@ sort_orders = {
         # Use reverse_order_str to sort descending, since Python doesn't do this directly.        
         'entry': lambda entry: (misc.reverse_order_str(entry['basename_if_directory_lowercase']), entry['path_lowercase'].lower()),
         'index': [('basename_if_directory_lowercase', 'DESC'), ('path_lowercase', 'ASC')],
+        'fields': ('basename_if_directory_lowercase', 'path_lowercase'),
         'fs': lambda entry: (not entry.is_dir(), entry.name),
     },
 
@@ -129,26 +132,40 @@ sort_orders = {
 
         # SQLite doesn't have floor(), so do it with round() instead.
         'index': [('round(ctime - 0.5)', 'ASC'), ('path_lowercase', 'ASC')],
+        'fields': ('ctime', 'path_lowercase'),
         'fs': lambda entry: (math.floor(entry.stat().st_birthtime), entry.name),
     },
 
     # A natural sort.  This also puts directories first, but sorts numbered files much better.
-    # This isn't supported for searching, but it's mostly useful for viewing single directories.
-    # This is the default sort for Library.list.
+    # This is the default sort for Library.list.  Windows search can't sort this way, so this
+    # is only used for searches that don't use it.
+    #
+    # The index sort matches the filesystem sort exactly, so "list_index" is set to let
+    # Library.list read directories from the index.
     'natural': {
+        'entry': lambda entry: (entry['natural_sort_key'], entry['path_lowercase'].lower()),
+        'index': [('natural_sort_key', 'ASC'), ('path_lowercase', 'ASC')],
+        'fields': ('natural_sort_key', 'path_lowercase'),
         'fs': _create_natsort(),
+        'list_index': True,
     },
 
     # Like natural, but reverse the order of pages within a group.  This is an alternative to
     # -natural to show older image groups first, but without reversing the order of pages within
     # the group.
     'natural-reverse-pages': {
+        'entry': lambda entry: (entry['natural_sort_key_pages_reversed'], entry['path_lowercase'].lower()),
+        'index': [('natural_sort_key_pages_reversed', 'ASC'), ('path_lowercase', 'ASC')],
+        'fields': ('natural_sort_key_pages_reversed', 'path_lowercase'),
         'fs': _create_natsort_pages_reversed(),
+        'list_index': True,
     },
 
     # Sort by time bookmarked.  Use bookmark_updated_at, so editing a bookmark bumps it to the top.
     'bookmarked-at': {
-        'index': [('bookmark_updated_at', 'DESC')],
+        # Break ties with the path, so searches can be continued with after.
+        'index': [('bookmark_updated_at', 'DESC'), ('path_lowercase', 'DESC')],
+        'fields': ('bookmark_updated_at', 'path_lowercase'),
 
         # Bookmark searches are always local index searches, so these aren't used.
         'windows': [],
@@ -159,7 +176,7 @@ sort_orders = {
 
 # The sort "normal" can be used anywhere, including searches, but doesn't sort
 # optimally.  The sort "natural" uses a natural sort and makes a lot more sense,
-# but only works when viewing a directory since Windows indexing doesn't support
+# but can't be used with Windows search, since Windows indexing doesn't support
 # it.  Additionally, "-natural-reverse-pages" is an alternative to "-natural"
 # to view files in descending order, but to leave pages within a group of images
 # in ascending order.
@@ -178,6 +195,8 @@ def _get_sort(sort_order):
     - SQL orders are flattened to an ORDER BY clause.
     - A "reverse" key is added, which is true if sort_order begins with "-".
     - If reversed, SQL orders are inversed.
+    - An "index_keys" key is added with the unflattened index order, for FileIndex.search's
+    after parameter.
     """
     # If the sort order begins with '-', remove it and set the 'reversed' flag in
     # the results.
@@ -207,6 +226,9 @@ def _get_sort(sort_order):
             
             order[order_type] = new_order_by
 
+    if 'index' in order:
+        order['index_keys'] = order['index']
+
     # Flatten the SQL orderings to ORDER BY clauses.
     for order_type in 'windows', 'index':
         if order_type not in order:
@@ -216,9 +238,64 @@ def _get_sort(sort_order):
 
     return order
 
+def _map_in_order(executor, func, iterable, *, window):
+    """
+    Yield func(item) for each item in iterable, running up to window calls at once on
+    executor.  Results are yielded in the same order as iterable.
+
+    Closing the generator cancels calls that haven't started.
+    """
+    pending = collections.deque()
+    iterator = iter(iterable)
+    try:
+        while True:
+            # Fill the window.
+            while len(pending) < window:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                pending.append(executor.submit(func, item))
+
+            if not pending:
+                return
+
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
 # This parameter to set_image_edits means to leave the existing value unchanged.
 no_change = object()
 
+class _BulkIndexer:
+    """
+    Collect entries during a refresh and add them to the index in batches.
+    """
+    def __init__(self, db, *, batch_size=1000):
+        self.db = db
+        self.batch_size = batch_size
+        self.pending = []
+        self.indexed = 0
+        self.started_at = time.time()
+
+    def add(self, entries):
+        self.pending.extend(entries)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        self.db.add_records(self.pending)
+        self.indexed += len(self.pending)
+        self.pending = []
+
+    def __str__(self):
+        elapsed = max(time.time() - self.started_at, 0.001)
+        return '%i files indexed, %.0f rows/sec' % (self.indexed, self.indexed / elapsed)
+
 class Library:
     """
     Handle indexing and searching for a directory tree.
@@ -226,21 +303,68 @@ class Library:
     This handles a single root directory.  To index multiple directories, create
     multiple libraries.
     """
-    def __init__(self, data_dir):
+    # The number of threads to crawl each mount with during refresh, if not set by mount.
+    default_crawl_workers = 8
+
+    # How many search results to populate at once.  If None, populate a batch at a time.
+    search_populate_window = None
+
+    # How many threads to populate search results with.  These are shared by all searches.
+    search_workers = 16
+
+    def __init__(self, data_dir, *, search_provider=None):
+        """
+        search_provider is the SearchProvider to search the filesystem with.  By default,
+        this uses Windows Search on Windows, and our own filename index elsewhere.
+        """
         self.mounts = {}
         self.monitors = {}
+        self.crawl_workers = {}
         self._data_dir = data_dir
 
         # Open our databases.
         self.db = FileIndex(self.data_dir / 'index.sqlite')
 
-    def mount(self, path, name=None):
+        # This populates unpopulated entries in the background.  This is started by the
+        # server with populate_engine.run.
+        self.populate_engine = PopulateEngine(self)
+
+        # Cached results for list_ids.
+        self.list_ids_cache = ListIdsCache(self.db)
+
+        # Changes from monitoring are collected and handled in batches.
+        self.change_batcher = ChangeBatcher(self.handle_updates)
+
+        # The thread pool for populating search results.  This is shut down by shutdown().
+        self._search_executor = ThreadPoolExecutor(max_workers=self.search_workers, thread_name_prefix='Search')
+
+        # Keep the metadata file registry up to date when we write metadata files.  With
+        # write-behind, this happens when the file is actually written.
+        metadata_storage.add_write_listener(self._update_metadata_registry)
+
+        if search_provider is None:
+            if sys.platform == 'win32':
+                search_provider = WindowsSearchProvider()
+            else:
+                search_provider = FilenameIndexProvider(FilenameIndex(self.data_dir / 'filenames.sqlite'))
+        self.search_provider = search_provider
+
+    def mount(self, path, name=None, *, crawl_workers=None):
+        """
+        Add a directory to the library.
+
+        crawl_workers is the number of directories to list at once when refreshing this
+        mount.  Network shares benefit from more, and a single spinning disk may do better
+        with fewer.
+        """
         path = open_path(path)
         if name is None:
             name = path.name
 
         assert name not in self.mounts
         self.mounts[name] = path
+        if crawl_workers is not None:
+            self.crawl_workers[name] = crawl_workers
 
         self.monitor(name)
 
@@ -251,9 +375,11 @@ class Library:
 
         await self.stop_monitoring(name)
         del self.mounts[name]
+        self.crawl_workers.pop(name, None)
 
     def shutdown(self):
-        pass
+        metadata_storage.remove_write_listener(self._update_metadata_registry)
+        self._search_executor.shutdown(wait=False, cancel_futures=True)
     
     @property
     def data_dir(self):
@@ -312,8 +438,13 @@ class Library:
         """
         Do a quick refresh of the library.
 
-        This uses Windows Search to find directories with our metadata, and refreshes just
-        those directories.
+        Metadata files we've read are registered in the index with their mtime and size, so
+        we start by only reading the registered ones that have changed.  That's just a stat
+        per metadata file if nothing has changed, and the library is ready once it's done.
+
+        We then use the search provider to find metadata files that aren't registered yet,
+        such as ones created while we weren't running, and read just those.  If the provider
+        keeps its own index, it's updated first.
 
         This currently doesn't remove bookmarks from the database that no longer exist.
         """
@@ -322,86 +453,316 @@ class Library:
         log.info('Initializing library: %s' % ', '.join(str(path) for path in paths))
         start = time.time()
 
-        # Scan for metadata files.
-        log.info(f'Finding bookmarks...')
-        all_metadata_files = []
+        # Read registered metadata files that have changed, and unregister ones that are gone.
+        registry = self.db.get_metadata_files([str(path) for path in paths])
+        changed_records, removed = await asyncio.to_thread(self._check_metadata_registry, registry)
+
+        indexer = _BulkIndexer(self.db)
+        for record in changed_records:
+            indexer.add(self._get_unindexed_metadata_entries(open_path(record['path'])))
+            await asyncio.sleep(0)
+
+        indexer.flush()
+        self.db.set_metadata_files(changed_records)
+        self.db.delete_metadata_files(removed)
+        self.populate_engine.wake()
+
+        log.info(f'Library ready in %.2f seconds: {len(registry)} bookmark files, {len(changed_records)} changed, {len(removed)} removed' % (time.time() - start))
+
+        await self.search_provider.refresh(paths)
+
+        # Scan for metadata files that aren't registered.
+        log.info(f'Finding new bookmarks...')
+        registered = set(registry.keys()) - set(removed)
+        new_metadata_files = []
         for path in paths:
-            # Find all metadata files.
-            for result in windows_search.search(
+            for result in self.search_provider.search(
                     paths=[str(path)],
                     filename=metadata_storage.metadata_filename,
                     timeout=0, # disable timeouts
                 ):
-                all_metadata_files.append(result.path)
+                if os.fspath(result.path) not in registered:
+                    new_metadata_files.append(result.path)
                 await asyncio.sleep(0)
 
-        log.info(f"Scanning {len(all_metadata_files)} directories with bookmarks")
-        for path in all_metadata_files:
-            path = open_path(path)
-            await self._refresh_metadata_file(path)
+        log.info(f"Scanning {len(new_metadata_files)} new directories with bookmarks")
+        metadata_records = []
+        for path in new_metadata_files:
+            record, entries = self._read_metadata_file(open_path(path))
+            indexer.add(entries)
+            if record is not None:
+                metadata_records.append(record)
 
             # Yield as we go, to make sure we allow other things to happen if this takes a while.
             await asyncio.sleep(0)
 
+        # Register the files once everything in them has been indexed.
+        indexer.flush()
+        self.db.set_metadata_files(metadata_records)
+        self.populate_engine.wake()
+
         end = time.time()
-        log.info(f'Indexing {", ".join(str(path) for path in paths)} took %.2f seconds' % (end-start))
+        log.info(f'Indexing {", ".join(str(path) for path in paths)} took %.2f seconds (%s)' % (end-start, indexer))
+
+    def _check_metadata_registry(self, registry, *, chunk_size=1000):
+        """
+        Given registered metadata files from get_metadata_files, return (changed, removed).
+        changed is a list of new registry records for files whose mtime or size has changed,
+        and removed is a list of files that no longer exist.
 
-    async def refresh(self, *, paths=None):
+        This is called in a thread, and checks files in parallel, since this can be a lot of
+        stats on a slow disk.  Files are checked in chunks, since a stat is much quicker than
+        scheduling a job for it.
+        """
+        def check_chunk(paths):
+            return [(path, self._get_metadata_file_record(path)) for path in paths]
+
+        paths = list(registry.keys())
+        chunks = [paths[start:start+chunk_size] for start in range(0, len(paths), chunk_size)]
+
+        changed = []
+        removed = []
+        with ThreadPoolExecutor(max_workers=self.default_crawl_workers, thread_name_prefix='CheckMetadata') as executor:
+            for results in executor.map(check_chunk, chunks):
+                for path, record in results:
+                    if record is None:
+                        removed.append(path)
+                    elif (record['mtime'], record['size']) != registry[path]:
+                        changed.append(record)
+
+        return changed, removed
+
+    async def refresh(self, *, paths=None, full=False):
         """
         Refresh the library.
 
         This does the same thing as quick_refresh, but scans the filesystem manually
-        rather than using Windows search.
+        rather than using Windows search.  Each mount is crawled in parallel with its
+        own number of crawl workers (see mount).
+
+        Directories that haven't changed since the last refresh aren't listed again (see
+        _refresh_mount).  If full is true, list every directory.
         """
         if paths is None:
             paths = self.mounts.values()
 
-        refreshed = 0
-        total_refresh = 0
-
-        import queue
-        pending_paths = queue.LifoQueue()
+        # Group paths by mount.
+        paths_by_mount = {}
         for path in paths:
-            pending_paths.put(path)
-            total_refresh += 1
-
-        while not pending_paths.empty():
-            if total_refresh > 1 and (refreshed % 1000) == 0:
-                log.info('Refreshing %i/%i (%i left)' % (refreshed, total_refresh, pending_paths.qsize()))
-
-            path = pending_paths.get()
-            refreshed += 1
-
             # Make sure path is inside this library.
-            if self.get_mount_for_path(path) is None:
+            mount = self.get_mount_for_path(path)
+            if mount is None:
                 log.warn('Path %s isn\'t mounted' % path)
                 continue
 
-            # Let other tasks run periodically.
-            await asyncio.sleep(0)
+            paths_by_mount.setdefault(mount, []).append(path)
+
+        indexer = _BulkIndexer(self.db)
+        journal_updates = []
+        metadata_records = []
+        await asyncio.gather(*[
+            self._refresh_mount(mount, mount_paths, indexer, journal_updates, metadata_records, full=full)
+            for mount, mount_paths in paths_by_mount.items()
+        ])
+        indexer.flush()
+
+        # Register the metadata files we read, now that everything in them has been indexed.
+        self.db.set_metadata_files(metadata_records)
 
-            for child in path.scandir():
-                if child.is_real_dir():
-                    pending_paths.put(child)
-                    total_refresh += 1
-                elif child.name == metadata_storage.metadata_filename:
-                    await self._refresh_metadata_file(child)
+        # Update the search provider's index too, if it has one.
+        await self.search_provider.refresh([path for mount_paths in paths_by_mount.values() for path in mount_paths])
+
+        # Update the refresh journal now that everything we found has been indexed.  Write
+        # subdirectories before their parents.  If we're interrupted, a parent that was
+        # written without its subdirectories would cause them to be skipped next time.
+        journal_updates.sort(key=lambda record: len(PurePath(record['path']).parts), reverse=True)
+        self.db.set_directory_journal(journal_updates)
+
+        # Populate any new entries we found.
+        self.populate_engine.wake()
+
+    async def _refresh_mount(self, mount, paths, indexer, journal_updates, metadata_records, *, full=False):
+        """
+        Crawl paths inside a mount for metadata files, adding them to indexer.
+
+        The directory's mtime changes when anything is added to, removed from or renamed in
+        it, so if a directory's mtime hasn't changed since the last refresh we don't need to
+        list it again.  We use the subdirectories we saw last time, and only check its metadata
+        file, which can be modified in place without changing the directory's mtime.  Unchanged
+        subdirectories are skipped the same way, so refreshing an unchanged tree only takes a
+        stat per directory.
+
+        Journal records for directories that were listed are added to journal_updates, and
+        registry records for metadata files that were read are added to metadata_records.
+        A directory is only recorded if all of its subdirectories are in the journal, since
+        subdirectories that aren't won't be found next time.
+        """
+        journal = {} if full else self.db.get_directory_journal(paths)
+        skipped = []
+        mount_journal_updates = []
+
+        # The subdirectories of each directory we listed, by path.
+        listed_subdirectories = {}
+
+        def get_mtime(path):
+            try:
+                return path.stat().st_mtime
+            except FileNotFoundError:
+                return None
+
+        def list_directory(path):
+            mtime = path.stat().st_mtime
+            previous = journal.get(os.fspath(path))
+            metadata_file = path / metadata_storage.metadata_filename
+
+            if previous is not None and previous['mtime'] == mtime:
+                skipped.append(previous['child_count'])
+                files = []
+                if previous['metadata_mtime'] is not None:
+                    metadata_mtime = get_mtime(metadata_file)
+                    if metadata_mtime != previous['metadata_mtime']:
+                        if metadata_mtime is not None:
+                            files.append(metadata_file)
+                        mount_journal_updates.append(dict(previous, path=os.fspath(path), metadata_mtime=metadata_mtime))
+
+                return [open_path(subdirectory, open_zips=False) for subdirectory in previous['subdirectories']], files
+
+            subdirectories, files = Crawler.scandir(path)
+            child_count = len(subdirectories) + len(files)
+            listed_subdirectories[os.fspath(path)] = [os.fspath(subdirectory) for subdirectory in subdirectories]
+
+            # Only the metadata file is read.
+            files = [file for file in files if file.name == metadata_storage.metadata_filename]
+
+            # Don't record very recent mtimes.  Filesystems with coarse timestamps could
+            # change again without the mtime changing.
+            if time.time() - mtime > 2:
+                mount_journal_updates.append({
+                    'path': os.fspath(path),
+                    'mtime': mtime,
+                    'child_count': child_count,
+                    'metadata_mtime': get_mtime(files[0]) if files else None,
+                })
+
+            return subdirectories, files
+
+        def process_file(path):
+            # Read metadata files on the crawler's threads, so we don't block the event loop.
+            return self._read_metadata_file(path)
+
+        # Use the number of directories we've already indexed to estimate how long this will take.
+        crawler = Crawler(paths, process_file=process_file, list_directory=list_directory,
+            workers=self.crawl_workers.get(mount, self.default_crawl_workers),
+            expected_directories=self.db.get_directory_count(paths))
+
+        last_progress_at = time.time()
+        async for results in crawler.run():
+            for record, entries in results:
+                indexer.add(entries)
+                if record is not None:
+                    metadata_records.append(record)
+
+            if time.time() - last_progress_at >= 5:
+                last_progress_at = time.time()
+                log.info('Refreshing %s: %s (%s)' % (mount, crawler, indexer))
+                AsyncTask.set_progress(crawler.get_progress())
+
+        # Drop records for directories with subdirectories that aren't in the journal, such
+        # as ones with recent mtimes or that we couldn't list.  Check subdirectories first,
+        # so dropping one drops its parents too.  Directories that were already in the
+        # journal keep their old record, which is enough for their parent to find them.
+        recorded = set(journal)
+        mount_journal_updates.sort(key=lambda record: len(PurePath(record['path']).parts), reverse=True)
+        for record in mount_journal_updates:
+            subdirectories = listed_subdirectories.get(record['path'], [])
+            if all(subdirectory in recorded for subdirectory in subdirectories):
+                recorded.add(record['path'])
+                journal_updates.append(record)
+
+        if crawler.directories > 1:
+            log.info('Refreshed %s: %s, %i unchanged with %i entries (%s)' % (mount, crawler, len(skipped), sum(skipped), indexer))
 
     async def _refresh_metadata_file(self, metadata_file, *, conn=None):
+        record, entries = self._read_metadata_file(metadata_file, conn=conn)
+        self.db.add_records(entries, conn=conn)
+        if record is not None:
+            self.db.set_metadata_files([record], conn=conn)
+        else:
+            self.db.delete_metadata_files([metadata_file], conn=conn)
+
+    @classmethod
+    def _get_metadata_file_record(cls, metadata_file):
+        """
+        Return a record for FileIndex.set_metadata_files for a metadata file, or None if
+        it doesn't exist.
+        """
+        try:
+            stat_result = os.stat(metadata_file)
+        except FileNotFoundError:
+            return None
+
+        return {
+            'path': os.fspath(metadata_file),
+            'mtime': stat_result.st_mtime,
+            'size': stat_result.st_size,
+        }
+
+    def _read_metadata_file(self, metadata_file, *, conn=None):
+        """
+        Return (record, entries) for a metadata file.  entries are from _get_unindexed_metadata_entries,
+        and record is from _get_metadata_file_record.
+
+        The file is stat'd before it's read, so if it changes while we're reading it, the
+        registry won't match and it'll be read again.
+        """
+        record = self._get_metadata_file_record(metadata_file)
+        if record is None:
+            return None, []
+
+        return record, self._get_unindexed_metadata_entries(metadata_file, conn=conn)
+
+    def _update_metadata_registry(self, metadata_file):
+        """
+        Update the registry for a metadata file that we've written.  This is called by
+        metadata_storage after the file is written.
+        """
+        record = self._get_metadata_file_record(metadata_file)
+        if record is not None:
+            self.db.set_metadata_files([record])
+        else:
+            self.db.delete_metadata_files([metadata_file])
+
+    def _get_unindexed_metadata_entries(self, metadata_file, *, conn=None):
+        """
+        Return unpopulated entries for files in a metadata file which aren't in the
+        index yet.
+        """
         assert metadata_file.name == metadata_storage.metadata_filename
-                    
+
         # Refresh just files with metadata.
-        for path in metadata_storage.get_files_with_metadata(metadata_file):
+        paths = metadata_storage.get_files_with_metadata(metadata_file)
+        existing_entries = self.db.get_multi([os.fspath(path) for path in paths], conn=conn)
+
+        entries = []
+        for path in paths:
+            if os.fspath(path) in existing_entries:
+                continue
+
             try:
                 # This file has metadata (usually a bookmark), so add it to the database.
                 # We might be adding thousands of files here, so only add an unpopulated entry.
                 # This imports bookmarrks, and any other metadata we stashed away in the
                 # metadata files.
-                self._get_entry(path=path, conn=conn, populate=False, check_mtime=False)
+                entry = self._get_entry_from_path(path, populate=False)
             except FileNotFoundError as e:
                 log.warn('Bookmarked file %s doesn\'t exist' % path)
                 continue
 
+            if entry is not None:
+                entries.append(entry)
+
+        return entries
+
     def monitor(self, mount):
         """
         Begin monitoring our directory for changes that need to be indexed.
@@ -440,7 +801,7 @@ class Library:
 
     async def monitored_file_changed(self, path, old_path, action):
         path = open_path(path)
-        await self.handle_update(path=path, old_path=old_path, action=action)
+        self.change_batcher.add(path, old_path, action)
 
     @staticmethod
     def normalize_bookmark_tags(bookmark_tags):
@@ -466,21 +827,70 @@ class Library:
         path may be a string.  We'll only convert it to a Path if necessary, since doing this
         for every file is slow.
         """
-        # If we receive FILE_ACTION_ADDED for a directory, a directory was either created or
-        # moved into our tree.  Scan it for metadata files.  We can't use a quick refresh
-        # here, since we often get here before Windows's indexing has caught up.
-        if action == monitor_changes.FileAction.FILE_ACTION_ADDED:
-            # We don't care about files being added, only directories.
-            try:
-                if not path.is_real_dir():
-                    return
-            except FileNotFoundError:
-                # The path was deleted before we got here, which probably means a file
-                # was created and then immediately deleted.
-                return
+        await self.handle_updates([(path, old_path, action)], db_conn=db_conn)
 
-            log.info('Refreshing added directory: %s' % path)
-            await self.refresh(paths=[path])
+    async def handle_updates(self, changes, *, db_conn=None):
+        """
+        Handle a list of (path, old_path, action) changes.  This is called by change_batcher
+        with changes from file monitoring.
+
+        Metadata files are read in a single transaction, and added directories are refreshed
+        together after it's committed.
+        """
+        refresh_paths = []
+        metadata_files = []
+        removed_metadata_files = []
+
+        # Directories whose contents changed, to update in the search provider's index.
+        changed_directories = set()
+
+        for path, old_path, action in changes:
+            changed_directories.add(os.path.dirname(os.fspath(path)))
+            if old_path is not None:
+                changed_directories.add(os.path.dirname(os.fspath(old_path)))
+
+            # If we receive FILE_ACTION_ADDED for a directory, a directory was either created or
+            # moved into our tree.  Scan it for metadata files.  We can't use a quick refresh
+            # here, since we often get here before Windows's indexing has caught up.
+            if action == monitor_changes.FileAction.FILE_ACTION_ADDED:
+                try:
+                    if path.is_real_dir():
+                        refresh_paths.append(path)
+                        continue
+                except FileNotFoundError:
+                    # The path was deleted before we got here, which probably means a file
+                    # was created and then immediately deleted.
+                    continue
+
+            # If a metadata file was written, index any files it has metadata for that we
+            # haven't seen yet.  Metadata files are written to a temporary file and renamed
+            # over the old one, so this is usually a rename.
+            if path.name == metadata_storage.metadata_filename:
+                if action == monitor_changes.FileAction.FILE_ACTION_REMOVED:
+                    removed_metadata_files.append(path)
+                else:
+                    metadata_files.append(path)
+
+            # If a metadata file was renamed away, it's no longer registered under its old name.
+            if old_path is not None and os.path.basename(old_path) == metadata_storage.metadata_filename:
+                removed_metadata_files.append(old_path)
+
+        if metadata_files or removed_metadata_files:
+            with self.db.connect(db_conn, write=True) as conn:
+                self.db.delete_metadata_files(removed_metadata_files, conn=conn)
+                for metadata_file in metadata_files:
+                    await self._refresh_metadata_file(metadata_file, conn=conn)
+            self.populate_engine.wake()
+
+        if refresh_paths:
+            log.info('Refreshing added directories: %s' % ', '.join(str(path) for path in refresh_paths))
+            await self.refresh(paths=refresh_paths)
+
+        await self.search_provider.refresh(sorted(changed_directories), recursive=False)
+
+        if len(changes) > 1:
+            log.info('Handled %i file changes: %i directories refreshed, %i metadata files read (%s)' % (
+                len(changes), len(refresh_paths), len(metadata_files), self.change_batcher))
 
     def _get_entry_from_path(self, path: os.PathLike, *, populate=True, extra_metadata=None):
         """
@@ -515,7 +925,7 @@ class Library:
             return None
 
         # Read file metadata.
-        file_metadata = metadata_storage.load_file_metadata(path)
+        file_metadata = metadata_storage.load_file_metadata(path, return_copy=False)
 
         # If additional metadata was provided, use it too.  This lets us use data from
         # windows_search.SearchDirEntry.
@@ -528,15 +938,7 @@ class Library:
         # metadata file or from a Windows search result.
         #
         # Don't overwrite data that we got from the file directly.
-        entry['bookmarked'] = file_metadata.get('bookmarked', False)
-        entry['bookmark_tags'] = self.normalize_bookmark_tags(file_metadata.get('bookmark_tags', ''))
-
-        # To migrate older bookmarks from before this was added, use the file timestamp as the default
-        # bookmark time.  This should be quick, but just to be safe, make sure we don't stat the file
-        # if the file isn't bookmarked.
-        default_bookmark_time = path.stat().st_birthtime if entry['bookmarked'] else 0
-        entry['bookmark_created_at'] = file_metadata.get('bookmark_created_at', default_bookmark_time)
-        entry['bookmark_updated_at'] = file_metadata.get('bookmark_updated_at', default_bookmark_time)
+        entry.update(self._get_bookmark_fields(path, file_metadata))
         if 'width' not in entry:
             entry['width'] = file_metadata.get('width')
         if 'height' not in entry:
@@ -560,6 +962,23 @@ class Library:
 
         return entry
 
+    def _get_bookmark_fields(self, path, file_metadata):
+        """
+        Return the entry fields for the bookmark in file_metadata.
+        """
+        bookmarked = file_metadata.get('bookmarked', False)
+
+        # To migrate older bookmarks from before this was added, use the file timestamp as the default
+        # bookmark time.  This should be quick, but just to be safe, make sure we don't stat the file
+        # if the file isn't bookmarked.
+        default_bookmark_time = path.stat().st_birthtime if bookmarked else 0
+        return {
+            'bookmarked': bookmarked,
+            'bookmark_tags': self.normalize_bookmark_tags(file_metadata.get('bookmark_tags', '')),
+            'bookmark_created_at': file_metadata.get('bookmark_created_at', default_bookmark_time),
+            'bookmark_updated_at': file_metadata.get('bookmark_updated_at', default_bookmark_time),
+        }
+
     @classmethod
     def _create_file_record(cls, path: os.PathLike):
         error = None
@@ -617,6 +1036,7 @@ class Library:
             'mtime': stat.st_mtime,
             'path_lowercase': str(path).lower(),
             'basename_if_directory_lowercase': None, # only set for directories
+            **FileIndex.get_natural_sort_fields(os.fspath(path), is_directory=False),
             'filesystem_mtime': path.filesystem_file.stat().st_mtime,
             'title': title,
             'mime_type': mime_type,
@@ -650,6 +1070,7 @@ class Library:
             'path': os.fspath(path),
             'path_lowercase': str(path.filesystem_file).lower(),
             'basename_if_directory_lowercase': path.filesystem_file.name.lower(),
+            **FileIndex.get_natural_sort_fields(os.fspath(path), is_directory=True),
             'is_directory': True,
             'parent': str(Path(path).parent),
             'ctime': stat.st_birthtime,
@@ -697,6 +1118,7 @@ class Library:
             'path': os.fspath(path),
             'path_lowercase': str(path.filesystem_file).lower(),
             'basename_if_directory_lowercase': path.filesystem_file.name.lower() if is_directory else None,
+            **FileIndex.get_natural_sort_fields(os.fspath(path), is_directory=is_directory),
             'filesystem_mtime': path.filesystem_file.stat().st_mtime,
             'is_directory': is_directory,
             'parent': str(Path(path).parent),
@@ -731,6 +1153,11 @@ class Library:
         include_files=True,
         include_dirs=True,
         batch_size=50,
+
+        # If set, continue a previous listing after the file with this name.  If the
+        # file no longer exists, skip is used to continue from the same position.
+        after=None,
+        skip=0,
     ):
         """
         Return all files inside each path non-recursively.
@@ -738,6 +1165,9 @@ class Library:
         if not paths:
             paths = self.mounts.values()
 
+        # The user is browsing these directories, so populate anything in them first.
+        self.populate_engine.prioritize(paths)
+
         # The normal sort for directory listings is the natural sort.  Substitute it
         # here, so the caller doesn't need to figure it out.
         if sort_order == 'normal':
@@ -745,6 +1175,19 @@ class Library:
         elif sort_order == '-normal':
             sort_order = _default_directory_list_reverse_sort
 
+        paths = list(paths)
+        sort_order_info = _get_sort(sort_order) if sort_order not in (None, 'shuffle') else None
+
+        # If everything in these directories is in the index and they haven't changed since,
+        # read them from the index, so we don't need to read and sort the whole directory.
+        if not force_refresh and sort_order_info is not None and sort_order_info.get('list_index') and self._is_listing_indexed(paths):
+            yield from self._list_from_index(paths, sort_order_info,
+                include_files=include_files, include_dirs=include_dirs, batch_size=batch_size, after=after, skip=skip)
+            return
+
+        # Otherwise, add them to the index in the background so we can next time.
+        self._index_listing(paths)
+
         # Run scandir for each path, and chain them together into a single iterator.
         iterators = []
         for path in paths:
@@ -758,16 +1201,34 @@ class Library:
             random.shuffle(scandir_results)
             scandir_results.sort(key=lambda item: not item.is_dir())
             scandir_results = iter(scandir_results)
-        elif sort_order is not None:
-            sort_order_info = _get_sort(sort_order)
-            if sort_order_info is not None:
-                sorted_results = list(scandir_results)
-                sorted_results.sort(key=sort_order_info['fs'], reverse=sort_order_info['reverse'])
+        elif sort_order_info is not None:
+            sorted_results = list(scandir_results)
+            sorted_results.sort(key=sort_order_info['fs'], reverse=sort_order_info['reverse'])
 
-                # Convert back to an iterator.
-                scandir_results = iter(sorted_results)
+            # Convert back to an iterator.
+            scandir_results = iter(sorted_results)
+
+        # If we're continuing from a previous listing, skip past the last file we returned.
+        # We don't read entries for files we're skipping, so this is much faster than
+        # reading through the listing.
+        if after is not None:
+            scandir_results = list(scandir_results)
+            for idx, child in enumerate(scandir_results):
+                if child.name == after:
+                    scandir_results = scandir_results[idx+1:]
+                    skip = 0
+                    break
+            else:
+                log.info('Continuing listing from %s, which no longer exists', after)
+
+            scandir_results = iter(scandir_results)
+
+        # Read the cached entries for everything in these directories at once, instead
+        # of querying for each file.
+        cached_entries = {} if force_refresh else self.db.get_children(paths)
 
         results = []
+        children = []
         for child in scandir_results:
             # Skip unsupported files.
             if misc.ignore_file(child):
@@ -779,22 +1240,214 @@ class Library:
             if not include_files and not is_dir:
                 continue
 
-            # Find the file in cache and cache it if needed.
-            entry = self._get_entry(child, force_refresh=force_refresh)
-            if entry is None:
+            if skip > 0:
+                skip -= 1
                 continue
 
-            self._convert_to_path(entry)
-            results.append(entry)
+            # Collect enough files to fill the batch, then read them together.  Some of
+            # them may not have entries, so we might need to do this more than once.
+            children.append(child)
+            if len(results) + len(children) < batch_size:
+                continue
+
+            results.extend(self._get_list_entries(children, cached_entries))
+            children = []
 
             # If we have a full batch, stop iterating and return it.
             if len(results) >= batch_size:
                 yield results
                 results = []
-            
+
+        if children:
+            results.extend(self._get_list_entries(children, cached_entries))
+
         if results:
             yield results
 
+    def _list_from_index(self, paths, sort_order_info, *, include_files, include_dirs, batch_size, after, skip):
+        """
+        List directories from the index for list.  This returns the same results as
+        reading the directories, but only reads the files being returned.
+
+        This is only used if _is_listing_indexed is true, so the index has an entry for
+        everything in the directories.
+        """
+        paths = [os.fspath(path) for path in paths]
+        keys = sort_order_info['index_keys']
+        fields = sort_order_info['fields']
+
+        def get_position(entry):
+            return keys, self.db.get_sort_key_values({ field: entry[field] for field in fields }, keys)
+
+        # If we're continuing from a previous listing, start after the file we returned last.
+        position = None
+        if after is not None:
+            for entry in self.db.get_multi([os.path.join(path, after) for path in paths]).values():
+                position = get_position(entry)
+                skip = 0
+                break
+            else:
+                log.info('Continuing listing from %s, which no longer exists', after)
+
+        results = []
+        while True:
+            # Read enough to fill the batch, and close the search so we don't keep a read
+            # transaction open while we're yielding.
+            search = self.db.search(paths=paths, mode=FileIndex.SearchMode.Subdir,
+                order=sort_order_info['index'], after=position,
+                include_files=include_files, include_dirs=include_dirs)
+            try:
+                rows = list(itertools.islice(search, skip, skip + batch_size - len(results)))
+            finally:
+                search.close()
+
+            if not rows:
+                break
+
+            skip = 0
+            position = get_position(rows[-1])
+
+            # These are checked and populated like entries from a directory listing.  We don't
+            # need to check misc.ignore_file, since we never add ignored files to the index.
+            cached_entries = { row['path']: row for row in rows }
+            results.extend(self._get_list_entries([open_path(row['path']) for row in rows], cached_entries))
+
+            if len(results) >= batch_size:
+                yield results
+                results = []
+
+        if results:
+            yield results
+
+    def _is_listing_indexed(self, paths):
+        """
+        Return true if everything in paths is in the index, so they can be listed with
+        _list_from_index.
+        """
+        if not paths:
+            return False
+
+        listing_mtimes = self.db.get_listing_mtimes(paths)
+        for path in paths:
+            listing_mtime = listing_mtimes.get(os.fspath(path))
+            if listing_mtime is None:
+                return False
+
+            # Don't use path.stat(), since its result may be cached.
+            try:
+                if os.stat(path).st_mtime != listing_mtime:
+                    return False
+            except OSError:
+                return False
+
+        return True
+
+    def _index_listing(self, paths):
+        """
+        Add everything inside paths to the index in the background.  This is done by the
+        populate engine, which populates the new entries afterwards.  See _index_directory.
+        """
+        # We can only tell if real directories have changed, so don't index ZIPs.
+        for path in paths:
+            try:
+                if not path.is_real_dir():
+                    return
+            except OSError:
+                return
+
+        self.populate_engine.index_directories(paths)
+
+    def _index_directory(self, path):
+        """
+        Add entries for everything inside path that isn't in the index, remove entries
+        for files that no longer exist, and record the directory's mtime.  Until the
+        directory changes, list can read it from the index.
+
+        Files are added as placeholders, which is much faster than reading them, and
+        are populated later.
+        """
+        # Read the mtime before listing the directory, so if it changes while we're listing
+        # it, it won't match next time.
+        mtime = os.stat(path).st_mtime
+
+        cached_entries = self.db.get_children([path])
+        complete = True
+        entries = []
+        found_paths = set()
+        for child in path.scandir():
+            if misc.ignore_file(child):
+                continue
+
+            child_path = os.fspath(child)
+            found_paths.add(child_path)
+            if child_path in cached_entries:
+                continue
+
+            # Directories don't have placeholders, but their entries are quick to create.
+            entry = self._get_entry_from_path(child, populate=child.is_dir())
+            if entry is None or entry.get('error') is not None:
+                complete = False
+                continue
+
+            entries.append(entry)
+
+        # Files may have been populated since we read cached_entries, so don't replace
+        # entries that already exist.
+        self.db.add_records(entries, replace=False)
+
+        stale_paths = [child_path for child_path in cached_entries if child_path not in found_paths]
+        if stale_paths:
+            self.db.delete_recursively(stale_paths)
+
+        # Only record the mtime if the directory wasn't modified very recently.  The mtime
+        # may have a resolution of a few seconds, so another change right after this one
+        # might not change it.
+        if complete and time.time() - mtime >= 2:
+            self.db.set_listing_mtimes({ os.fspath(path): mtime })
+
+    def _get_list_entries(self, paths, cached_entries):
+        """
+        Return entries for a batch of paths from a directory listing.
+
+        cached_entries is the database entries for the directory from db.get_children.
+        Entries that are up to date are returned from it, and new or stale entries are
+        read from the files and written in a single transaction.  This does the same thing
+        as calling _get_entry for each path.
+        """
+        results = []
+        entries_to_add = []
+        paths_to_delete = []
+        for path in paths:
+            entry = cached_entries.get(os.fspath(path))
+
+            # Ignore unpopulated and stale entries, so we'll populate them.
+            if entry is not None and (not entry['populated'] or not self._entry_is_up_to_date(entry, path=path)):
+                entry = None
+
+            if entry is None:
+                entry = self._get_entry_from_path(path)
+                if entry is None:
+                    # The file doesn't exist on disk.  Delete any stale entries pointing at it.
+                    paths_to_delete.append(path)
+                    continue
+
+                # Don't cache entries if there was an error scanning the file.
+                if entry.get('error') is None:
+                    entries_to_add.append(entry)
+
+            results.append(entry)
+
+        if entries_to_add or paths_to_delete:
+            with self.db.connect(write=True) as conn:
+                self.db.add_records(entries_to_add, conn=conn)
+                if paths_to_delete:
+                    self.db.delete_recursively(paths_to_delete, conn=conn)
+
+        for entry in results:
+            self._convert_to_path(entry)
+
+        return results
+
     def list_ids(self,
         path,
         *,
@@ -811,17 +1464,6 @@ class Library:
         elif sort_order == '-normal':
             sort_order = _default_directory_list_reverse_sort
 
-        scandir_results = path.scandir()
-
-        if sort_order == 'shuffle':
-            scandir_results = list(scandir_results)
-            random.shuffle(scandir_results)
-            scandir_results.sort(key=lambda item: not item.is_dir())
-        elif sort_order is not None:
-            sort_order_info = _get_sort(sort_order)
-            if sort_order_info is not None:
-                scandir_results = sorted(scandir_results, key=sort_order_info['fs'], reverse=sort_order_info['reverse'])
-
         # pathlib is surprisingly slow, and becomes a major bottleneck when we're looking
         # up large search results.  Since all files will be in the same directory, optimize
         # this by figuring out the prefix the results will have just once.
@@ -835,17 +1477,49 @@ class Library:
         else:
             root_path = PurePosixPath('/root') / str(path).replace('\\', '/')
 
-        results = []
-        for path in scandir_results:
-            # Skip unsupported files.
-            if misc.ignore_file(path):
-                continue
+        # See if we have this result cached.  Shuffled results are different every time,
+        # so they aren't cached.  If the directory was changed very recently, another change
+        # might not change the mtime, so don't cache it yet.
+        use_cache = sort_order != 'shuffle'
+        if use_cache:
+            mtime = os.stat(path.filesystem_file).st_mtime
+            use_cache = time.time() - mtime >= 2
+
+        if use_cache:
+            results = self.list_ids_cache.get(path, sort_order=sort_order, prefix=str(root_path), mtime=mtime)
+            if results is not None:
+                return results
+
+        sort_order_info = _get_sort(sort_order) if sort_order not in (None, 'shuffle') else None
+
+        # If the directory is in the index, we can read the sorted listing from it.  Otherwise,
+        # read the directory and add it to the index in the background.
+        if sort_order_info is not None and sort_order_info.get('list_index') and self._is_listing_indexed([path]):
+            children = [
+                (os.path.basename(entry['path']), entry['is_directory'])
+                for entry in self.db.search(paths=[os.fspath(path)], mode=FileIndex.SearchMode.Subdir, order=sort_order_info['index'])
+            ]
+        else:
+            self._index_listing([path])
+
+            scandir_results = path.scandir()
+            if sort_order == 'shuffle':
+                scandir_results = list(scandir_results)
+                random.shuffle(scandir_results)
+                scandir_results.sort(key=lambda item: not item.is_dir())
+            elif sort_order_info is not None:
+                scandir_results = sorted(scandir_results, key=sort_order_info['fs'], reverse=sort_order_info['reverse'])
+
+            children = [(child.name, child.is_dir()) for child in scandir_results if not misc.ignore_file(child)]
+
+        # Build the IDs with string formatting instead of pathlib, since the names are
+        # already basenames.
+        prefix = str(root_path)
+        results = ['%s:%s/%s' % ('folder' if is_dir else 'file', prefix, name) for name, is_dir in children]
+
+        if use_cache:
+            self.list_ids_cache.set(path, results, sort_order=sort_order, prefix=str(root_path), mtime=mtime)
 
-            is_dir = path.is_dir()
-            relative_path = root_path / path.name
-            media_id = '%s:%s' % ('folder' if is_dir else 'file', relative_path)
-            results.append(media_id)
-            
         return results
 
     def get_mountpoint_entries(self):
@@ -853,7 +1527,7 @@ class Library:
         Return entries for each mountpoint.
         """
         results = []
-        with self.db.connect() as conn:
+        with self.db.connect(write=True) as conn:
             for mount_name, mount_path in self.mounts.items():
                 entry = self._get_entry(mount_path, conn=conn)
                 assert entry is not None
@@ -862,16 +1536,20 @@ class Library:
                 results.append(entry)
         return results
 
-    def _entry_is_up_to_date(self, entry):
+    def _entry_is_up_to_date(self, entry, *, path=None):
         """
         Check an entry against its file on disk to check that the file still
         exists, and the entry is up to date.  Return true if the entry is up-to-date,
         or false if the entry is stale or the file no longer exists.
+
+        If path is set, it's the entry's path.  If it came from scandir, this uses its
+        cached stat instead of reading it again.
         """
         # Check if cache is out of date.  If this is a ZIP, we're checking the mtime
         # of the ZIP itself, so we don't read the ZIP directory here.
         try:
-            path = open_path(entry['path'])
+            if path is None:
+                path = open_path(entry['path'])
             path_stat = path.filesystem_file.stat()
         except OSError as e:
             # The only common error is ENOENT, but treat any error as stale.
@@ -940,14 +1618,15 @@ class Library:
 
     # Searching is a bit tricky.  We have a few things we want to do:
     #
-    # - Read both Windows Search and our index, returning results from both.
-    # - Windows Search needs to be read incrementally, since it might be a very
+    # - Read both the search provider (usually Windows Search) and our index, returning
+    # results from both.
+    # - The search provider needs to be read incrementally, since it might be a very
     # large search.
     # - Yield data in batches.  Open a database connection while reading a batch,
     # so we save any new cached data in a single transaction, but don't keep the
     # transaction open while yielding, or we can hold a write lock indefinitely.
-    # - If sorting is enabled, request sorted data from both Windows and our index,
-    # and merge the two together as we go.
+    # - If sorting is enabled, request sorted data from both the search provider and our
+    # index, and merge the two together as we go.
     #
     # See Library.list  for a simpler example of batching.
     #
@@ -961,6 +1640,8 @@ class Library:
     # to match differently, such as having different keyword matching.
     def search(self, *,
         paths=None,
+
+        # If false, don't use the search provider, and only search our index.
         use_windows_search=True,
         use_index=True,
         sort_order='normal',
@@ -968,6 +1649,14 @@ class Library:
 
         # If true, check that search results from the database actually exist on disk.
         verify_files=True,
+
+        # If set, continue a previous search after this entry.  Only the sort order's
+        # "fields" need to be present.
+        after=None,
+
+        # If false, don't run the searches in background threads.  This is faster if the
+        # caller will only read a single batch.
+        threaded=True,
         **search_options):
         if not paths:
             paths = self.mounts.values()
@@ -981,28 +1670,30 @@ class Library:
         else:
             sort_order_info = _get_sort(sort_order)
 
-        # A sort order needs these keys to be used with searching.
+        # Don't use Windows search when searching bookmarks.  Bookmarks are always indexed,
+        # and the search doesn't help us with them.
+        if search_options.get('bookmarked') or search_options.get('bookmark_tags') is not None:
+            use_windows_search = False
+
+        # A sort order needs these keys to be used with searching.  Sorts that the search provider
+        # can't do, like natural sorting with Windows search, can only be used when we're not using it.
         if sort_order_info is not None:
-            for key in ('entry', 'index', 'windows'):
+            required_keys = ('entry', 'index', self.search_provider.sort_key) if use_windows_search else ('entry', 'index')
+            for key in required_keys:
                 if key not in sort_order_info:
                     log.warn(f'Sort "{sort_order}" not supported for searching')
-                    sort_order_info = sort_orders['normal']
+                    sort_order_info = _get_sort('normal')
                     break
 
         # We're waiting synchronously for the Windows search if we're in shuffle and can't
         # return any results at all until it finishes, so use a smaller timeout.
         windows_search_timeout = 5 if shuffle else 10
 
-        # Don't use Windows search when searching bookmarks.  Bookmarks are always indexed,
-        # and the search doesn't help us with them.
-        if search_options.get('bookmarked') or search_options.get('bookmark_tags') is not None:
-            use_windows_search = False
-
-        # Create the Windows search.
+        # Create the search provider's search.
         if use_windows_search:
-            order = sort_order_info['windows'] if sort_order_info else None
+            order = sort_order_info[self.search_provider.sort_key] if sort_order_info else None
             order_fs = sort_order_info['fs'] if sort_order_info else None
-            windows_search_iter = windows_search.search(paths=[str(path) for path in paths],
+            windows_search_iter = self.search_provider.search(paths=[str(path) for path in paths],
                 order=order,
                 order_fs=order_fs,
                 timeout=windows_search_timeout,
@@ -1010,10 +1701,31 @@ class Library:
         else:
             windows_search_iter = []
 
+        # If we're continuing a search, get the sort keys of the last result.  Only take the
+        # fields this sort uses, since these are evaluated as SQL.
+        index_after = None
+        if after is not None:
+            if sort_order_info is None:
+                raise misc.Error('invalid-request', 'Shuffled searches can\'t be continued')
+
+            after = { field: after.get(field) for field in sort_order_info['fields'] }
+
+            # Get the sort key now, so a position with invalid values, like a null ctime,
+            # is rejected instead of failing partway through the search.
+            if not all(value is None or isinstance(value, (str, int, float)) for value in after.values()):
+                raise misc.Error('invalid-request', 'Invalid cursor')
+            try:
+                after_key = sort_order_info['entry'](after)
+            except (TypeError, ValueError, AttributeError):
+                raise misc.Error('invalid-request', 'Invalid cursor')
+
+            keys = sort_order_info['index_keys']
+            index_after = keys, self.db.get_sort_key_values(after, keys)
+
         # Create the index search.
         if use_index:
             order = sort_order_info['index'] if sort_order_info else None
-            index_search_iter = self.db.search(paths=[str(path) for path in paths], order=order, **search_options)
+            index_search_iter = self.db.search(paths=[str(path) for path in paths], order=order, after=index_after, **search_options)
         else:
             index_search_iter = []
 
@@ -1025,7 +1737,7 @@ class Library:
                 # This is just a signal that the Windows search timed out.  We only enable timeouts
                 # for shuffled searches, in case they match tons of results.
                 return None
-            elif isinstance(result, os.DirEntry) or isinstance(result, windows_search.SearchDirEntry):
+            elif isinstance(result, os.PathLike):
                 # log.info('Search result from Windows:', result.path)
                 if result.path in seen_paths:
                     return
@@ -1056,7 +1768,7 @@ class Library:
                 if item is windows_search.SearchTimeout:
                     # This is ignored, so it doesn't matter where it goes.
                     return 0
-                elif isinstance(item, os.DirEntry) or isinstance(item, windows_search.SearchDirEntry):
+                elif isinstance(item, os.PathLike):
                     return not item.is_dir()
                 else:
                     return not item['is_directory']
@@ -1077,8 +1789,9 @@ class Library:
             # them at a time here.  This prevents us from keeping the Windows search queries
             # and SQLite transactions open indefinitely.  This doesn't do any of the slower
             # work of scanning files, just the file search.
-            windows_search_iter = misc.ThreadedQueue(windows_search_iter)
-            index_search_iter = misc.ThreadedQueue(index_search_iter)
+            if threaded:
+                windows_search_iter = misc.ThreadedQueue(windows_search_iter)
+                index_search_iter = misc.ThreadedQueue(index_search_iter)
 
             # get_results_from_search iterates through those and yield entries.
             def get_results_from_index():
@@ -1097,42 +1810,73 @@ class Library:
             search_results_iter = get_results_from_search()
             index_results_iter = get_results_from_index()
 
+            # Windows search can't start from a position, so if we're continuing a search,
+            # skip past the results we've already returned.  The index search is already
+            # starting in the right place.
+            if after is not None:
+                def is_before_after(entry):
+                    # Only compare with <, since that's all reverse_order_str supports.
+                    key = sort_order_info['entry'](entry)
+                    return not (key < after_key) if sort_order_info['reverse'] else not (after_key < key)
+
+                search_results_iter = itertools.dropwhile(is_before_after, search_results_iter)
+
             # If we're sorting, use heapq.merge to merge the two together.  Otherwise, just chain them.
             if sort_order_info:
                 final_search = heapq.merge(search_results_iter, index_results_iter, key=sort_order_info['entry'], reverse=sort_order_info['reverse'])
             else:
                 final_search = itertools.chain(search_results_iter, index_results_iter)
 
-        # Iterate over the final search, returning it in batches.
-        results = []
-        for entry in final_search:
-            if entry is None:
-                continue
+        # Compile the search filters once, rather than for each result.
+        matches_incomplete_entry = self.db.compile_search(incomplete=True, **search_options)
+        matches_entry = self.db.compile_search(**search_options)
 
-            # If this entry isn't populated, populate it now.
-            if not entry['populated']:
-                # We have a subset of data in the unpopulated entry.  It'll always have the
-                # filename, keyword, etc., and it may or may not have file-specific data like
-                # width and height.  Do an early filter based on what information we have.
+        def get_candidates():
+            for entry in final_search:
+                if entry is None:
+                    continue
+
+                # If this entry isn't populated, we have a subset of data in the unpopulated entry.
+                # It'll always have the filename, keyword, etc., and it may or may not have file-specific
+                # data like width and height.  Do an early filter based on what information we have.
                 # If the user searched for width and we know the width already, we can discard
                 # the result now and not waste time reading the full entry.  This makes some
                 # searches a lot faster.
-                if not self.db.entry_matches_search(entry, incomplete=True, **search_options):
+                if not entry['populated'] and not matches_incomplete_entry(entry):
                     # log.info('Early discarded search result that doesn\'t match: %s' % entry['path'])
                     continue
 
+                yield entry
+
+        def finish_entry(entry):
+            """
+            Populate and verify a search result.  This is run on the search thread pool.
+
+            Return (entry, update).  entry is the entry to return, or None to skip it.  update
+            is ('add', entry) or ('delete', path) if the index needs to be updated, which the
+            caller does in batches, so threads don't compete for the write lock.
+            """
+            update = None
+
+            # If this entry isn't populated, populate it now.
+            if not entry['populated']:
                 # Load the full entry.
-                path = open_path(entry['path'])
-                entry = self._get_entry(path)
+                path = entry['path']
+                entry = self._get_entry_from_path(open_path(path))
                 if entry is None:
-                    continue
+                    # The file doesn't exist on disk.  Delete the stale entry.
+                    return None, ('delete', path)
+
+                # Don't cache entries if there was an error scanning the file.
+                if entry.get('error') is None:
+                    update = ('add', entry)
 
                 # If the search only had a placeholder, it wasn't able to check the complete
                 # search.  For example, Windows index searching doesn't know if a GIF is animated.
                 # Re-check the result now that we have a populated entry.
-                if not self.db.entry_matches_search(entry, **search_options):
+                if not matches_entry(entry):
                     log.info('Discarded search result that doesn\'t match: %s' % entry['path'])
-                    continue
+                    return None, update
 
             # If we're verifying files, see if the file needs to be refreshed.
             if verify_files:
@@ -1140,27 +1884,83 @@ class Library:
                 if not self._entry_is_up_to_date(entry):
                     # The entry is stale or no longer exists, so refresh it.  If the file still
                     # exists we'll get the updated entry.
-                    # The cached entry is out of date, so refresh or delete it.
                     log.info('Refreshing stale entry: %s', entry['path'])
-                    path = open_path(entry['path'])
-                    entry = self._get_entry(path, force_refresh=True)
+                    path = entry['path']
+                    entry = self._get_entry_from_path(open_path(path))
+                    if entry is None:
+                        return None, ('delete', path)
+
+                    if entry.get('error') is None:
+                        update = ('add', entry)
+
+            return entry, update
+
+        # Populate and verify results concurrently, a window ahead of the results we're
+        # returning.  Populating means reading the file, which is slow if it's done for
+        # each result in turn.  Results are still returned in order.
+        finished_entries = _map_in_order(self._search_executor, finish_entry, get_candidates(),
+            window=max(batch_size, 1) if self.search_populate_window is None else self.search_populate_window)
+
+        entries_to_add = []
+        paths_to_delete = []
+        def update_index():
+            if entries_to_add:
+                # Add copies of the entries, since we've converted their paths, and give the
+                # new IDs back to the entries we returned.
+                self.db.add_records([copy for copy, entry in entries_to_add])
+                for copy, entry in entries_to_add:
+                    entry['id'] = copy['id']
+                entries_to_add.clear()
+            if paths_to_delete:
+                self.db.delete_recursively(paths_to_delete)
+                paths_to_delete.clear()
 
-            if entry is None:
-                continue
+        # Iterate over the final search, returning it in batches.
+        results = []
+        try:
+            for entry, update in finished_entries:
+                if update is not None:
+                    action, value = update
+                    if action == 'add':
+                        entries_to_add.append((dict(value), value))
+                    else:
+                        paths_to_delete.append(value)
 
-            self._convert_to_path(entry)
-            results.append(entry)
+                if entry is None:
+                    continue
 
-            # If we have a full batch, stop iterating and return it.
-            if len(results) >= batch_size:
-                # Yield this block of results.
-                yield results
-                results = []
+                self._convert_to_path(entry)
+                results.append(entry)
+
+                # If we have a full batch, stop iterating and return it.
+                if len(results) >= batch_size:
+                    # Save changes to the index before returning the batch.
+                    update_index()
+
+                    # Yield this block of results.
+                    yield results
+                    results = []
+        finally:
+            finished_entries.close()
+            update_index()
 
         # Yield any leftover results.
         if results:
             yield results
 
+    def get_search_position(self, entry, *, sort_order='normal'):
+        """
+        Return the fields of entry needed to continue a search after it, to pass to
+        search's after parameter.
+
+        Return None if the sort order can't be continued.
+        """
+        sort_order_info = _get_sort(sort_order) if sort_order != 'shuffle' else None
+        if sort_order_info is None or 'fields' not in sort_order_info:
+            return None
+
+        return { field: entry.get(field) for field in sort_order_info['fields'] }
+
     def get_all_bookmark_paths(self):
         """
         Return the paths for all bookmarks.
@@ -1234,6 +2034,113 @@ class Library:
     def get_all_bookmark_tags(self):
         return self.db.get_all_bookmark_tags()
 
+    def bookmark_batch(self, paths, operations):
+        """
+        Edit bookmarks for a list of files, returning { path: entry }.  The entry is None
+        if the file doesn't exist, or the exception if editing the file failed.  A failure
+        in one directory doesn't prevent other directories from being edited.
+
+        operations is a list of (action, tags), which are applied to each file in order:
+        - ('add', tags): bookmark the file if it isn't already, and add tags.
+        - ('remove', tags): remove tags.  This doesn't unbookmark the file.
+        - ('set', tags): bookmark the file with exactly these tags.
+        - ('delete', None): remove the bookmark.
+
+        This is like calling bookmark_edit or bookmark_remove for each file, but each
+        directory's metadata file is only saved once.  The index is updated in a single
+        transaction from the entries we already have, so files aren't read again.  Files
+        that aren't in the index yet get a placeholder entry.
+        """
+        for action, tags in operations:
+            if action not in ('add', 'remove', 'set', 'delete'):
+                raise misc.Error('invalid-request', 'Invalid bookmark action: %s' % action)
+
+        # Only edit each file once, even if it's listed more than once.
+        paths = list({ os.fspath(path): path for path in paths }.values())
+
+        results = {}
+        existing_entries = self.db.get_multi([os.fspath(path) for path in paths])
+        edit_paths = []
+        for path in paths:
+            if not path.exists():
+                results[os.fspath(path)] = None
+            else:
+                edit_paths.append(path)
+
+        now = math.floor(time.time())
+        def edit(path, file_metadata):
+            for action, tags in operations:
+                # Remove the bookmark, and the cached dimensions like bookmark_remove.
+                if action == 'delete':
+                    for key in ('bookmarked', 'bookmark_tags', 'bookmark_created_at', 'bookmark_updated_at', 'width', 'height'):
+                        file_metadata.pop(key, None)
+                    continue
+
+                # Removing tags from a file that isn't bookmarked doesn't do anything.
+                bookmarked = file_metadata.get('bookmarked', False)
+                if action == 'remove' and not bookmarked:
+                    continue
+
+                bookmark_tags = file_metadata.get('bookmark_tags', '').split() if bookmarked else []
+                if action == 'add':
+                    bookmark_tags += tags
+                elif action == 'remove':
+                    bookmark_tags = [tag for tag in bookmark_tags if tag not in tags]
+                elif action == 'set':
+                    bookmark_tags = list(tags)
+
+                # Set the created time if this is a new bookmark.  Unlike bookmark_edit, don't
+                # touch the updated time if nothing changed, so the metadata file isn't saved.
+                bookmark_tags = self.normalize_bookmark_tags(' '.join(bookmark_tags))
+                if not bookmarked or bookmark_tags != file_metadata.get('bookmark_tags'):
+                    file_metadata['bookmarked'] = True
+                    file_metadata.setdefault('bookmark_created_at', now)
+                    file_metadata['bookmark_updated_at'] = now
+                    file_metadata['bookmark_tags'] = bookmark_tags
+
+            # Cache the dimensions, like bookmark_edit, if we know them.
+            entry = existing_entries.get(os.fspath(path))
+            if file_metadata.get('bookmarked') and entry is not None and entry.get('width') is not None:
+                file_metadata['width'] = entry['width']
+                file_metadata['height'] = entry['height']
+
+        errors = metadata_storage.edit_files_metadata(edit_paths, edit)
+        for path, e in errors.items():
+            results[os.fspath(path)] = e
+
+        # Update the index with the new bookmark data.
+        entries = []
+        for path in edit_paths:
+            if os.fspath(path) in results:
+                continue
+
+            try:
+                entry = existing_entries.get(os.fspath(path))
+                if entry is not None:
+                    file_metadata = metadata_storage.load_file_metadata(path, return_copy=False)
+                    entry.update(self._get_bookmark_fields(path, file_metadata))
+                else:
+                    entry = self._get_entry_from_path(path, populate=False)
+            except Exception as e:
+                log.exception('Error updating bookmark for %s' % path)
+                results[os.fspath(path)] = e
+                continue
+
+            if entry is None:
+                results[os.fspath(path)] = None
+                continue
+
+            entries.append(entry)
+            results[os.fspath(path)] = entry
+
+        with self.db.connect(write=True) as conn:
+            self.db.add_records(entries, conn=conn)
+
+        for entry in entries:
+            self._convert_to_path(entry)
+
+        return results
+
     def batch_rename_tag(self, from_tag, to_tag, paths=None, max_edits=100):
         # Stop if we're not changing anything.
         if from_tag == to_tag:
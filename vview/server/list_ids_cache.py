@@ -0,0 +1,94 @@
+import collections, logging, os, threading
+
+log = logging.getLogger(__name__)
+
+class ListIdsCache:
+    """
+    A cache of Library.list_ids results.
+
+    Listing the IDs in a large directory reads and sorts the whole directory, and the client
+    asks for them often to navigate.  Results are cached by directory and sort order, along
+    with the directory's mtime, so they're discarded when files in the directory are added,
+    removed or renamed.  Checking the cache only needs a stat of the directory.
+
+    Recently used results are kept in memory.  Results for large directories are also stored
+    in the database, so they survive restarts.
+    """
+    def __init__(self, db, *, max_entries=32, max_stored_entries=100, min_stored_ids=1000):
+        """
+        max_entries is the number of results to keep in memory, and max_stored_entries is the
+        number to keep in the database.  Results with fewer than min_stored_ids IDs are quick
+        to recreate, so they're only kept in memory.
+        """
+        self.db = db
+        self.max_entries = max_entries
+        self.max_stored_entries = max_stored_entries
+        self.min_stored_ids = min_stored_ids
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+        # Statistics.
+        self.hits = 0
+        self.stored_hits = 0
+        self.misses = 0
+
+    @classmethod
+    def _get_key(cls, sort_order, prefix):
+        return f'ids:{sort_order}:{prefix}'
+
+    def get(self, path, *, sort_order, prefix, mtime):
+        """
+        Return the cached IDs for path, or None if they're not cached or path has changed.
+
+        prefix is the media ID prefix of files in the directory, since IDs change if the
+        directory is mounted differently.  mtime is the directory's current mtime.
+        """
+        path = os.fspath(path)
+        key = self._get_key(sort_order, prefix)
+        with self._lock:
+            cached = self._entries.get((path, key))
+            if cached is not None and cached[0] == mtime:
+                self._entries.move_to_end((path, key))
+                self.hits += 1
+                return list(cached[1])
+
+        stored = self.db.get_listing_cache(path, key)
+        if stored is not None and stored[0] == mtime:
+            ids = stored[1]
+            with self._lock:
+                self.stored_hits += 1
+            self._add(path, key, mtime, ids)
+            return list(ids)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, path, ids, *, sort_order, prefix, mtime):
+        """
+        Cache the IDs for path, when its mtime was mtime.
+        """
+        path = os.fspath(path)
+        key = self._get_key(sort_order, prefix)
+        self._add(path, key, mtime, ids)
+
+        if len(ids) >= self.min_stored_ids:
+            self.db.set_listing_cache(path, key, mtime, ids, max_entries=self.max_stored_entries)
+
+    def _add(self, path, key, mtime, ids):
+        with self._lock:
+            self._entries[(path, key)] = (mtime, tuple(ids))
+            self._entries.move_to_end((path, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Clear the in-memory cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __str__(self):
+        return '%i hits, %i stored hits, %i misses' % (self.hits, self.stored_hits, self.misses)
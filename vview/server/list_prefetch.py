@@ -0,0 +1,122 @@
+import asyncio, logging
+
+log = logging.getLogger(__name__)
+
+class ListPrefetcher:
+    """
+    Read the next page of paginated /list results in the background.
+
+    api_list parks the generator for a search after returning a page, and normally only
+    reads the next page when the client asks for it, so every page boundary waits for
+    the next page to be populated.  With prefetching, the next page is read as soon as a
+    page is returned, so it's usually ready by the time the client scrolls to it.
+
+    Prefetching uses a thread per page, so each user can only have max_pages_per_user
+    pages being prefetched at a time.  Pages beyond that are read on request as usual.
+    A page stops counting once it's been read, so pages that are never requested don't
+    hold on to the budget until they're evicted from the cache.
+    """
+    def __init__(self, *, max_pages_per_user=2):
+        self.max_pages_per_user = max_pages_per_user
+
+        # The number of prefetched pages each user has, by username.
+        self._pages_by_user = {}
+
+        # Statistics.
+        self.started = 0
+        self.skipped = 0
+
+    def start(self, generator, *, user):
+        """
+        Start reading the next page from a paginated request generator.  Return a PrefetchedPage,
+        or None if user has no budget left.
+        """
+        count = self._pages_by_user.get(user, 0)
+        if count >= self.max_pages_per_user:
+            self.skipped += 1
+            return None
+
+        self.started += 1
+        self._pages_by_user[user] = count + 1
+        return PrefetchedPage(generator, on_release=lambda: self._release(user))
+
+    def _release(self, user):
+        count = self._pages_by_user[user] - 1
+        if count:
+            self._pages_by_user[user] = count
+        else:
+            del self._pages_by_user[user]
+
+    def __str__(self):
+        return '%i pages prefetched, %i skipped, %i in use' % (self.started, self.skipped, sum(self._pages_by_user.values()))
+
+class PrefetchedPage:
+    """
+    A page being read from a paginated request generator in the background.
+    """
+    def __init__(self, generator, *, on_release):
+        self.generator = generator
+        self._on_release = on_release
+        self._cancelled = False
+
+        self._future = asyncio.ensure_future(asyncio.to_thread(self._read))
+        self._future.add_done_callback(self._read_finished)
+
+    def _read(self):
+        try:
+            return next(self.generator)
+        except StopIteration:
+            # Request generators never stop on their own.  Don't let StopIteration escape
+            # into the future.
+            raise RuntimeError('Request generator stopped')
+
+    def _read_finished(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            log.error('Error prefetching page', exc_info=future.exception())
+
+        self._release()
+
+        # If we were cancelled while the page was being read, the generator couldn't be
+        # closed, since it was running.  Close it now.
+        if self._cancelled:
+            self.generator.close()
+
+    def _release(self):
+        if self._on_release is not None:
+            self._on_release()
+            self._on_release = None
+
+    async def get(self):
+        """
+        Wait for the page to be read, and return it.
+
+        If the prefetch was cancelled, the generator has been closed and can't be used
+        to continue the search, so return None.  This can happen while we're waiting,
+        if the search is evicted from the cache.
+        """
+        if self._cancelled:
+            return None
+
+        # Shield the read, so if the request is cancelled, the page is still read and
+        # another call can return it.
+        result = await asyncio.shield(self._future)
+        if self._cancelled:
+            return None
+
+        return result
+
+    def cancel(self):
+        """
+        Cancel the prefetch and close the generator.
+
+        The thread reading the page can't be interrupted, so if it's still running, the
+        generator is closed when it finishes.
+        """
+        if self._cancelled:
+            return
+
+        self._cancelled = True
+        self._release()
+
+        if self._future.done():
+            self.generator.close()
@@ -1,5 +1,7 @@
-import copy, json, os, threading, logging
+import copy, json, os, threading, logging, time
+from collections import OrderedDict
 from contextlib import contextmanager
+from types import MappingProxyType
 from ..util import win32
 from ..util.paths import open_path
 from pprint import pprint
@@ -8,15 +10,185 @@ log = logging.getLogger(__name__)
 
 metadata_filename = '.vview.txt'
 
-# A mapping from metadata filenames to their contents.
-#
-# Note that we always deep copy these objects before returning them to callers.
-_metadata_cache = {}
+class _CacheEntry:
+    __slots__ = ('mtime', 'size', 'data', 'validated_at')
 
-# This is held while accessing _metadata_cache or doing any operations on
-# metadata files.
+    def __init__(self, mtime, size, data, validated_at):
+        self.mtime = mtime
+        self.size = size
+        self.data = data
+        self.validated_at = validated_at
+
+class _MetadataCache:
+    """
+    A size-bounded LRU cache of parsed metadata files.
+
+    Entries are keyed by the metadata file's path, and remember the file's mtime and size
+    when it was read, so files edited outside of vview are read again.  To avoid a stat for
+    every lookup, entries are only checked against the file once every revalidate_interval
+    seconds.  Files that don't exist are cached with an mtime of None.
+
+    Cached data is never modified.  It's stored as a read-only mapping, and saving metadata
+    replaces the entry instead of changing it, so readers can use it without copying it.
+    """
+    def __init__(self, *, max_entries=10000, revalidate_interval=1):
+        self.max_entries = max_entries
+        self.revalidate_interval = revalidate_interval
+        self._entries = OrderedDict()
+
+        # Statistics.
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path):
+        """
+        Return (data, entry) for a metadata file.
+
+        If the entry is up to date, data is its cached data.  If it's due to be checked
+        against the file, data is None, and the caller should stat the file and call
+        check(path, entry, stat).  If the file isn't cached, both are None.
+        """
+        entry = self._entries.get(path)
+        if entry is None:
+            self.misses += 1
+            return None, None
+
+        if time.monotonic() - entry.validated_at >= self.revalidate_interval:
+            return None, entry
+
+        self._entries.move_to_end(path)
+        self.hits += 1
+        return entry.data, entry
+
+    def check(self, path, entry, stat):
+        """
+        Finish checking an entry returned by get() against the file.  stat is (mtime, size)
+        from _stat_metadata_file.  Return the cached data if the file hasn't changed, or
+        None if it has and the file needs to be read again.
+
+        The file is stat'd without holding the cache's lock, so the entry may have been
+        replaced or evicted in the meantime.  If so, this also returns None.
+        """
+        if self._entries.get(path) is not entry:
+            self.misses += 1
+            return None
+
+        if stat != (entry.mtime, entry.size):
+            del self._entries[path]
+            self.misses += 1
+            return None
+
+        entry.validated_at = time.monotonic()
+        self._entries.move_to_end(path)
+        self.hits += 1
+        return entry.data
+
+    def set(self, path, stat, data):
+        """
+        Cache data for a metadata file, and return the read-only cached data.  stat is
+        (mtime, size) from _stat_metadata_file, from before the file was read or after it
+        was written.  data belongs to the cache once this is called.
+        """
+        mtime, size = stat
+        entry = _CacheEntry(mtime, size, MappingProxyType(data), time.monotonic())
+        self._entries[path] = entry
+        self._entries.move_to_end(path)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+        return entry.data
+
+    def clear(self):
+        self._entries.clear()
+
+    def get_stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+def _stat_metadata_file(path):
+    """
+    Return (mtime, size) for a metadata file, or (None, None) if it doesn't exist.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None, None
+
+    return stat.st_mtime, stat.st_size
+
+# Parsed metadata files, by path.
+_metadata_cache = _MetadataCache()
+
+# Metadata saved with write-behind that hasn't been written yet, by metadata file path.
+# This is newer than the file, so it's used instead of _metadata_cache.  Like cached data,
+# it's read-only.
+_pending_writes = {}
+
+# The write journal, if write-behind is enabled.  See open_journal.
+_journal = None
+
+# Functions to call after a metadata file is written.  See add_write_listener.
+_write_listeners = []
+
+# This is held while accessing _metadata_cache, _pending_writes, _directory_locks,
+# _journal and _write_listeners, and is only held briefly.  Reading and writing metadata files is locked
+# per directory with _lock_directory.
 _metadata_lock = threading.RLock()
 
+# Locks for metadata files that are in use, by path.  Each value is [lock, users], and
+# locks are removed when they have no users.
+_directory_locks = {}
+
+@contextmanager
+def _lock_directory(this_metadata_filename):
+    """
+    Lock a metadata file while reading or writing it.  This lets different directories
+    be used at the same time.
+    """
+    with _metadata_lock:
+        lock_info = _directory_locks.setdefault(this_metadata_filename, [threading.RLock(), 0])
+        lock_info[1] += 1
+
+    try:
+        with lock_info[0]:
+            yield
+    finally:
+        with _metadata_lock:
+            lock_info[1] -= 1
+            if lock_info[1] == 0:
+                del _directory_locks[this_metadata_filename]
+
+def add_write_listener(func):
+    """
+    Call func(metadata_file) on any thread after a metadata file is written or deleted.
+
+    With write-behind, saving metadata doesn't write the file immediately, so anything
+    that needs to know about the file on disk, like its mtime, should use this instead
+    of looking at the file after saving.
+    """
+    with _metadata_lock:
+        _write_listeners.append(func)
+
+def remove_write_listener(func):
+    with _metadata_lock:
+        _write_listeners.remove(func)
+
+def get_cache_stats():
+    """
+    Return a dictionary of statistics for the metadata cache.
+    """
+    with _metadata_lock:
+        return _metadata_cache.get_stats() | {
+            'pending_writes': len(_pending_writes),
+        }
+
 def load_directory_metadata(directory_path, return_copy=True):
     """
     Get stored metadata for files in path.  This currently only stores bookmarks.
@@ -36,19 +208,44 @@ def load_directory_metadata(directory_path, return_copy=True):
     a file extension that it indexes by default (we use .txt), and we can insert
     keywords in the file that we can search for.  Windows Search will index metadata
     for some file types, but it's hit-or-miss (it handles JPEGs much better than PNGs).
+
+    If return_copy is false, the result is read-only and shared with the cache.
     """
+    this_metadata_filename = os.fspath(directory_path / metadata_filename)
+    with _lock_directory(this_metadata_filename):
+        return _load_directory_metadata_locked(this_metadata_filename, return_copy=return_copy)
+
+def _load_directory_metadata_locked(this_metadata_filename, *, return_copy=True):
+    entry = None
     with _metadata_lock:
-        return _load_directory_metadata_locked(directory_path, return_copy=return_copy)
+        result = _pending_writes.get(this_metadata_filename)
+        if result is None:
+            result, entry = _metadata_cache.get(this_metadata_filename)
 
-def _load_directory_metadata_locked(directory_path, *, return_copy=True):
-    try:
-        this_metadata_filename = os.fspath(directory_path / metadata_filename)
-        result = _metadata_cache.get(this_metadata_filename)
-        if result is not None:
-            if return_copy:
-                result = copy.deepcopy(result)
-            return result
+    # If the cache entry needs to be checked against the file, stat it without holding
+    # _metadata_lock, so a slow stat doesn't block other directories.
+    if result is None and entry is not None:
+        stat = _stat_metadata_file(this_metadata_filename)
+        with _metadata_lock:
+            result = _metadata_cache.check(this_metadata_filename, entry, stat)
+
+    if result is None:
+        result = _read_metadata_file(this_metadata_filename)
+
+    # The cached data is read-only.  Only copy it if the caller wants to modify it.
+    if return_copy:
+        result = copy.deepcopy(dict(result))
+    return result
+
+def _read_metadata_file(this_metadata_filename):
+    """
+    Read and cache a metadata file, returning its data.
+    """
+    # Stat the file before reading it, so if it changes while we're reading it, the cache
+    # will see that it's changed.
+    stat = _stat_metadata_file(this_metadata_filename)
 
+    try:
         with open(this_metadata_filename, 'rt', encoding='utf-8') as f:
             data = f.read()
             try:
@@ -61,63 +258,330 @@ def _load_directory_metadata_locked(directory_path, *, return_copy=True):
             if not isinstance(result, dict):
                 log.warn('Metadata file %s is corrupt: data isn\'t a dictionary' % this_metadata_filename)
                 result = { }
-
-            _metadata_cache[this_metadata_filename] = result
-            return result
     except FileNotFoundError:
-        _metadata_cache[this_metadata_filename] = { }
-        return { }
+        result = { }
     except json.decoder.JSONDecodeError as e:
         log.warn('Error reading metadata from %s: %s' % (this_metadata_filename, e))
-        _metadata_cache[this_metadata_filename] = { }
-        return { }
+        result = { }
+
+    with _metadata_lock:
+        return _metadata_cache.set(this_metadata_filename, stat, result)
 
 def save_directory_metadata(directory_path, data):
+    """
+    Save metadata for files in directory_path, and return the path to the metadata file.
+    The metadata file is deleted if data is empty.
+    """
+    this_metadata_filename = os.fspath(directory_path / metadata_filename)
+    with _lock_directory(this_metadata_filename):
+        # The cache keeps data, so copy it in case the caller modifies it later.
+        data = copy.deepcopy(data)
+        _store_directory_metadata(this_metadata_filename, data, [{ 'path': this_metadata_filename, 'directory': data }])
+
+    return open_path(this_metadata_filename)
+
+def _store_directory_metadata(this_metadata_filename, data, journal_records):
+    """
+    Save new metadata for a directory.  data is cached, so it must not be modified after
+    this is called.
+
+    If write-behind is enabled, journal_records are written to the journal, and the file
+    is written on the next flush.  Otherwise, the file is written now.
+    """
     with _metadata_lock:
-        return _save_directory_metadata_locked(directory_path, data)
+        journal = _journal
+
+    if journal is not None and journal.append(journal_records):
+        with _metadata_lock:
+            _pending_writes[this_metadata_filename] = MappingProxyType(data)
+        return
+
+    _write_directory_metadata(this_metadata_filename, data)
 
-def _save_directory_metadata_locked(directory_path, data):
-    this_metadata_filename = directory_path / metadata_filename
+def _write_directory_metadata(this_metadata_filename, data):
+    """
+    Write a metadata file.  The directory must be locked with _lock_directory.
+    """
     this_metadata_filename = open_path(this_metadata_filename)
 
     # If there's no data, delete the metadata file if it exists.
     if not data:
         this_metadata_filename.unlink(missing_ok=True)
+        stat = (None, None)
+    else:
+        json_data = json.dumps({
+            'identifier': 'vviewmetadatafile',
+            'version': 1,
+            'data': data,
+        }, indent=4, ensure_ascii=False) + '\n'
+
+        # Write the new metadata to a temporary file.
+        temp_metadata_filename = this_metadata_filename.with_suffix('.temp')
+        with open(temp_metadata_filename, 'w+t', encoding='utf-8') as f:
+            f.write(json_data)
+
+        # If the file is hidden, Windows won't let us overwrite it, which doesn't
+        # make much sense.  We have to open it for writing (but not overwrite) and
+        # unset the hidden bit.
+        try:
+            with this_metadata_filename.open('r+t', shared=False) as f:
+                win32.set_file_hidden(f, hide=False)
+        except FileNotFoundError:
+            pass
+
+        # Overwrite the metadata file with the new one.
+        temp_metadata_filename.replace(this_metadata_filename)
+
+        # Hide the file so we don't clutter the user's directory if possible.
+        with this_metadata_filename.open('r+t', shared=False) as f:
+            win32.set_file_hidden(f, hide=True)
 
-        if os.fspath(this_metadata_filename) in _metadata_cache:
-            del _metadata_cache[os.fspath(this_metadata_filename)]
-        return
+        stat = _stat_metadata_file(this_metadata_filename)
 
-    data = {
-        'identifier': 'vviewmetadatafile',
-        'version': 1,
-        'data': data,
-    }
-    json_data = json.dumps(data, indent=4, ensure_ascii=False) + '\n'
-
-    # Write the new metadata to a temporary file.
-    temp_metadata_filename = this_metadata_filename.with_suffix('.temp')
-    with open(temp_metadata_filename, 'w+t', encoding='utf-8') as f:
-        f.write(json_data)
-
-    # If the file is hidden, Windows won't let us overwrite it, which doesn't
-    # make much sense.  We have to open it for writing (but not overwrite) and
-    # unset the hidden bit.
-    try:
-        with this_metadata_filename.open('r+t', shared=False) as f:
-            win32.set_file_hidden(f, hide=False)
-    except FileNotFoundError:
-        pass
+    # Only update our cache once we've successfully written the new data.  This is the
+    # newest data for the directory, so anything waiting to be written is replaced.
+    with _metadata_lock:
+        _metadata_cache.set(os.fspath(this_metadata_filename), stat, data)
+        _pending_writes.pop(os.fspath(this_metadata_filename), None)
+        listeners = list(_write_listeners)
+
+    for listener in listeners:
+        try:
+            listener(this_metadata_filename)
+        except Exception:
+            log.exception('Error in metadata write listener for %s' % this_metadata_filename)
+
+class _WriteJournal:
+    """
+    Write-behind for metadata files.
+
+    Saving metadata for a file normally rewrites the whole metadata file for its directory,
+    so editing many files in a directory, like renaming a tag, rewrites the same file over
+    and over.  With the journal, each edit is appended to the journal file and kept in
+    _pending_writes, and directories with edits are written once every flush_interval
+    seconds, however many edits they had.
+
+    If we exit without flushing, the journal is replayed the next time it's opened.  Before
+    each flush, the journal is moved aside and a new one is started for edits made during
+    the flush, and the old one is deleted once everything in it has been written.  Edits
+    set values rather than changing them, so replaying edits that were already written is
+    harmless.
+
+    The journal is flushed after each edit but not fsynced, so it protects against the
+    process exiting or crashing, but edits from the last few seconds can be lost if the
+    system loses power.  This is the same as writing metadata files directly, which
+    aren't fsynced either.
+    """
+    def __init__(self, path, *, flush_interval=1):
+        self.path = os.fspath(path)
+        self.flushing_path = self.path + '.flushing'
+        self.flush_interval = flush_interval
+
+        # Metadata files with edits that haven't been flushed.
+        self._dirty = set()
+        self._closed = False
+        self._condition = threading.Condition()
+
+        # This is held while flushing, so only one flush runs at a time.
+        self._flush_lock = threading.Lock()
+
+        # Statistics.
+        self.edits = 0
+        self.writes = 0
+
+        self._replay()
+
+        self._file = open(self.path, 'at', encoding='utf-8')
+        self._thread = threading.Thread(target=self._run, name='MetadataJournal', daemon=True)
+        self._thread.start()
+
+    def _replay(self):
+        """
+        Write edits left in the journal by a previous run.
+        """
+        records = []
+        for path in (self.flushing_path, self.path):
+            try:
+                f = open(path, 'rt', encoding='utf-8')
+            except FileNotFoundError:
+                continue
+
+            with f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # The last line might be incomplete if we exited while writing it.
+                        log.warn('Ignoring incomplete metadata journal entry in %s' % path)
+
+        records_by_path = {}
+        for record in records:
+            records_by_path.setdefault(record['path'], []).append(record)
+
+        # Apply each directory's edits to the file in order, and write it.
+        for path, path_records in records_by_path.items():
+            with _lock_directory(path):
+                data = dict(_load_directory_metadata_locked(path, return_copy=False))
+                for record in path_records:
+                    if 'directory' in record:
+                        data = dict(record['directory'])
+                    elif record['data']:
+                        data[record['file']] = record['data']
+                    else:
+                        data.pop(record['file'], None)
+
+                try:
+                    _write_directory_metadata(path, data)
+                except OSError as e:
+                    log.error('Couldn\'t write metadata file %s from the journal: %s' % (path, e))
+
+        if records:
+            log.info('Replayed %i metadata edits for %i directories from the journal' % (len(records), len(records_by_path)))
+
+        for path in (self.flushing_path, self.path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def append(self, records):
+        """
+        Add edits to the journal.  Each record has the metadata file's path, and either a
+        file and data for editing a file's metadata, or directory for replacing the whole
+        directory's.
+
+        Return false if the journal is closed, in which case the caller should write the
+        file itself.
+        """
+        with self._condition:
+            if self._closed:
+                return False
+
+            # Flush so the edit survives us crashing.  This doesn't fsync, since that would
+            # make every edit wait for the disk.  See the class comment.
+            self._file.write(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records))
+            self._file.flush()
+            self._dirty.update(record['path'] for record in records)
+            self.edits += len(records)
+            self._condition.notify()
+            return True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                # Wait for an edit, then give more edits a chance to arrive so they're
+                # written together.
+                self._condition.wait_for(lambda: self._dirty or self._closed)
+                self._condition.wait_for(lambda: self._closed, timeout=self.flush_interval)
+                if self._closed:
+                    return
+
+            try:
+                self.flush()
+            except Exception as e:
+                log.exception('Error flushing metadata journal')
+
+    def flush(self):
+        """
+        Write every directory with pending edits.
+        """
+        with self._flush_lock:
+            # Move the journal aside and start a new one for edits made while we're writing.
+            with self._condition:
+                if not self._dirty:
+                    return
+
+                dirty, self._dirty = self._dirty, set()
+                self._file.close()
+                os.replace(self.path, self.flushing_path)
+                self._file = open(self.path, 'at', encoding='utf-8')
+
+            keep_journal = False
+            for path in sorted(dirty):
+                if not self._write_pending(path):
+                    keep_journal = True
+
+            # Everything in the old journal has been written, so it can be deleted.  If
+            # something couldn't be written and couldn't be added to the new journal, keep
+            # it so it's replayed next time.
+            if not keep_journal:
+                os.unlink(self.flushing_path)
+
+    def _write_pending(self, path):
+        """
+        Write pending edits for a metadata file.  If it fails, add the edits to the new
+        journal, so they're written on the next flush.  Return false if that fails too.
+        """
+        with _lock_directory(path):
+            with _metadata_lock:
+                data = _pending_writes.get(path)
+
+            # Stop if the file has already been written.
+            if data is None:
+                return True
+
+            try:
+                _write_directory_metadata(path, dict(data))
+                self.writes += 1
+                return True
+            except OSError as e:
+                log.error('Couldn\'t write metadata file %s: %s' % (path, e))
+                return self.append([{ 'path': path, 'directory': dict(data) }])
+
+    def close(self):
+        """
+        Stop the journal, writing any pending edits.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+        self._thread.join()
+        self.flush()
+
+        self._file.close()
+        os.unlink(self.path)
+
+    def __str__(self):
+        return '%i metadata edits, %i files written' % (self.edits, self.writes)
+
+def open_journal(journal_path, *, flush_interval=1):
+    """
+    Enable write-behind for metadata files, journaling edits to journal_path.
+
+    Edits are visible to readers immediately, but metadata files are only written every
+    flush_interval seconds, so many edits to the same directory only write it once.  If
+    the journal has edits from a previous run that weren't written, they're written now.
+    The journal survives the process crashing, but not a power loss.
+    """
+    global _journal
+    close_journal()
+
+    journal = _WriteJournal(journal_path, flush_interval=flush_interval)
+    with _metadata_lock:
+        _journal = journal
+
+def close_journal():
+    """
+    Write any pending edits and disable write-behind.
+    """
+    global _journal
+    with _metadata_lock:
+        journal, _journal = _journal, None
 
-    # Overwrite the metadata file with the new one.
-    temp_metadata_filename.replace(this_metadata_filename)
+    if journal is not None:
+        journal.close()
+        log.info('Closed metadata journal: %s' % journal)
 
-    # Hide the file so we don't clutter the user's directory if possible.
-    with this_metadata_filename.open('r+t', shared=False) as f:
-        win32.set_file_hidden(f, hide=True)
+def flush():
+    """
+    If write-behind is enabled, write pending edits now.
+    """
+    with _metadata_lock:
+        journal = _journal
 
-    # Only update our cache once we've successfully written the new data.
-    _metadata_cache[os.fspath(this_metadata_filename)] = copy.deepcopy(data.get('data', { }))
+    if journal is not None:
+        journal.flush()
 
 def _directory_path_for_file(path):
     """
@@ -143,24 +607,27 @@ def load_file_metadata(path, *, return_copy=True):
     If metadata for the parent directory has already been loaded with
     load_directory_metadata, it can be specified with directory_metadata
     to avoid loading it repeatedly while scanning directories.
+
+    If return_copy is false, the result is read-only and shared with the cache, which
+    avoids copying it if the caller doesn't need to modify it.
     """
-    with _metadata_lock:
-        return _load_file_metadata_locked(path, return_copy=return_copy)
+    return _load_file_metadata(path, return_copy=return_copy)
 
 @contextmanager
 def load_and_lock_file_metadata(path):
     """
-    Yield the metadata for path, locking all metadata until the context manager
-    completes.
+    Yield the metadata for path, locking metadata for its directory until the context
+    manager completes.
 
     This is used for writing metadata.  The caller should call save_file_metadata
     before exiting the context manager.
     """
-    with _metadata_lock:
-        result = _load_file_metadata_locked(path)
+    directory_path, _ = _directory_path_for_file(path)
+    with _lock_directory(os.fspath(directory_path / metadata_filename)):
+        result = _load_file_metadata(path)
         yield result
 
-def _load_file_metadata_locked(path, *, return_copy=True):
+def _load_file_metadata(path, *, return_copy=True):
     # Do the copy here if return_copy is true instead of having load_directory_metadata
     # do it, so we only deep copy the file we're returning and not the entire directory.
     directory_path, filename = _directory_path_for_file(path)
@@ -173,6 +640,8 @@ def _load_file_metadata_locked(path, *, return_copy=True):
 
     if return_copy:
         result = copy.deepcopy(result)
+    else:
+        result = MappingProxyType(result)
 
     return result
 
@@ -183,23 +652,90 @@ def has_file_metadata(path):
     return len(load_file_metadata(path, return_copy=False)) != 0
 
 def save_file_metadata(path, data):
-    with _metadata_lock:
-        return _save_file_metadata_locked(path, data)
-
-def _save_file_metadata_locked(path, data):
+    """
+    Save metadata for path, and return the path to the metadata file it was saved in.
+    """
     directory_path, filename = _directory_path_for_file(path)
+    this_metadata_filename = os.fspath(directory_path / metadata_filename)
+    with _lock_directory(this_metadata_filename):
+        # Make a new dictionary for the directory with this file replaced.  The data for
+        # other files isn't modified, so it's shared with the cached data and not copied.
+        directory_metadata = dict(_load_directory_metadata_locked(this_metadata_filename, return_copy=False))
+
+        # If data is empty, remove this record.
+        data = copy.deepcopy(data)
+        if not data:
+            if str(filename) in directory_metadata:
+                del directory_metadata[str(filename)]
+        else:
+            directory_metadata[str(filename)] = data
+
+        _store_directory_metadata(this_metadata_filename, directory_metadata, [{
+            'path': this_metadata_filename,
+            'file': str(filename),
+            'data': data,
+        }])
+
+    return open_path(this_metadata_filename)
+
+def edit_files_metadata(paths, edit):
+    """
+    Edit metadata for a list of files, saving each directory's metadata file once.
 
-    # Read the full metadata so we can replace this file.
-    directory_metadata = load_directory_metadata(directory_path)
+    edit(path, data) is called for each path with a copy of its metadata, and modifies
+    it in place.  Each directory's metadata is locked while its files are edited.
+    Directories whose metadata didn't change aren't saved.
 
-    # If data is empty, remove this record.
-    if not data:
-        if str(filename) in directory_metadata:
-            del directory_metadata[str(filename)]
-    else:
-        directory_metadata[str(filename)] = data
+    If editing or saving a directory fails, the other directories are still saved.  Return
+    { path: exception } for the files in directories that failed.
+    """
+    # Group the files by the metadata file they're stored in.
+    files_by_metadata_file = {}
+    for path in paths:
+        directory_path, filename = _directory_path_for_file(path)
+        this_metadata_filename = os.fspath(directory_path / metadata_filename)
+        files_by_metadata_file.setdefault(this_metadata_filename, []).append((path, str(filename)))
+
+    errors = {}
+    for this_metadata_filename, files in files_by_metadata_file.items():
+        try:
+            _edit_directory_metadata(this_metadata_filename, files, edit)
+        except Exception as e:
+            log.exception('Error editing metadata in %s' % this_metadata_filename)
+            for path, filename in files:
+                errors[path] = e
+
+    return errors
+
+def _edit_directory_metadata(this_metadata_filename, files, edit):
+    """
+    Edit metadata for files in one directory for edit_files_metadata.  files is a list
+    of (path, filename).
+    """
+    with _lock_directory(this_metadata_filename):
+        directory_metadata = dict(_load_directory_metadata_locked(this_metadata_filename, return_copy=False))
+
+        journal_records = []
+        for path, filename in files:
+            old_data = directory_metadata.get(filename, {})
+            if not isinstance(old_data, dict):
+                log.warn('Metadata for %s is corrupt' % path)
+                old_data = {}
+
+            data = copy.deepcopy(old_data)
+            edit(path, data)
+            if data == old_data:
+                continue
 
-    _save_directory_metadata_locked(directory_path, directory_metadata)
+            if data:
+                directory_metadata[filename] = data
+            else:
+                directory_metadata.pop(filename, None)
+
+            journal_records.append({ 'path': this_metadata_filename, 'file': filename, 'data': data })
+
+        if journal_records:
+            _store_directory_metadata(this_metadata_filename, directory_metadata, journal_records)
 
 def get_files_with_metadata(metadata_path):
     """
@@ -208,7 +744,7 @@ def get_files_with_metadata(metadata_path):
     """
     assert metadata_path.name == metadata_filename
     directory_path = metadata_path.parent
-    directory_metadata = load_directory_metadata(directory_path)
+    directory_metadata = load_directory_metadata(directory_path, return_copy=False)
 
     return [open_path(directory_path / filename) for filename in directory_metadata.keys()]
 
@@ -0,0 +1,267 @@
+import asyncio, logging, os, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+from ..util.paths import open_path
+from ..util.threaded_tasks import AsyncTask
+
+log = logging.getLogger(__name__)
+
+class PopulateEngine:
+    """
+    Populate unpopulated index entries in the background.
+
+    Refreshes store unpopulated placeholder entries, since reading every bookmarked file
+    would make refreshes very slow.  Without this, they're populated when a search returns
+    them, which makes the first search after a refresh slow.
+
+    The queue is the unpopulated entries in the index, so it persists across restarts.
+    Entries are read in ID order, and the last ID we finished is checkpointed to the
+    database, so we continue where we left off after a restart and don't retry files that
+    couldn't be populated until we start a new pass.
+
+    Directories being browsed are populated first (see prioritize).  Other work pauses
+    while the server is handling requests, so we don't slow down the UI.
+
+    This also adds the contents of browsed directories to the index (see index_directories),
+    so they can be listed from the index next time.
+    """
+    def __init__(self, library, *, workers=4, batch_size=50, idle_time=2, max_priority_paths=4):
+        """
+        idle_time is how long it's been since the last request before we'll do
+        non-priority work.
+        """
+        self.library = library
+        self.workers = workers
+        self.batch_size = batch_size
+        self.idle_time = idle_time
+        self.max_priority_paths = max_priority_paths
+
+        self._lock = threading.Lock()
+        self._priority_paths = []
+        self._directories_to_index = []
+        self._last_request_at = 0
+
+        # This is set when there may be new work.  It belongs to run()'s event loop, and
+        # is set from other threads with _wake.
+        self._loop = None
+        self._wake_event = None
+
+        # Statistics.
+        self.populated = 0
+        self.failed = 0
+
+    @property
+    def db(self):
+        return self.library.db
+
+    def request_started(self):
+        """
+        This is called when the server starts handling a request.
+        """
+        self._last_request_at = time.time()
+
+    def prioritize(self, paths):
+        """
+        Populate entries inside paths before anything else.
+
+        This is called when directories are browsed, so their entries are populated
+        before they're requested.  Only the most recent few paths are remembered.
+        """
+        paths = [os.fspath(path) for path in paths]
+        with self._lock:
+            for path in paths:
+                # Move the path to the end if it's already in the list.  This is a [path, after_id]
+                # pair, so we don't retry entries that failed.
+                self._priority_paths = [item for item in self._priority_paths if item[0] != path]
+                self._priority_paths.append([path, 0])
+            del self._priority_paths[:-self.max_priority_paths]
+
+        self._wake()
+
+    def index_directories(self, paths):
+        """
+        Add everything inside paths to the index, then populate them.  This is called
+        when directories are listed that aren't in the index.  See Library._index_directory.
+        """
+        with self._lock:
+            for path in paths:
+                if path not in self._directories_to_index:
+                    self._directories_to_index.append(path)
+
+        self._wake()
+
+    def wake(self):
+        """
+        Check for new unpopulated entries, such as after a refresh.
+        """
+        self._wake()
+
+    def _wake(self):
+        """
+        Wake up run() if it's waiting for work.  This can be called from any thread.
+        """
+        loop = self._loop
+        if loop is None:
+            return
+
+        try:
+            loop.call_soon_threadsafe(self._wake_event.set)
+        except RuntimeError:
+            # The loop has closed, so run() has exited.
+            pass
+
+    async def _wait_for_wake(self, timeout=None):
+        """
+        Wait until _wake is called, or until timeout if it's set.
+        """
+        try:
+            await asyncio.wait_for(self._wake_event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _is_busy(self):
+        return time.time() - self._last_request_at < self.idle_time
+
+    def _get_priority_work(self):
+        """
+        Return unpopulated entries in prioritized paths.  Paths with nothing left to
+        populate are removed.
+        """
+        while True:
+            with self._lock:
+                if not self._priority_paths:
+                    return []
+                item = self._priority_paths[-1]
+
+            path, after_id = item
+            entries = self.db.get_unpopulated(paths=[path], after_id=after_id, limit=self.batch_size)
+            with self._lock:
+                if entries:
+                    item[1] = entries[-1]['id']
+                    return entries
+
+                if item in self._priority_paths:
+                    self._priority_paths.remove(item)
+
+    async def _index_directories(self, executor):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if not self._directories_to_index:
+                    return
+                path = self._directories_to_index.pop(0)
+
+            try:
+                await loop.run_in_executor(executor, self.library._index_directory, path)
+            except Exception as e:
+                log.warn('Error indexing %s: %s' % (path, e))
+                continue
+
+            # Populate the entries we just added.
+            self.prioritize([path])
+
+    def _populate(self, entry):
+        """
+        Return a populated entry for an unpopulated one, or None if the file no longer exists.
+        This is run on the worker threads.
+        """
+        path = open_path(entry['path'])
+        return self.library._get_entry_from_path(path)
+
+    async def _populate_batch(self, executor, entries):
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*[
+            loop.run_in_executor(executor, self._populate, entry)
+            for entry in entries
+        ], return_exceptions=True)
+
+        populated = []
+        deleted = []
+        for entry, result in zip(entries, results):
+            if isinstance(result, Exception):
+                log.warn('Error populating %s: %s' % (entry['path'], result))
+                self.failed += 1
+            elif result is None:
+                deleted.append(entry['path'])
+            elif result.get('error') is not None:
+                # Don't cache entries if there was an error reading the file, as with _get_entry.
+                self.failed += 1
+            else:
+                populated.append(result)
+
+        if populated:
+            self.db.add_records(populated)
+            self.populated += len(populated)
+
+        if deleted:
+            self.db.delete_recursively(deleted)
+
+    async def run(self):
+        """
+        Populate entries until cancelled.  This is run as a background task.
+        """
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='Populate')
+        self._wake_event = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        try:
+            checkpoint = self.db.get_populate_checkpoint()
+            started_at = time.time()
+            last_progress_at = time.time()
+            while True:
+                # Clear the wake flag before we look for work, so we don't miss a wake() that
+                # happens after we've found nothing to do.
+                self._wake_event.clear()
+
+                # Index browsed directories first.  This is quick, since it only adds placeholders.
+                await self._index_directories(executor)
+
+                # Populate browsed directories next, even if we're busy, since those are what
+                # the user will ask for next.
+                entries = self._get_priority_work()
+                background = not entries
+                if background:
+                    # Pause other work while requests are coming in.  Wait until we've been
+                    # idle for idle_time, or until priority work arrives.
+                    if self._is_busy():
+                        await self._wait_for_wake(timeout=self._last_request_at + self.idle_time - time.time())
+                        continue
+
+                    entries = self.db.get_unpopulated(after_id=checkpoint, limit=self.batch_size)
+                    if not entries:
+                        # We've finished a pass.  Start the next pass from the beginning, so we'll
+                        # retry anything that failed, but wait until there's something new to do.
+                        if checkpoint != 0:
+                            log.info('Finished populating entries (%i populated, %i failed)' % (self.populated, self.failed))
+                            checkpoint = 0
+                            self.db.set_populate_checkpoint(checkpoint)
+
+                        await self._wait_for_wake()
+                        continue
+
+                    checkpoint = entries[-1]['id']
+
+                await self._populate_batch(executor, entries)
+
+                # Save our position.  If we're interrupted before this, we'll redo the batch,
+                # which is harmless.
+                if background:
+                    self.db.set_populate_checkpoint(checkpoint)
+
+                if time.time() - last_progress_at >= 5:
+                    last_progress_at = time.time()
+                    rate = self.populated / max(time.time() - started_at, 0.001)
+                    log.info('Populating entries: %s' % self)
+                    AsyncTask.set_progress({
+                        'populated': self.populated,
+                        'failed': self.failed,
+                        'entries_per_second': rate,
+                    })
+
+                # Let other tasks run.
+                await asyncio.sleep(0)
+        finally:
+            self._loop = None
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def __str__(self):
+        return '%i populated, %i failed' % (self.populated, self.failed)
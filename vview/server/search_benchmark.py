@@ -0,0 +1,88 @@
+# A benchmark for the first page of a cold library search.
+#
+# This creates a directory of bookmarked JPEG, PNG and WebP files and refreshes it, so
+# the index has unpopulated entries for all of them.  It then measures how long it takes
+# to get the first page of a bookmark search, which populates each result it returns.
+# This is run with different populate windows (Library.search_populate_window), where
+# a window of 1 populates one result at a time.
+#
+# python -m vview.server.search_benchmark --files 5000
+import argparse, asyncio, logging, os, shutil, statistics, sys, tempfile, time
+from pathlib import Path
+from PIL import Image
+
+from . import metadata_storage
+from .library import Library
+from ..util.paths import open_path
+
+log = logging.getLogger(__name__)
+
+_formats = ('jpg', 'png', 'webp')
+
+def create_files(directory, count):
+    """
+    Create count small images in directory, cycling through JPEG, PNG and WebP, and
+    bookmark all of them.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    metadata = {}
+    for idx in range(count):
+        filename = 'image%05i.%s' % (idx, _formats[idx % len(_formats)])
+        path = directory / filename
+        if not path.exists():
+            Image.new('RGB', (64 + idx % 64, 64), color=(idx % 256, 0, 0)).save(path)
+        metadata[filename] = { 'bookmarked': True }
+
+    metadata_storage.save_directory_metadata(open_path(directory), metadata)
+
+async def measure_first_page(directory, data_dir, *, window, batch_size):
+    """
+    Return how long the first page of a cold bookmark search takes.
+    """
+    shutil.rmtree(data_dir, ignore_errors=True)
+    data_dir.mkdir(parents=True)
+
+    library = Library(open_path(data_dir))
+    library.mounts['benchmark'] = open_path(directory)
+    library.search_populate_window = window
+
+    # Refresh to create unpopulated entries for the bookmarks.
+    await library.refresh(full=True)
+
+    started_at = time.perf_counter()
+    search = library.search(bookmarked=True, use_windows_search=False, batch_size=batch_size, threaded=False)
+    try:
+        results = next(search, [])
+    finally:
+        search.close()
+    elapsed = time.perf_counter() - started_at
+
+    assert len(results) == batch_size, len(results)
+    return elapsed
+
+async def main():
+    parser = argparse.ArgumentParser(description='Benchmark the first page of a cold library search.')
+    parser.add_argument('--files', type=int, default=5000, help='How many files to search (default: %(default)s)')
+    parser.add_argument('--windows', default='1,8,50',
+        help='Comma-separated populate windows to test (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=50, help='The page size (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per window (default: %(default)s)')
+    parser.add_argument('--work-dir', type=Path, default=Path(tempfile.gettempdir()) / 'vview-search-benchmark',
+        help='Where to create the test files, which are reused between runs (default: %(default)s)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+
+    directory = (args.work_dir / f'files-{args.files}').resolve()
+    create_files(directory, args.files)
+
+    for window in [int(window) for window in args.windows.split(',')]:
+        times = []
+        for _ in range(args.repeat):
+            times.append(await measure_first_page(directory, args.work_dir / 'data', window=window, batch_size=args.batch_size))
+
+        print('window %3i: first page of %i in %.1fms (median of %i)' % (
+            window, args.batch_size, statistics.median(times) * 1000, args.repeat))
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,248 @@
+import asyncio, logging, os, stat, time
+from pathlib import Path
+
+from . import metadata_storage
+from ..util import misc, windows_search
+from ..util.crawler import Crawler
+from ..util.paths import open_path
+
+log = logging.getLogger(__name__)
+
+# Search providers yield this if a search with a timeout times out.
+SearchTimeout = windows_search.SearchTimeout
+
+class SearchProvider:
+    """
+    A filesystem search backend for Library.
+
+    Library.search combines results from a search provider with results from FileIndex.
+    Providers find files on disk that might not be in the index yet, and quick_refresh
+    uses them to find metadata files.
+
+    search() yields DirEntry-like results.  If order is given, results must be sorted in
+    the same order as the sort order's "entry" key, so Library.search can merge them with
+    index results.  order is the sort order's sort_key entry (see library.sort_orders), so
+    sort orders without it can't be used with a provider.
+    """
+    # The key in library.sort_orders with the ORDER BY clause for this provider.
+    sort_key = None
+
+    async def refresh(self, paths, *, recursive=True):
+        """
+        Update any index the provider keeps for paths.  If recursive is false, only
+        update the paths themselves and not directories inside them.
+        """
+        pass
+
+    def search(self, *,
+        paths=None,
+        exact_path=None,
+        filename=None,
+        substr=None,
+        recurse=True,
+        media_type=None,
+        total_pixels=None,
+        aspect_ratio=None,
+        order=None,
+        order_fs=None,
+        include_files=True,
+        include_dirs=True,
+        timeout=None,
+    ):
+        """
+        Yield search results.  See windows_search._windows_search for the parameters.
+
+        If timeout is None, a default timeout is used, and an exception is raised if it
+        times out.  If it's 0, there's no timeout.  Otherwise, SearchTimeout is yielded
+        if the search times out.
+        """
+        raise NotImplementedError()
+
+class WindowsSearchProvider(SearchProvider):
+    """
+    Search with Windows Search.  This searches the system index, so there's no index
+    for us to refresh.
+    """
+    sort_key = 'windows'
+
+    def search(self, **kwargs):
+        return windows_search.search(**kwargs)
+
+class FilenameIndexDirEntry(os.PathLike):
+    """
+    A DirEntry-like class for FilenameIndex results, like windows_search.SearchDirEntry.
+    """
+    def __init__(self, record):
+        self._path = record['path']
+        self._is_directory = bool(record['is_directory'])
+        self._stat = None
+
+    @property
+    def metadata(self):
+        """
+        Return any extra metadata that we got from the search.  We only know filenames.
+        """
+        return { }
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def name(self):
+        return os.path.basename(self._path)
+
+    def is_dir(self, *, follow_symlinks=True):
+        return self._is_directory
+
+    def is_file(self, *, follow_symlinks=True):
+        return not self._is_directory
+
+    def exists(self, *, follow_symlinks=True):
+        return True
+
+    @property
+    def is_symlink(self):
+        return False
+
+    def stat(self, *, follow_symlinks=True):
+        if self._stat is None:
+            self._stat = os.stat(self._path)
+        return self._stat
+
+    def __fspath__(self):
+        return self._path
+
+    def __repr__(self):
+        return 'FilenameIndexDirEntry(%s)' % self._path
+
+class FilenameIndexProvider(SearchProvider):
+    """
+    Search with our own index of filenames, for when Windows Search isn't available.
+
+    The index is a FilenameIndex, which is updated by crawling with refresh().  Directories
+    are only listed again if their mtime has changed, so refreshing an unchanged tree only
+    takes a stat per directory.  Paths that haven't been crawled yet are searched directly,
+    which is slow, but gives the same results.
+    """
+    sort_key = 'index'
+
+    def __init__(self, db, *, workers=8):
+        """
+        db is a FilenameIndex, and workers is the number of directories to list at once.
+        """
+        self.db = db
+        self.workers = workers
+
+    async def refresh(self, paths, *, recursive=True):
+        paths = [open_path(path, open_zips=False) for path in paths]
+        if not paths:
+            return
+
+        mtimes = self.db.get_directory_mtimes(paths, recursive=recursive)
+        listed = 0
+
+        def list_directory(path):
+            nonlocal listed
+            mtime = path.stat().st_mtime
+
+            # If the directory hasn't changed, we only need to visit its subdirectories.
+            if mtimes.get(os.fspath(path)) == mtime:
+                if not recursive:
+                    return [], []
+                return [open_path(subdirectory, open_zips=False) for subdirectory in self.db.get_subdirectories(path)], []
+
+            subdirectories = []
+            records = []
+            for child in path.scandir():
+                child_stat = child.stat()
+                is_directory = stat.S_ISDIR(child_stat.st_mode)
+                if is_directory:
+                    # Skip upscale caches, like misc.ignore_file.
+                    if child.name == '.upscales':
+                        continue
+
+                    subdirectories.append(child)
+                    mime_type = 'application/folder'
+                else:
+                    # Index supported files, and metadata files so quick_refresh can find them.
+                    mime_type = misc.mime_type(child.name)
+                    if mime_type is None and child.name != metadata_storage.metadata_filename:
+                        continue
+
+                # Use the same creation time as Library._get_placeholder_entry, so the ctime sort
+                # matches.  Only Windows has st_birthtime.
+                ctime = getattr(child_stat, 'st_birthtime', child_stat.st_ctime)
+                records.append(self.db.get_record(os.fspath(child), is_directory=is_directory, ctime=ctime, mime_type=mime_type))
+
+            listed += 1
+
+            # Don't record very recent mtimes.  Filesystems with coarse timestamps could
+            # change again without the mtime changing.
+            if time.time() - mtime <= 2:
+                mtime = None
+
+            return (subdirectories if recursive else []), [(path, mtime, records)]
+
+        crawler = Crawler(paths, process_file=lambda listing: listing, list_directory=list_directory, workers=self.workers)
+        async for listings in crawler.run():
+            self.db.set_listings(listings)
+
+        if listed:
+            log.info('Updated filename index for %i directories (%s)' % (listed, crawler))
+
+    def search(self, *,
+        paths=None,
+        exact_path=None,
+        filename=None,
+        substr=None,
+        recurse=True,
+        media_type=None,
+        order=None,
+        order_fs=None,
+        include_files=True,
+        include_dirs=True,
+        timeout=None,
+
+        # Not supported.  We only have filenames, so the caller has to filter these.
+        total_pixels=None,
+        aspect_ratio=None,
+    ):
+        yield_timeouts = (timeout is not None)
+        if timeout is None:
+            timeout = 10
+
+        options = {
+            'exact_path': exact_path,
+            'filename': filename,
+            'substr': substr,
+            'recurse': recurse,
+            'media_type': media_type,
+            'include_files': include_files,
+            'include_dirs': include_dirs,
+        }
+
+        # Search paths that have been crawled from the index.
+        paths = [os.fspath(path) for path in paths] if paths else []
+        indexed_paths = self.db.get_indexed_directories(paths)
+        if indexed_paths or exact_path is not None:
+            try:
+                for record in self.db.search(paths=[path for path in paths if path in indexed_paths], order=order, timeout=timeout, **options):
+                    yield FilenameIndexDirEntry(record)
+            except TimeoutError:
+                # As with Windows search, only yield SearchTimeout if the caller asked for a
+                # timeout.  Otherwise, treat it as an error so incomplete results aren't used.
+                log.warn(f'Filename search timed out.  Timeout: {timeout}')
+                if yield_timeouts:
+                    yield SearchTimeout
+                    return
+                else:
+                    raise
+
+        # Search paths that haven't been crawled yet directly.
+        for path in paths:
+            if path in indexed_paths:
+                continue
+
+            log.info(f'{path} isn\'t in the filename index, searching directly')
+            yield from windows_search.fallback_search(paths=[path], order_fs=order_fs, **options)
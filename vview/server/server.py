@@ -9,7 +9,9 @@ from ..util.paths import open_path, PathBase
 from ..util.threaded_tasks import AsyncTask
 from ..database.signature_db import SignatureDB
 from .library import Library
+from . import metadata_storage
 from .api_server import APIServer
+from .list_prefetch import ListPrefetcher
 
 misc.config_logging()
 log = logging.getLogger(__name__)
@@ -91,6 +93,7 @@ class Server:
 
     async def _init(self):
         self.api_list_results = OrderedDict()
+        self.list_prefetcher = ListPrefetcher()
 
         # Set up the Windows tray icon and terminal window.
         windows_ui.WindowsUI.get.create(self.exit)
@@ -106,6 +109,11 @@ class Server:
         self.data_dir.mkdir()
 
         self.settings = Settings.create(self.data_dir / 'settings.json')
+
+        # Write metadata files behind, so edits to many files in a directory only write it once.
+        # This writes edits left over from last time.
+        metadata_storage.open_journal(self.data_dir / 'metadata-journal.txt')
+
         self.library = Library(self.data_dir)
         self.sig_db = SignatureDB(self.data_dir / 'signatures.sqlite')
 
@@ -135,13 +143,17 @@ class Server:
                 log.warn('Library path isn\'t a directory: %s', str(path))
                 continue
 
-            self.library.mount(path, name)
+            self.library.mount(path, name, crawl_workers=folder_info['crawl_workers'])
 
         # Run a quick refresh at startup.  This can still take a few seconds for larger
         # libraries, so run this in a task to allow requests to start being handled immediately.
         refresh_task = self.library.quick_refresh()
         self.run_background_task(refresh_task, name=f'Indexing {name}')
 
+        # Populate entries the refresh didn't populate in the background.  This runs until
+        # we exit, so give it its own thread rather than taking one of the shared ones.
+        self.run_background_task(self.library.populate_engine.run(), name='Populating entries', dedicated_thread=True)
+
     async def _shutdown(self):
         log.info('Shutting down manager')
 
@@ -149,6 +161,11 @@ class Server:
 
         for name in list(self.library.mounts.keys()):
             await self.library.unmount(name)
+
+        # Write any metadata edits that haven't been written yet.  Do this before shutting
+        # down the library, so the files it writes are still registered.
+        metadata_storage.close_journal()
+        self.library.shutdown()
         
     def exit(self, reason='not specified'):
         """
@@ -179,21 +196,24 @@ class Server:
 
         return path
 
-    def run_background_task(self, func, *, name=None):
+    def run_background_task(self, func, *, name=None, dedicated_thread=False):
         """
-        Run a background task.
+        Run a background task.  See AsyncTask.run.
         """
-        AsyncTask.run(func, name=name)
+        AsyncTask.run(func, name=name, dedicated_thread=dedicated_thread)
 
     # Values of api_list_results can be a dictionary, in which case they're a result
     # cached from a previous call.  They can also be a function, which is called to
-    # retrieve the next page, which is used to continue previous searches.
-    cached_result = namedtuple('cached_result', ('result', 'prev_uuid', 'next_offset'))
+    # retrieve the next page, which is used to continue previous searches.  If the next
+    # page is being read in the background, prefetch is its PrefetchedPage.
+    cached_result = namedtuple('cached_result', ('result', 'prev_uuid', 'next_offset', 'prefetch'), defaults=(None,))
     def cache_api_list_result(self, uuid, cached_result):
         self.api_list_results[uuid] = cached_result
         
         # Delete old cached entries.
         uuids = list(self.api_list_results.keys())
+        # Each cached generator holds a database read connection while it's parked, so
+        # this needs to stay well below Database's max_readers.
         max_cache_entries = 25
         uuids = uuids[:-max_cache_entries]
         for erase_uuid in uuids:
@@ -206,11 +226,24 @@ class Server:
 
         return self.api_list_results.get(uuid, None)
 
+    def prefetch_api_list_result(self, uuid, *, user):
+        """
+        If uuid is a cached generator for continuing a search, start reading its next
+        page in the background.  See ListPrefetcher.
+        """
+        result = self.api_list_results.get(uuid, None)
+        if result is None or not hasattr(result.result, 'send') or result.prefetch is not None:
+            return
+
+        prefetch = self.list_prefetcher.start(result.result, user=user)
+        if prefetch is not None:
+            self.api_list_results[uuid] = result._replace(prefetch=prefetch)
+
     def api_list_cache_erase(self, uuid):
         """
         Remove the given cache page from the cache.  If the cache entry is a generator
         for continuing a search, it will be closed and GeneratorExit will be raised inside
-        it.
+        it, and any prefetch of its next page is cancelled.
         """
         result = self.api_list_results.get(uuid, None)
         if result is None:
@@ -218,7 +251,11 @@ class Server:
 
         del self.api_list_results[uuid]
 
-        if hasattr(result.result, 'send'):
+        # If the next page is being prefetched, cancel it.  This closes the generator once
+        # it's no longer running.
+        if result.prefetch is not None:
+            result.prefetch.cancel()
+        elif hasattr(result.result, 'send'):
             result.result.close()
 
     def clear_api_list_cache(self):
@@ -226,7 +263,7 @@ class Server:
         Clear the api/list cache.
         """
         # If any of these are generators, close them to shut them down cleanly.
-        uuids = self.api_list_results.keys()
+        uuids = list(self.api_list_results.keys())
         for uuid in uuids:
             self.api_list_cache_erase(uuid)
 
@@ -176,6 +176,9 @@ class Settings:
             folders.append({
                 'name': name,
                 'path': path,
+
+                # The number of threads to crawl this folder with, or None for the default.
+                'crawl_workers': folder.get('crawl_workers'),
             })
         return folders
     
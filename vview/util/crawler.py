@@ -0,0 +1,223 @@
+import asyncio, collections, logging, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+class Crawler:
+    """
+    Walk directory trees with a pool of threads, streaming results back to the event loop.
+
+    Listing directories is slow on network shares and spinning disks, and is mostly spent
+    waiting on I/O, so listing several directories at once is much faster than walking the
+    tree one directory at a time.
+
+    Each worker has its own queue of directories.  Workers take directories from the end of
+    their own queue, so each worker walks its part of the tree depth-first.  When a worker runs
+    out of directories, it steals one from the front of the longest queue, which is usually
+    the top of a large subtree, so the work spreads out quickly.
+
+    process_file(path) is called on a worker thread for each file found, and results that
+    aren't None are returned in batches from run():
+
+    crawler = Crawler(paths, process_file=process_file)
+    async for results in crawler.run():
+        ...
+    """
+    def __init__(self, paths, *, process_file, list_directory=None, workers=8, batch_size=100, expected_directories=None):
+        """
+        list_directory(path) is called on a worker thread to list each directory, and returns
+        (subdirectories, files).  Subdirectories are crawled, and process_file is called for
+        each file.  This defaults to Crawler.scandir, and can be overridden to skip listing
+        directories that haven't changed.
+
+        If expected_directories is set, it's an estimate of how many directories will be
+        crawled, which is used to estimate the time remaining.
+        """
+        self.process_file = process_file
+        self.list_directory = list_directory or self.scandir
+        self.workers = max(workers, 1)
+        self.batch_size = batch_size
+        self.expected_directories = expected_directories
+
+        self._queues = [collections.deque() for _ in range(self.workers)]
+        self._condition = threading.Condition()
+        self._cancelled = False
+        self._exception = None
+
+        # The number of directories that are queued or being listed.  We're finished when
+        # this reaches zero.
+        self._pending = 0
+
+        # Distribute the starting paths across the workers.
+        for idx, path in enumerate(paths):
+            self._queues[idx % self.workers].append(path)
+            self._pending += 1
+
+        # Statistics.  See get_progress.
+        self.directories = 0
+        self.discovered = self._pending
+        self.started_at = None
+
+    async def run(self):
+        """
+        Crawl the paths, yielding lists of results from process_file as they're found.
+
+        If process_file raises an exception, the crawl stops and the exception is raised
+        here.  Closing the generator stops the crawl.
+        """
+        loop = asyncio.get_running_loop()
+        results = asyncio.Queue()
+        self.started_at = time.time()
+
+        # Each worker puts None on the queue when it exits.
+        def send(batch):
+            loop.call_soon_threadsafe(results.put_nowait, batch)
+
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='Crawler')
+        try:
+            for worker_idx in range(self.workers):
+                executor.submit(self._run_worker, worker_idx, send)
+
+            running_workers = self.workers
+            while running_workers:
+                batch = await results.get()
+                if batch is None:
+                    running_workers -= 1
+                    continue
+
+                yield batch
+
+            if self._exception is not None:
+                raise self._exception
+        finally:
+            self._cancel()
+            executor.shutdown(wait=False)
+
+    def _cancel(self):
+        with self._condition:
+            self._cancelled = True
+            self._condition.notify_all()
+
+    def _get_next_directory(self, worker_idx):
+        """
+        Return the next directory for a worker to list, or None if the crawl is finished.
+        """
+        with self._condition:
+            while True:
+                if self._cancelled:
+                    return None
+
+                # Take work from the end of our own queue.
+                own_queue = self._queues[worker_idx]
+                if own_queue:
+                    return own_queue.pop()
+
+                # Steal from the front of the longest queue.
+                longest_queue = max(self._queues, key=len)
+                if longest_queue:
+                    return longest_queue.popleft()
+
+                # If nothing is queued and nothing is being listed, nothing else will be
+                # queued, so we're done.
+                if self._pending == 0:
+                    return None
+
+                # Wait for another worker to queue more work.
+                self._condition.wait()
+
+    def _finished_directory(self, worker_idx, subdirectories):
+        with self._condition:
+            self._queues[worker_idx].extend(subdirectories)
+            self._pending += len(subdirectories) - 1
+            self.discovered += len(subdirectories)
+            self.directories += 1
+
+            # Wake up idle workers if we added work, or if this was the last directory so
+            # they can exit.
+            if subdirectories or self._pending == 0:
+                self._condition.notify_all()
+
+    def _run_worker(self, worker_idx, send):
+        batch = []
+        try:
+            while True:
+                path = self._get_next_directory(worker_idx)
+                if path is None:
+                    break
+
+                subdirectories = []
+                try:
+                    try:
+                        subdirectories, files = self.list_directory(path)
+                    except OSError as e:
+                        # The directory may have been deleted or be inaccessible.  Skip it and
+                        # keep going.
+                        log.warn('Couldn\'t list %s: %s' % (path, e))
+                        files = []
+
+                    for file in files:
+                        result = self.process_file(file)
+                        if result is not None:
+                            batch.append(result)
+                finally:
+                    self._finished_directory(worker_idx, subdirectories)
+
+                if len(batch) >= self.batch_size:
+                    send(batch)
+                    batch = []
+        except BaseException as e:
+            # Stop the crawl and let run() raise the exception.
+            self._exception = self._exception or e
+            self._cancel()
+        finally:
+            if batch:
+                send(batch)
+            send(None)
+
+    @classmethod
+    def scandir(cls, path):
+        """
+        List a directory, returning (subdirectories, files).  This is the default for
+        list_directory.
+        """
+        subdirectories = []
+        files = []
+        for child in path.scandir():
+            if child.is_real_dir():
+                subdirectories.append(child)
+            else:
+                files.append(child)
+        return subdirectories, files
+
+    def get_progress(self):
+        """
+        Return a dictionary describing the crawl's progress.
+        """
+        with self._condition:
+            queued = sum(len(queue) for queue in self._queues)
+            directories = self.directories
+            discovered = self.discovered
+
+        elapsed = max(time.time() - self.started_at, 0.001) if self.started_at else 0
+        rate = directories / elapsed if elapsed else 0
+
+        # Estimate how many directories there are from what we've seen so far and what we
+        # expected.  This is only an estimate: we don't know how many directories are inside
+        # directories we haven't listed yet.
+        total = max(discovered, self.expected_directories or 0)
+        eta = (total - directories) / rate if rate else None
+
+        return {
+            'directories': directories,
+            'queued': queued,
+            'directories_per_second': rate,
+            'eta': eta,
+        }
+
+    def __str__(self):
+        progress = self.get_progress()
+        result = '%i directories, %i queued, %.0f directories/sec' % (
+            progress['directories'], progress['queued'], progress['directories_per_second'])
+        if progress['eta'] is not None:
+            result += ', about %i seconds left' % progress['eta']
+        return result
@@ -0,0 +1,14 @@
+from enum import Enum
+
+# The kinds of changes reported by MonitorChanges.  The values match ReadDirectoryChangesW's
+# FILE_ACTION_* constants.  This is in its own module so the platform monitors can share it
+# without importing each other.
+class FileAction(Enum):
+    FILE_ACTION_ADDED = 1
+    FILE_ACTION_REMOVED = 2
+    FILE_ACTION_MODIFIED = 3
+
+    # These two are combined into FILE_ACTION_RENAMED, so they're never returned directly.  
+    FILE_ACTION_RENAMED_OLD_NAME = 4
+    FILE_ACTION_RENAMED_NEW_NAME = 5
+    FILE_ACTION_RENAMED = 1000
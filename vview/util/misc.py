@@ -334,7 +334,7 @@ class TransientWriteConnection:
             # Open a connection.  Note that db.connect() is a context manager, and we need
             # to keep a reference to it, both so we can call __exit__ when we're done and because
             # if it's GC'd, the context manager will be exited prematurely.
-            self.connection_ctx = self.db.connect(write=False)
+            self.connection_ctx = self.db.connect(write=True)
             try:
                 self.connection = self.connection_ctx.__enter__()
             except:
@@ -720,6 +720,45 @@ class reverse_order_str(str):
     def __lt__(self, rhs):
         return not super().__lt__(rhs)
 
+import natsort
+_natsort_key = natsort.natsort_keygen(alg=natsort.IGNORECASE)
+_natsort_page_pattern = re.compile(r'(.* #)(\d+)(.*)')
+
+def natural_sort_key(stem, *, is_directory, reverse_pages=False):
+    """
+    Return a natural sort key for a file, as a string.
+
+    This puts directories first, then sorts by stem, with numbers sorted numerically and
+    case ignored.  The key is a string that sorts the same way as the equivalent natsort
+    key, so it can be stored and indexed in the database.
+
+    If reverse_pages is true, pages within a group, such as "Image 12345 #3", are reversed.
+    See library._create_natsort_pages_reversed.
+
+    >>> natural_sort_key('Image 2', is_directory=False) < natural_sort_key('image 10', is_directory=False)
+    True
+    >>> natural_sort_key('b', is_directory=True) < natural_sort_key('a', is_directory=False)
+    True
+    """
+    if reverse_pages and not is_directory:
+        match = _natsort_page_pattern.match(stem)
+        if match:
+            # natsort doesn't handle negative numbers, so we can't just invert the page number.
+            stem = f'{match[1]}{1000000000000000 - int(match[2])}{match[3]}'
+
+    # natsort keys alternate between strings and numbers.  Separate them with \x01, which
+    # sorts before anything in a filename, so a string sorts before strings it's a prefix of.
+    # Prefix numbers with their length, so they sort numerically.
+    parts = ['0' if is_directory else '1']
+    for part in _natsort_key(stem):
+        if isinstance(part, str):
+            parts.append(part)
+        else:
+            digits = str(part)
+            parts.append('%02i%s' % (len(digits), digits))
+
+    return '\x01'.join(parts)
+
 def config_logging():
     # Add a logging factory to make some extra tags available for logging.
     old_factory = logging.getLogRecordFactory()
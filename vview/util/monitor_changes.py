@@ -1,13 +1,17 @@
-import asyncio, ctypes, os, traceback, logging
+import asyncio, ctypes, os, sys, traceback, logging
 from pathlib import Path
 from ctypes.wintypes import BYTE, DWORD
-kernel32 = ctypes.windll.kernel32
 
 log = logging.getLogger(__name__)
 
-from . import win32
-
-ReadDirectoryChangesW = kernel32.ReadDirectoryChangesW
+# ReadDirectoryChangesW is only available on Windows.  Other platforms use inotify,
+# from monitor_changes_inotify.
+if sys.platform == 'win32':
+    from . import win32
+    kernel32 = ctypes.windll.kernel32
+    ReadDirectoryChangesW = kernel32.ReadDirectoryChangesW
+else:
+    win32 = None
 
 FILE_NOTIFY_CHANGE_FILE_NAME = 0x00000001
 FILE_NOTIFY_CHANGE_DIR_NAME = 0x00000002
@@ -18,16 +22,7 @@ FILE_NOTIFY_CHANGE_LAST_ACCESS = 0x00000020
 FILE_NOTIFY_CHANGE_CREATION = 0x00000040
 FILE_NOTIFY_CHANGE_SECURITY = 0x00000100
 
-from enum import Enum
-class FileAction(Enum):
-    FILE_ACTION_ADDED = 1
-    FILE_ACTION_REMOVED = 2
-    FILE_ACTION_MODIFIED = 3
-
-    # These two are combined into FILE_ACTION_RENAMED, so they're never returned directly.  
-    FILE_ACTION_RENAMED_OLD_NAME = 4
-    FILE_ACTION_RENAMED_NEW_NAME = 5
-    FILE_ACTION_RENAMED = 1000
+from .file_action import FileAction
 
 class FileNotifyInformation(ctypes.Structure):
     _fields_ = [
@@ -37,7 +32,7 @@ class FileNotifyInformation(ctypes.Structure):
         # ('FileName', BYTE),
     ]
 
-class MonitorChanges:
+class Win32MonitorChanges:
     def __init__(self, path: os.PathLike, *, buffer_size=1024*128):
         self.path = path
         self.buffer_size = buffer_size
@@ -169,6 +164,11 @@ class MonitorChanges:
         win32.CloseHandle(self.handle)
         self.handle = None
 
+if sys.platform == 'win32':
+    MonitorChanges = Win32MonitorChanges
+else:
+    from .monitor_changes_inotify import InotifyMonitorChanges as MonitorChanges
+
 async def go():
     monitor = MonitorChanges(Path('f:/'))
 
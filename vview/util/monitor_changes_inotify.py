@@ -0,0 +1,528 @@
+import asyncio, ctypes, ctypes.util, errno, os, struct, time, logging
+from pathlib import Path
+
+from .file_action import FileAction
+
+log = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = os.O_CLOEXEC
+IN_NONBLOCK = os.O_NONBLOCK
+
+# struct inotify_event, followed by a null-padded name of len bytes.
+_event_header = struct.Struct('iIII')
+
+_libc = None
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _libc.inotify_init1.argtypes = [ctypes.c_int]
+        _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return _libc
+
+class InotifyMonitorChanges:
+    """
+    Monitor a directory tree for changes with inotify.
+
+    This has the same interface as the ReadDirectoryChangesW implementation.  inotify
+    watches are per-directory, so we add a watch for each directory in the tree, and
+    add watches for new directories as they're created or moved in.
+
+    Watches are limited by fs.inotify.max_user_watches.  If we run out, directories that
+    we can't watch are polled instead, by checking their mtime every poll_interval seconds.
+    This only notices files being added, removed and renamed, not files being modified.
+    Polling a large tree is expensive, so directories that have changed recently are polled
+    every time, and the rest are polled a few at a time.
+    """
+    # Changes that we report as FILE_ACTION_MODIFIED.  This uses IN_CLOSE_WRITE rather than
+    # IN_MODIFY, so a file being written reports one change instead of one for every write.
+    _modify_events = IN_CLOSE_WRITE | IN_ATTRIB
+
+    _watch_events = \
+        IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | _modify_events | \
+        IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+
+    def __init__(self, path: os.PathLike, *,
+            buffer_size=1024*128,
+            poll_interval=5,
+            poll_batch_size=1000,
+            hot_directory_time=300,
+            rename_timeout=0.1):
+        """
+        buffer_size is the size of reads from the inotify descriptor.
+
+        poll_interval is how often to poll directories that we couldn't watch, and
+        poll_batch_size is how many of them to check each time, in addition to directories
+        that changed in the last hot_directory_time seconds.
+
+        rename_timeout is how long to wait for the IN_MOVED_TO to pair with an IN_MOVED_FROM
+        before treating it as a file being moved out of the tree.
+        """
+        self.path = Path(path)
+        self.buffer_size = buffer_size
+        self.poll_interval = poll_interval
+        self.poll_batch_size = poll_batch_size
+        self.hot_directory_time = hot_directory_time
+        self.rename_timeout = rename_timeout
+        self.watch_subtree = True
+        self._readable = None
+
+        # Watch descriptors to their directories, and back.
+        self._watch_paths = {}
+        self._watches = {}
+
+        # Directories that we're polling instead of watching, to (mtime, names).  _hot_directories
+        # is the time each polled directory last changed.  _poll_queue is the order we poll the
+        # rest of them in.
+        self._polled = {}
+        self._hot_directories = {}
+        self._poll_queue = []
+        self._warned_watch_limit = False
+
+        libc = _get_libc()
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd == -1:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        # Watch the top directory now, so we raise an error immediately if it can't be
+        # monitored.  Subdirectories are added when we start monitoring.
+        try:
+            wd = self._add_watch(self.path)
+        except OSError:
+            self.close()
+            raise
+
+        if wd is None:
+            self._add_polled_directory(self.path)
+
+    def __del__(self):
+        self.close()
+
+    async def monitor_call(self, func, *args, **kwargs):
+        async for (path, old_path), action in self.monitor(*args, **kwargs):
+            try:
+                await func(path, old_path, action)
+            except Exception as e:
+                log.exception('Error monitoring %s' % self.path)
+
+    # Yield changes to the directory.
+    #
+    # To stop monitoring, call close() or cancel the coroutine.
+    async def monitor(self, watch_subtree=True):
+        if self.fd is None:
+            return
+
+        self.watch_subtree = watch_subtree
+        if watch_subtree:
+            # Walking the tree can take a while, so do it in a thread.  Changes made while
+            # we're doing this are queued by the kernel.
+            await asyncio.to_thread(self._watch_subdirectories, self.path)
+
+        self._readable = readable = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.fd, readable.set)
+        try:
+            # A IN_MOVED_FROM which hasn't been paired with its IN_MOVED_TO yet, and when we
+            # received it.
+            pending_move = None
+            next_poll = time.monotonic() + self.poll_interval
+
+            while self.fd is not None:
+                # Wait until there are events to read, or until we need to poll or give up
+                # waiting for a rename to be paired.
+                timeout = None
+                if self._polled:
+                    timeout = max(0, next_poll - time.monotonic())
+                if pending_move is not None:
+                    rename_timeout = max(0, pending_move[1] + self.rename_timeout - time.monotonic())
+                    timeout = rename_timeout if timeout is None else min(timeout, rename_timeout)
+
+                try:
+                    await asyncio.wait_for(readable.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                except asyncio.CancelledError:
+                    # We were cancelled.  As with ReadDirectoryChangesW, we can be called again
+                    # until close() is called.
+                    return
+                readable.clear()
+
+                if self.fd is None:
+                    return
+
+                events = self._read_events()
+                if events is None:
+                    return
+
+                for event in events:
+                    # If a move is waiting to be paired and this isn't its other half, the file
+                    # was moved out of the tree.
+                    if pending_move is not None:
+                        (old_path, old_is_dir, cookie), _ = pending_move
+                        if event[0] != IN_MOVED_TO or event[3] != cookie:
+                            pending_move = None
+                            for change in self._moved_out(old_path, old_is_dir):
+                                yield change
+
+                    mask, path, is_dir, cookie = event
+                    if mask == IN_MOVED_FROM:
+                        pending_move = (path, is_dir, cookie), time.monotonic()
+                        continue
+
+                    if mask == IN_MOVED_TO:
+                        if pending_move is not None:
+                            old_path = pending_move[0][0]
+                            pending_move = None
+                            if is_dir:
+                                self._directory_renamed(old_path, path)
+                            yield (path, old_path), FileAction.FILE_ACTION_RENAMED
+                        else:
+                            # The file was moved into the tree, so treat it like it was created.
+                            if is_dir:
+                                await asyncio.to_thread(self._watch_directory_tree, path)
+                            yield (path, None), FileAction.FILE_ACTION_ADDED
+                        continue
+
+                    if mask == IN_CREATE:
+                        if is_dir:
+                            await asyncio.to_thread(self._watch_directory_tree, path)
+                        yield (path, None), FileAction.FILE_ACTION_ADDED
+                    elif mask == IN_DELETE:
+                        yield (path, None), FileAction.FILE_ACTION_REMOVED
+                    elif mask & self._modify_events:
+                        yield (path, None), FileAction.FILE_ACTION_MODIFIED
+
+                # If a rename hasn't been paired in time, the file was moved out of the tree.
+                if pending_move is not None and time.monotonic() >= pending_move[1] + self.rename_timeout:
+                    (old_path, old_is_dir, cookie), _ = pending_move
+                    pending_move = None
+                    for change in self._moved_out(old_path, old_is_dir):
+                        yield change
+
+                if self._polled and time.monotonic() >= next_poll:
+                    for change in await asyncio.to_thread(self._poll_directories):
+                        yield change
+                    next_poll = time.monotonic() + self.poll_interval
+        finally:
+            if self.fd is not None:
+                loop.remove_reader(self.fd)
+
+    def _read_events(self):
+        """
+        Read and parse queued events.
+
+        Return a list of (mask, path, is_dir, cookie), where mask is the single event bit
+        that we report, or None if the monitored directory is gone.
+        """
+        try:
+            data = os.read(self.fd, self.buffer_size)
+        except BlockingIOError:
+            return []
+        except OSError as e:
+            log.warn('Error monitoring %s: %s' % (self.path, e.strerror))
+            return None
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, name_length = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            name = data[offset:offset+name_length].rstrip(b'\0')
+            offset += name_length
+
+            if mask & IN_Q_OVERFLOW:
+                log.warn('Too many changes to monitor in %s, some changes were lost' % self.path)
+                continue
+
+            directory = self._watch_paths.get(wd)
+            if directory is None:
+                continue
+
+            if mask & IN_IGNORED:
+                # The watch was removed because the directory was deleted.  Watches that we
+                # remove ourself are already forgotten.
+                self._forget_watch(wd)
+                if directory == self.path:
+                    log.warn('Monitored directory was removed: %s' % self.path)
+                    return None
+                continue
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_UNMOUNT):
+                # We'll receive an IN_DELETE or IN_MOVED_FROM for the directory from its parent.
+                if directory == self.path:
+                    log.warn('Monitored directory was removed: %s' % self.path)
+                    return None
+                continue
+
+            if not name:
+                continue
+
+            path = directory / os.fsdecode(name)
+            is_dir = bool(mask & IN_ISDIR)
+            for event_type in (IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE):
+                if mask & event_type:
+                    events.append((event_type, path, is_dir, cookie))
+                    break
+            else:
+                if mask & self._modify_events:
+                    events.append((mask & self._modify_events, path, is_dir, cookie))
+
+        return events
+
+    def _moved_out(self, path, is_dir):
+        """
+        Handle a file or directory being moved out of the tree, returning its changes.
+        """
+        if is_dir:
+            self._unwatch_directory_tree(path)
+        return [((path, None), FileAction.FILE_ACTION_REMOVED)]
+
+    def _add_watch(self, path):
+        """
+        Add a watch for path, and return its watch descriptor.
+
+        Return None if we've run out of watches.  Raise OSError for other errors.
+        """
+        result = _get_libc().inotify_add_watch(self.fd, os.fsencode(path), self._watch_events)
+        if result == -1:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                if not self._warned_watch_limit:
+                    self._warned_watch_limit = True
+                    log.warn('Ran out of inotify watches monitoring %s, polling for changes instead.  '
+                        'Increase fs.inotify.max_user_watches to avoid this.' % self.path)
+                return None
+
+            raise OSError(error, os.strerror(error), os.fspath(path))
+
+        # If a directory is renamed and a new one is created with the old name, a watch for
+        # the old name may still point to the renamed directory.
+        old_wd = self._watches.get(path)
+        if old_wd is not None and old_wd != result:
+            self._watch_paths.pop(old_wd, None)
+
+        old_path = self._watch_paths.get(result)
+        if old_path is not None and old_path != path:
+            self._watches.pop(old_path, None)
+
+        self._watch_paths[result] = path
+        self._watches[path] = result
+        self._polled.pop(path, None)
+        return result
+
+    def _forget_watch(self, wd):
+        path = self._watch_paths.pop(wd, None)
+        if path is not None and self._watches.get(path) == wd:
+            del self._watches[path]
+
+    def _watch_subdirectories(self, path):
+        """
+        Add watches for directories inside path.  If we can't watch them, poll them.
+        """
+        for root, dirs, files in os.walk(path):
+            root = Path(root)
+            for dirname in dirs:
+                subdir = root / dirname
+                if subdir in self._watches or subdir in self._polled:
+                    continue
+
+                try:
+                    wd = self._add_watch(subdir)
+                except OSError as e:
+                    # The directory may have been deleted, or we may not have access to it.
+                    log.debug('Couldn\'t monitor %s: %s' % (subdir, e.strerror))
+                    continue
+
+                if wd is None:
+                    self._add_polled_directory(subdir)
+
+    def _watch_directory_tree(self, path):
+        """
+        Add watches for a directory that was created or moved into the tree, and the
+        directories inside it.
+        """
+        if path in self._watches or path in self._polled:
+            return
+
+        try:
+            wd = self._add_watch(path)
+        except OSError as e:
+            log.debug('Couldn\'t monitor %s: %s' % (path, e.strerror))
+            return
+
+        if wd is None:
+            self._add_polled_directory(path)
+
+        if self.watch_subtree:
+            self._watch_subdirectories(path)
+
+    def _unwatch_directory_tree(self, path):
+        """
+        Stop watching a directory that was moved out of the tree, and the directories
+        inside it.
+        """
+        for watched_path, wd in list(self._watches.items()):
+            if watched_path == path or path in watched_path.parents:
+                _get_libc().inotify_rm_watch(self.fd, wd)
+                self._forget_watch(wd)
+
+        for polled_path in list(self._polled.keys()):
+            if polled_path == path or path in polled_path.parents:
+                self._remove_polled_directory(polled_path)
+
+    def _directory_renamed(self, old_path, new_path):
+        """
+        Update our paths for a directory that was renamed inside the tree.
+
+        Watches follow the directory when it's renamed, so we just need to update their
+        paths.
+        """
+        def _rename(path):
+            if path == old_path:
+                return new_path
+            if old_path in path.parents:
+                return new_path / path.relative_to(old_path)
+            return None
+
+        for watched_path, wd in list(self._watches.items()):
+            renamed_path = _rename(watched_path)
+            if renamed_path is not None:
+                del self._watches[watched_path]
+                self._watches[renamed_path] = wd
+                self._watch_paths[wd] = renamed_path
+
+        for polled_path in list(self._polled.keys()):
+            renamed_path = _rename(polled_path)
+            if renamed_path is not None:
+                state = self._polled[polled_path]
+                self._remove_polled_directory(polled_path)
+                self._polled[renamed_path] = state
+                self._poll_queue.append(renamed_path)
+
+    def _add_polled_directory(self, path):
+        try:
+            mtime = path.stat().st_mtime
+            names = self._list_directory(path)
+        except OSError as e:
+            log.debug('Couldn\'t poll %s: %s' % (path, e.strerror))
+            return
+
+        self._polled[path] = (mtime, names)
+        self._poll_queue.append(path)
+
+    def _remove_polled_directory(self, path):
+        self._polled.pop(path, None)
+        self._hot_directories.pop(path, None)
+
+        # Directories we've stopped polling are removed from _poll_queue when we reach them.
+
+    @classmethod
+    def _list_directory(cls, path):
+        """
+        Return {name: is_dir} for the files in path.
+        """
+        with os.scandir(path) as it:
+            return { entry.name: entry.is_dir(follow_symlinks=False) for entry in it }
+
+    def _poll_directories(self):
+        """
+        Check directories that we're polling for changes, and return the changes.
+
+        This runs in a thread.
+        """
+        now = time.monotonic()
+
+        # Poll directories that changed recently, and the next batch of the rest.
+        for path, changed_at in list(self._hot_directories.items()):
+            if now - changed_at > self.hot_directory_time:
+                del self._hot_directories[path]
+        paths = list(self._hot_directories.keys())
+
+        count = 0
+        while self._poll_queue and count < self.poll_batch_size:
+            path = self._poll_queue.pop(0)
+            if path not in self._polled:
+                continue
+
+            self._poll_queue.append(path)
+            count += 1
+            if path not in self._hot_directories:
+                paths.append(path)
+
+        changes = []
+        for path in paths:
+            state = self._polled.get(path)
+            if state is None:
+                continue
+
+            old_mtime, old_names = state
+            try:
+                mtime = path.stat().st_mtime
+                if mtime == old_mtime:
+                    continue
+
+                names = self._list_directory(path)
+            except FileNotFoundError:
+                # The directory was removed.  We'll see that from its parent if it's being
+                # watched or polled.
+                self._remove_polled_directory(path)
+                continue
+            except OSError as e:
+                log.debug('Couldn\'t poll %s: %s' % (path, e.strerror))
+                continue
+
+            self._polled[path] = (mtime, names)
+            self._hot_directories[path] = now
+
+            # We can't tell renames apart when polling, so they're reported as a removal
+            # and an addition.
+            for name, is_dir in old_names.items():
+                if name not in names:
+                    if is_dir:
+                        self._unwatch_directory_tree(path / name)
+                    changes.append(((path / name, None), FileAction.FILE_ACTION_REMOVED))
+
+            for name, is_dir in names.items():
+                if name not in old_names:
+                    if is_dir and self.watch_subtree:
+                        self._watch_directory_tree(path / name)
+                    changes.append(((path / name, None), FileAction.FILE_ACTION_ADDED))
+
+        return changes
+
+    def close(self):
+        fd = getattr(self, 'fd', None)
+        if fd is None:
+            return
+
+        self.fd = None
+        try:
+            asyncio.get_running_loop().remove_reader(fd)
+        except RuntimeError:
+            # There's no running event loop.
+            pass
+
+        os.close(fd)
+
+        # Wake up monitor() if it's waiting, so it sees that we've been closed.
+        if self._readable is not None:
+            self._readable.set()
@@ -74,7 +74,7 @@ def open_path_in_browser(path):
         # See if we have a crop.  We still read the file above even if we're using the
         # crop resolution, so error handling is the same (we still check that the file
         # is readable).
-        file_metadata = metadata_storage.load_file_metadata(path)
+        file_metadata = metadata_storage.load_file_metadata(path, return_copy=False)
         crop = file_metadata.get('crop')
         if crop:
             width = crop[2] - crop[0]
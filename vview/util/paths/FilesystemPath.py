@@ -1,6 +1,12 @@
-import os, stat
+import os, stat, sys
 from pathlib import Path, PurePosixPath
-from .. import win32
+
+# win32 is only needed to open files with sharing flags.  Don't import it elsewhere, so
+# tools like the database benchmark can run on other platforms.
+if sys.platform == 'win32':
+    from .. import win32
+else:
+    win32 = None
 
 from .PathBase import PathBase
 from .ZipPath import ZipPath
@@ -165,7 +171,7 @@ class FilesystemPath(PathBase):
         if 't' in mode:
             encoding = 'utf-8'
                 
-        if shared:
+        if shared and win32 is not None:
             return win32.open_shared(os.fspath(self._path), mode, encoding=encoding)
         else:
             return open(os.fspath(self._path), mode, encoding=encoding)
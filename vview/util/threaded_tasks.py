@@ -18,17 +18,24 @@ class AsyncTask:
     tasks = set()
     task_executor = ThreadPoolExecutor(max_workers=4)
 
+    # AsyncTasks which are currently running.  See get_running_tasks.
+    running_tasks = set()
+
     @classmethod
-    def run(cls, task, *, name):
+    def run(cls, task, *, name, dedicated_thread=False):
         """
         Run a background task.
+
+        Tasks share task_executor's threads.  If dedicated_thread is true, the task gets a
+        thread of its own instead.  Use this for tasks that run for the life of the server,
+        so they don't permanently take up one of the shared threads.
         """
         result = cls()
         result.ran_task = False
 
         # Start _run_main_loop_task as a task in the caller's loop.  This can be awaited or cancelled
         # by the caller to await or cancel the threaded task.
-        main_loop_task = result._run_main_loop_task(task, name=name)
+        main_loop_task = result._run_main_loop_task(task, name=name, dedicated_thread=dedicated_thread)
         main_loop_task = asyncio.get_running_loop().create_task(main_loop_task, name=name)
 
         # Put the task on the task list to prevent it from being GC'd.
@@ -56,7 +63,7 @@ class AsyncTask:
 
         return main_loop_task
 
-    async def _run_main_loop_task(self, task, *, name):
+    async def _run_main_loop_task(self, task, *, name, dedicated_thread=False):
         log.info(f'Running task: {name}')
 
         self.ran_task = True
@@ -71,8 +78,11 @@ class AsyncTask:
         # Create a SyncCancellableTask task for the queued function.  The task will run in the task thread.
         self.task = self.task_loop.create_task(task, name=name)
 
+        self.running_tasks.add(self)
+
         # Start the task.
-        task_loop_task = asyncio.get_running_loop().run_in_executor(self.task_executor, self._run_task)
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name) if dedicated_thread else self.task_executor
+        task_loop_task = asyncio.get_running_loop().run_in_executor(executor, self._run_task)
 
         # Create a future in the main loop, and finish it when task_loop_task is finished.
         future = asyncio.get_running_loop().create_future()
@@ -95,12 +105,39 @@ class AsyncTask:
         # Clean up the task.
         log.info(f'Task {"cancelled" if self.was_cancelled else "finished"}: {self}')
 
+        self.running_tasks.discard(self)
         self.task_loop.close()
         self.task_loop = None
 
+        if executor is not self.task_executor:
+            executor.shutdown(wait=False)
+
     def __str__(self):
         return f'QueuedTask({self.name})'
 
+    @classmethod
+    def set_progress(cls, progress):
+        """
+        Report progress for the background task we're running in.
+
+        progress is a dictionary describing the task's progress, which is returned by
+        get_running_tasks.  This does nothing if we're not running in a background task.
+        """
+        task = asyncio.current_task()
+        if isinstance(task, _SyncCancellableTask):
+            task.progress = progress
+
+    @classmethod
+    def get_running_tasks(cls):
+        """
+        Return a list of running tasks, with their names and the progress they last
+        reported with set_progress.
+        """
+        return [{
+            'name': task.name,
+            'progress': task.task.progress,
+        } for task in list(cls.running_tasks)]
+
     def _cancel(self):
         """
         Ask the task to cancel.
@@ -144,6 +181,9 @@ class _SyncCancellableTask(asyncio.tasks.Task):
         super().__init__(coro, loop=loop)
         self.sync_cancelled = False
 
+        # The progress reported with AsyncTask.set_progress.
+        self.progress = None
+
     def cancel_sync(self):
         """
         Mark this task as cancelled.
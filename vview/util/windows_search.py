@@ -1,15 +1,20 @@
 # This gives an interface to Windows Search, returning results similar to
 # os.scandir.
 
-import asyncio, time, os, stat, logging, threading, queue
+import asyncio, time, os, stat, sys, logging, threading, queue
 import concurrent.futures
 from pathlib import Path
 from pprint import pprint
 
 log = logging.getLogger(__name__)
 
-from . import windows_search_api
-escape_sql = windows_search_api.escape_sql
+# Windows Search is only available on Windows.  SearchDirEntry, SearchTimeout and
+# fallback_search are used by other search providers too.
+if sys.platform == 'win32':
+    from . import windows_search_api
+    escape_sql = windows_search_api.escape_sql
+else:
+    windows_search_api = None
 
 FILE_ATTRIBUTE_READONLY = 0x01
 FILE_ATTRIBUTE_DIRECTORY = 0x10
@@ -182,7 +187,7 @@ def search(*args,
         order=None,
         
         # A sort function that takes a DirEntry and returns a key.  This should match order.
-        # This is used if we fall back to _fallback_search.
+        # This is used if we fall back to fallback_search.
         order_fs=None,
 
         **kwargs):
@@ -214,7 +219,7 @@ def search(*args,
             unseen_paths.remove(unseen_path)
 
     for unseen_path in list(unseen_paths):
-        for result in _fallback_search(*args, paths=[unseen_path], order_fs=order_fs, **kwargs):
+        for result in fallback_search(*args, paths=[unseen_path], order_fs=order_fs, **kwargs):
             yield result
 
 def _windows_search(*,
@@ -377,7 +382,7 @@ def _windows_search(*,
 # isn't available.  This only supports filters that we can implement reasonably quickly.
 # This is just enough to make things functional where we can't use search, like over network
 # mounts.
-def _fallback_search(*,
+def fallback_search(*,
         paths=None,
         exact_path=None,
         filename=None,